@@ -0,0 +1,88 @@
+"""Compare per-element append_asset against the bulk subgraph copy.
+
+    python benchmarks/bulk_copy.py model.ifc --product IfcBuildingElement --keywords door,window
+
+Runs Patcher.patch() both ways on the same selection, prints the timings and
+checks that both outputs contain the same products with the same properties,
+materials, types and geometry.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ifc_viewer_final"))
+
+import ifcopenshell
+import ifcopenshell.util.element
+
+from patcher import Patcher
+
+
+def product_signature(element: ifcopenshell.entity_instance) -> tuple:
+    element_type = ifcopenshell.util.element.get_type(element)
+    material = ifcopenshell.util.element.get_material(element, should_skip_usage=True)
+    psets = ifcopenshell.util.element.get_psets(element)
+    for properties in psets.values():
+        properties.pop("id", None)
+    items = Counter()
+    if element.Representation:
+        for representation in element.Representation.Representations:
+            for item in representation.Items:
+                items[item.is_a()] += 1
+    return (
+        element.is_a(),
+        element.Name,
+        element_type.Name if element_type else None,
+        material.is_a() if material else None,
+        getattr(material, "Name", None) if material else None,
+        repr(sorted(psets.items())),
+        tuple(sorted(items.items())),
+    )
+
+
+def model_signature(file: ifcopenshell.file) -> dict[str, tuple]:
+    return {element.GlobalId: product_signature(element) for element in file.by_type("IfcProduct")}
+
+
+def run(file: ifcopenshell.file, args: argparse.Namespace, bulk_copy: bool) -> tuple[float, ifcopenshell.file]:
+    stories = args.stories.split(",") if args.stories else [s.Name for s in file.by_type("IfcBuildingStorey")]
+    keywords = [keyword for keyword in args.keywords.split(",") if keyword] if args.keywords else []
+    filter_option = "IFC Product and Keywords" if args.product else "Keywords Only"
+    patcher = Patcher(file, logging.getLogger("IFCLogger"), stories, keywords, args.product, filter_option,
+                      bulk_copy=bulk_copy)
+    start = time.perf_counter()
+    patcher.patch()
+    return time.perf_counter() - start, patcher.file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("ifc_file")
+    parser.add_argument("--product", default="IfcProduct", help="IFC class to keep, empty for keywords only")
+    parser.add_argument("--keywords", default="", help="comma separated keywords")
+    parser.add_argument("--stories", default="", help="comma separated storey names, default all")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    file = ifcopenshell.open(args.ifc_file)
+    print(f"parse: {time.perf_counter() - start:.2f}s, {len(file.by_type('IfcProduct'))} products")
+
+    append_time, appended = run(file, args, bulk_copy=False)
+    bulk_time, bulk = run(file, args, bulk_copy=True)
+    print(f"append_asset: {append_time:.2f}s, {len(appended.by_type('IfcProduct'))} products, {len(list(appended))} entities")
+    print(f"bulk copy:    {bulk_time:.2f}s, {len(bulk.by_type('IfcProduct'))} products, {len(list(bulk))} entities")
+    print(f"speedup:      {append_time / bulk_time:.1f}x")
+
+    expected, actual = model_signature(appended), model_signature(bulk)
+    differences = [guid for guid in expected.keys() | actual.keys() if expected.get(guid) != actual.get(guid)]
+    for guid in differences[:10]:
+        print(f"  {guid}: {expected.get(guid)} != {actual.get(guid)}")
+    print("outputs match" if not differences else f"{len(differences)} products differ")
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""Time and memory-profile every pipeline stage on synthetic models.
+
+    python benchmarks/run.py --sizes 1k,10k --output results.json --baseline baseline.json
+
+For each size a deterministic model is generated with synthetic.py (cached in
+--models-dir) and taken through the same stages as the app: parse, filter
+option extraction, filter_elements, patch, to_string, zip and geometry
+conversion. Each stage reports wall and CPU seconds, the growth of resident
+memory and its peak above the stage's starting point, and with --tracemalloc
+the peak of Python allocations. Results are written as JSON; with --baseline
+every stage slower than the baseline by more than --tolerance is reported and
+the exit code is 1.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ifc_viewer_final"))
+
+import ifcopenshell
+
+import synthetic
+from geometry import write_glb
+from model_cache import open_model
+from model_index import ModelIndex
+from patcher import Patcher
+
+# Size name: storeys, products per storey
+SIZES = {
+    "1k": (10, 100),
+    "10k": (20, 500),
+    "100k": (50, 2000),
+    "1m": (100, 10000),
+}
+STAGES = ("parse", "options", "filter", "patch", "to_string", "zip", "geometry")
+
+
+def resident_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        try:
+            import resource
+        except ImportError:  # Windows
+            return 0
+        # ru_maxrss is a high water mark in KiB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class MemorySampler:
+    """Polls resident memory on a thread to catch the peak reached inside native code"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, resident_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "MemorySampler":
+        self.peak = resident_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, resident_bytes())
+
+
+def measure(stage: Callable, use_tracemalloc: bool):
+    """Run stage once, returning its result and its timings and memory use"""
+    if use_tracemalloc:
+        tracemalloc.start()
+    before = resident_bytes()
+    with MemorySampler() as sampler:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        result = stage()
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+    after = resident_bytes()
+    stats = {
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "rss_delta_bytes": after - before,
+        "rss_peak_bytes": sampler.peak - before,
+    }
+    if use_tracemalloc:
+        stats["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, stats
+
+
+def model_path(models_dir: str, size: str, args: argparse.Namespace) -> str:
+    storeys, per_storey = SIZES[size]
+    path = os.path.join(models_dir, f"synthetic-{size}-d{args.depth}-s{args.shared}-seed{args.seed}.ifc")
+    if not os.path.exists(path):
+        model_args = argparse.Namespace(
+            storeys=storeys, products_per_storey=per_storey, depth=args.depth, assembly_every=10,
+            shared=args.shared, vocabulary=",".join(synthetic.VOCABULARY), seed=args.seed,
+        )
+        tmp_path = f"{path}.tmp"
+        synthetic.generate(tmp_path, model_args)
+        os.replace(tmp_path, path)
+    return path
+
+
+def run_size(path: str, args: argparse.Namespace) -> dict:
+    stages = {}
+    state = {}
+
+    def parse():
+        state["file"] = open_model(path)[0]
+
+    def options():
+        file = state["file"]
+        state["stories"] = sorted({story.Name for story in file.by_type("IfcBuildingStorey") if story.Name})
+        return ModelIndex.for_file(file).classes()
+
+    def filter_elements():
+        keywords = [keyword for keyword in args.keywords.split(",") if keyword]
+        filter_option = "IFC Product and Keywords" if args.product else "Keywords Only"
+        stories = state["stories"][:max(1, len(state["stories"]) // 2)]
+        state["patcher"] = Patcher(state["file"], logging.getLogger("IFCLogger"), stories, keywords,
+                                   args.product or None, filter_option, bulk_copy=True)
+        state["elements"] = state["patcher"].filter_elements()
+
+    def patch():
+        # patch() replaces patcher.file with its output, so repeated runs start from the source again
+        state["patcher"].file = state["file"]
+        state["patcher"].patch(elements=state["elements"])
+
+    def to_string():
+        state["text"] = state["patcher"].file.to_string()
+
+    def zip_output():
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("filtered.ifc", state["text"])
+        state["zip_bytes"] = buffer.tell()
+
+    def geometry():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state["glb_elements"] = write_glb(state["patcher"].file, os.path.join(tmp_dir, "filtered.glb"),
+                                              batch=True)
+
+    functions = {"parse": parse, "options": options, "filter": filter_elements, "patch": patch,
+                 "to_string": to_string, "zip": zip_output, "geometry": geometry}
+    for name in STAGES:
+        if name not in args.stages:
+            # Later stages depend on the earlier ones, so they always run, just unreported
+            functions[name]()
+            continue
+        runs = [measure(functions[name], args.tracemalloc)[1] for _ in range(args.repeat)]
+        stages[name] = min(runs, key=lambda stats: stats["seconds"])
+        print(f"  {name:<10} {stages[name]['seconds']:8.3f}s  {stages[name]['rss_peak_bytes'] / 1024 ** 2:8.1f} MiB")
+
+    return {
+        "model": os.path.basename(path),
+        "model_bytes": os.path.getsize(path),
+        "products": len(state["file"].by_type("IfcProduct")),
+        "selected": len(state["elements"]),
+        "output_products": len(state["patcher"].file.by_type("IfcProduct")),
+        "output_bytes": len(state["text"]),
+        "zip_bytes": state["zip_bytes"],
+        "stages": stages,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Stages slower than in baseline by more than tolerance, as printable lines"""
+    regressions = []
+    for size, result in results["sizes"].items():
+        baseline_stages = baseline.get("sizes", {}).get(size, {}).get("stages", {})
+        for name, stats in result["stages"].items():
+            if name not in baseline_stages:
+                continue
+            before, after = baseline_stages[name]["seconds"], stats["seconds"]
+            ratio = after / before if before else float("inf")
+            marker = "  REGRESSION" if ratio > 1 + tolerance else ""
+            print(f"  {size:<5} {name:<10} {before:8.3f}s -> {after:8.3f}s  x{ratio:.2f}{marker}")
+            if marker:
+                regressions.append(f"{size} {name}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1k,10k", help=f"comma separated, from {', '.join(SIZES)}")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to report")
+    parser.add_argument("--depth", type=int, default=2, help="decomposition depth of the generated models")
+    parser.add_argument("--shared", type=float, default=0.5, help="fraction of products with shared representations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--product", default="IfcBuildingElement", help="IFC class to keep, empty for keywords only")
+    parser.add_argument("--keywords", default="", help="comma separated keywords, default none")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the fastest is kept")
+    parser.add_argument("--tracemalloc", action="store_true", help="also record peak Python allocations (slower)")
+    parser.add_argument("--models-dir", default=os.path.join(tempfile.gettempdir(), "ifc_benchmark_models"))
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+    args.stages = [stage for stage in args.stages.split(",") if stage]
+    sizes = [size for size in args.sizes.split(",") if size]
+    unknown = [name for name in sizes if name not in SIZES] + [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown sizes or stages: {', '.join(unknown)}")
+
+    os.makedirs(args.models_dir, exist_ok=True)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "ifcopenshell": ifcopenshell.version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "arguments": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+        "sizes": {},
+    }
+    for size in sizes:
+        path = model_path(args.models_dir, size, args)
+        print(f"{size}: {path}")
+        results["sizes"][size] = run_size(path, args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"{len(regressions)} regressions" if regressions else "no regressions")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
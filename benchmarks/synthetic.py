@@ -0,0 +1,283 @@
+"""Generate deterministic synthetic IFC4 models for benchmarking.
+
+    python benchmarks/synthetic.py model.ifc --storeys 10 --products-per-storey 1000 --depth 2 --shared 0.5
+
+The same arguments and seed always produce the same file, byte for byte. The
+STEP text is written directly rather than through ifcopenshell.api so that
+models with a million products are generated in seconds.
+
+Every product has a placement, a property set with two properties, a material
+and an extruded box body. A --shared fraction of the products map a
+representation of their type (IfcMappedItem of an IfcRepresentationMap)
+instead of owning their geometry. With --depth, every --assembly-every'th
+product is an IfcElementAssembly whose parts are nested --depth levels deep.
+"""
+import argparse
+import random
+import sys
+import uuid
+from typing import TextIO
+
+import ifcopenshell.guid
+
+# Class, trailing attributes after Tag, type class, trailing type attributes after ElementType
+CLASSES = [
+    ("IfcWall", ".NOTDEFINED.", "IfcWallType", ".NOTDEFINED."),
+    ("IfcSlab", ".NOTDEFINED.", "IfcSlabType", ".NOTDEFINED."),
+    ("IfcColumn", ".NOTDEFINED.", "IfcColumnType", ".NOTDEFINED."),
+    ("IfcBeam", ".NOTDEFINED.", "IfcBeamType", ".NOTDEFINED."),
+    ("IfcMember", ".NOTDEFINED.", "IfcMemberType", ".NOTDEFINED."),
+    ("IfcDoor", "$,$,.NOTDEFINED.,$,$", "IfcDoorType", ".NOTDEFINED.,.NOTDEFINED.,$,$"),
+    ("IfcWindow", "$,$,.NOTDEFINED.,$,$", "IfcWindowType", ".NOTDEFINED.,.NOTDEFINED.,$,$"),
+    ("IfcFurniture", ".NOTDEFINED.", "IfcFurnitureType", ".NOTDEFINED.,.NOTDEFINED."),
+]
+PART_CLASSES = ["IfcBeam", "IfcMember"]
+VOCABULARY = ["fire", "external", "internal", "load bearing", "acoustic", "glazed", "steel", "timber", "concrete",
+              "insulated", "temporary", "demolished", "new", "existing", "red", "blue"]
+MATERIALS = [("Concrete", 0.7, 0.7, 0.7), ("Steel", 0.5, 0.55, 0.6), ("Timber", 0.65, 0.45, 0.25),
+             ("Glass", 0.6, 0.8, 0.9), ("Brick", 0.7, 0.3, 0.2)]
+TYPES_PER_CLASS = 5
+# Box size per class: x, y, height
+SIZES = {"IfcWall": (4.0, 0.2, 3.0), "IfcSlab": (6.0, 6.0, 0.25), "IfcColumn": (0.4, 0.4, 3.0),
+         "IfcBeam": (5.0, 0.3, 0.5), "IfcMember": (2.0, 0.1, 0.1), "IfcDoor": (0.9, 0.1, 2.1),
+         "IfcWindow": (1.2, 0.1, 1.4), "IfcFurniture": (1.0, 0.6, 0.8)}
+
+
+class StepWriter:
+    """Writes entities with increasing ids and returns the id of each"""
+
+    def __init__(self, output: TextIO):
+        self.output = output
+        self.next_id = 1
+
+    def add(self, entity: str, *attributes) -> int:
+        entity_id = self.next_id
+        self.next_id += 1
+        self.output.write(f"#{entity_id}={entity.upper()}({','.join(attributes)});\n")
+        return entity_id
+
+
+def ref(entity_id) -> str:
+    return f"#{entity_id}" if entity_id else "$"
+
+
+def refs(entity_ids) -> str:
+    return "(" + ",".join(f"#{i}" for i in entity_ids) + ")"
+
+
+def string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def real(value: float) -> str:
+    text = repr(float(value))
+    return text if "e" in text or "." in text else text + "."
+
+
+def point(values) -> str:
+    return "(" + ",".join(real(v) for v in values) + ")"
+
+
+class SyntheticModel:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.vocabulary = [word.strip() for word in args.vocabulary.split(",") if word.strip()]
+        self.products = 0
+        self.by_type: dict[int, list[int]] = {}
+        self.by_material: dict[int, list[int]] = {}
+
+    def guid(self) -> str:
+        return string(ifcopenshell.guid.compress(uuid.UUID(int=self.rng.getrandbits(128)).hex))
+
+    def write(self, output: TextIO) -> int:
+        output.write("ISO-10303-21;\nHEADER;\n")
+        output.write("FILE_DESCRIPTION(('ViewDefinition [DesignTransferView]'),'2;1');\n")
+        output.write("FILE_NAME('synthetic.ifc','2000-01-01T00:00:00',(''),(''),'synthetic.py','','');\n")
+        output.write("FILE_SCHEMA(('IFC4'));\nENDSEC;\nDATA;\n")
+        self.step = step = StepWriter(output)
+
+        person = step.add("IfcPerson", "$", string("Benchmark"), "$", "$", "$", "$", "$", "$")
+        organization = step.add("IfcOrganization", "$", string("Benchmark"), "$", "$", "$")
+        user = step.add("IfcPersonAndOrganization", ref(person), ref(organization), "$")
+        application = step.add("IfcApplication", ref(organization), string("1.0"), string("synthetic.py"),
+                               string("synthetic"))
+        self.owner = step.add("IfcOwnerHistory", ref(user), ref(application), "$", ".NOCHANGE.", "$", "$", "$",
+                              "946684800")
+        units = [
+            step.add("IfcSIUnit", "*", ".LENGTHUNIT.", "$", ".METRE."),
+            step.add("IfcSIUnit", "*", ".AREAUNIT.", "$", ".SQUARE_METRE."),
+            step.add("IfcSIUnit", "*", ".VOLUMEUNIT.", "$", ".CUBIC_METRE."),
+            step.add("IfcSIUnit", "*", ".PLANEANGLEUNIT.", "$", ".RADIAN."),
+        ]
+        unit_assignment = step.add("IfcUnitAssignment", refs(units))
+        self.origin = step.add("IfcCartesianPoint", point((0, 0, 0)))
+        self.z_axis = step.add("IfcDirection", point((0, 0, 1)))
+        self.x_axis = step.add("IfcDirection", point((1, 0, 0)))
+        world = step.add("IfcAxis2Placement3D", ref(self.origin), ref(self.z_axis), ref(self.x_axis))
+        context = step.add("IfcGeometricRepresentationContext", "$", string("Model"), "3", "1.E-05", ref(world), "$")
+        self.body = step.add("IfcGeometricRepresentationSubContext", string("Body"), string("Model"), "*", "*", "*",
+                             "*", ref(context), "$", ".MODEL_VIEW.", "$")
+        project = step.add("IfcProject", self.guid(), ref(self.owner), string("Synthetic Project"), "$", "$", "$",
+                           "$", refs([context]), ref(unit_assignment))
+
+        site_placement = self.placement(None, (0, 0, 0))
+        site = step.add("IfcSite", self.guid(), ref(self.owner), string("Site"), "$", "$", ref(site_placement),
+                        "$", "$", ".ELEMENT.", "$", "$", "$", "$", "$")
+        building_placement = self.placement(site_placement, (0, 0, 0))
+        building = step.add("IfcBuilding", self.guid(), ref(self.owner), string("Building"), "$", "$",
+                            ref(building_placement), "$", "$", ".ELEMENT.", "$", "$", "$")
+        step.add("IfcRelAggregates", self.guid(), ref(self.owner), "$", "$", ref(project), refs([site]))
+        step.add("IfcRelAggregates", self.guid(), ref(self.owner), "$", "$", ref(site), refs([building]))
+
+        self.styles = {}
+        self.materials = []
+        for name, r, g, b in MATERIALS:
+            material = step.add("IfcMaterial", string(name), "$", "$")
+            colour = step.add("IfcColourRgb", "$", real(r), real(g), real(b))
+            shading = step.add("IfcSurfaceStyleShading", ref(colour), "$")
+            self.styles[material] = step.add("IfcSurfaceStyle", string(name), ".BOTH.", refs([shading]))
+            self.materials.append(material)
+
+        self.types = {}
+        for ifc_class, _, type_class, type_attributes in CLASSES:
+            for n in range(TYPES_PER_CLASS):
+                material = self.rng.choice(self.materials)
+                solid = self.box(SIZES[ifc_class], material)
+                shape = step.add("IfcShapeRepresentation", ref(self.body), string("Body"), string("SweptSolid"),
+                                 refs([solid]))
+                mapping_origin = step.add("IfcAxis2Placement3D", ref(self.origin), "$", "$")
+                representation_map = step.add("IfcRepresentationMap", ref(mapping_origin), ref(shape))
+                type_id = step.add(type_class, self.guid(), ref(self.owner), string(f"{ifc_class[3:]} Type {n + 1}"),
+                                   "$", "$", "$", refs([representation_map]), "$", "$", type_attributes)
+                self.types.setdefault(ifc_class, []).append((type_id, representation_map, material))
+
+        storeys = []
+        for s in range(self.args.storeys):
+            elevation = s * 3.0
+            storey_placement = self.placement(building_placement, (0, 0, elevation))
+            storey = step.add("IfcBuildingStorey", self.guid(), ref(self.owner), string(f"Level {s}"), "$", "$",
+                              ref(storey_placement), "$", "$", ".ELEMENT.", real(elevation))
+            storeys.append(storey)
+            contained = []
+            slot = 0
+            target = self.products + self.args.products_per_storey
+            while self.products < target:
+                x, y = (slot % 50) * 6.0, (slot // 50) * 6.0
+                if self.args.depth and slot % self.args.assembly_every == self.args.assembly_every - 1:
+                    contained.append(self.assembly(storey_placement, (x, y, 0), s, slot, self.args.depth))
+                else:
+                    ifc_class = CLASSES[self.rng.randrange(len(CLASSES))][0]
+                    contained.append(self.element(ifc_class, storey_placement, (x, y, 0), s, slot))
+                slot += 1
+            step.add("IfcRelContainedInSpatialStructure", self.guid(), ref(self.owner), "$", "$", refs(contained),
+                     ref(storey))
+        step.add("IfcRelAggregates", self.guid(), ref(self.owner), "$", "$", ref(building), refs(storeys))
+
+        for type_id, related in self.by_type.items():
+            step.add("IfcRelDefinesByType", self.guid(), ref(self.owner), "$", "$", refs(related), ref(type_id))
+        for material, related in self.by_material.items():
+            step.add("IfcRelAssociatesMaterial", self.guid(), ref(self.owner), "$", "$", refs(related),
+                     ref(material))
+        output.write("ENDSEC;\nEND-ISO-10303-21;\n")
+        return self.products
+
+    def placement(self, relative_to, location) -> int:
+        position = self.step.add("IfcCartesianPoint", point(location))
+        axes = self.step.add("IfcAxis2Placement3D", ref(position), "$", "$")
+        return self.step.add("IfcLocalPlacement", ref(relative_to), ref(axes))
+
+    def box(self, size, material) -> int:
+        x, y, height = size
+        profile = self.step.add("IfcRectangleProfileDef", ".AREA.", "$", "$", real(x), real(y))
+        solid = self.step.add("IfcExtrudedAreaSolid", ref(profile), "$", ref(self.z_axis), real(height))
+        self.step.add("IfcStyledItem", ref(solid), refs([self.styles[material]]), "$")
+        return solid
+
+    def name(self, ifc_class: str, storey: int, slot: int) -> str:
+        return string(f"{ifc_class[3:]} {self.rng.choice(self.vocabulary)} {storey}-{slot}")
+
+    def element(self, ifc_class: str, relative_to: int, location, storey: int, slot: int) -> int:
+        step = self.step
+        placement = self.placement(relative_to, location)
+        type_id, representation_map, material = self.rng.choice(self.types[ifc_class])
+        if self.rng.random() < self.args.shared:
+            operator = step.add("IfcCartesianTransformationOperator3D", "$", "$", ref(self.origin), "$", "$")
+            item = step.add("IfcMappedItem", ref(representation_map), ref(operator))
+            shape = step.add("IfcShapeRepresentation", ref(self.body), string("Body"), string("MappedRepresentation"),
+                             refs([item]))
+        else:
+            width, depth, height = SIZES[ifc_class]
+            scale = 0.5 + self.rng.random()
+            solid = self.box((width * scale, depth, height), material)
+            shape = step.add("IfcShapeRepresentation", ref(self.body), string("Body"), string("SweptSolid"),
+                             refs([solid]))
+        definition = step.add("IfcProductDefinitionShape", "$", "$", refs([shape]))
+        class_attributes = next(attributes for name, attributes, _, _ in CLASSES if name == ifc_class)
+        attributes = [self.guid(), ref(self.owner), self.name(ifc_class, storey, slot), "$", "$", ref(placement),
+                      ref(definition), "$"]
+        if class_attributes:
+            attributes.append(class_attributes)
+        element = step.add(ifc_class, *attributes)
+        self.by_type.setdefault(type_id, []).append(element)
+        self.by_material.setdefault(material, []).append(element)
+        self.pset(element, slot)
+        self.products += 1
+        return element
+
+    def assembly(self, relative_to: int, location, storey: int, slot: int, depth: int) -> int:
+        step = self.step
+        placement = self.placement(relative_to, location)
+        assembly = step.add("IfcElementAssembly", self.guid(), ref(self.owner), self.name("IfcAssembly", storey, slot),
+                            "$", "$", ref(placement), "$", "$", ".NOTDEFINED.", ".NOTDEFINED.")
+        self.pset(assembly, slot)
+        self.products += 1
+        parts = []
+        for n in range(2):
+            offset = (0, n * 0.5, depth * 0.5)
+            if depth > 1:
+                parts.append(self.assembly(placement, offset, storey, slot, depth - 1))
+            else:
+                parts.append(self.element(PART_CLASSES[n], placement, offset, storey, slot))
+        step.add("IfcRelAggregates", self.guid(), ref(self.owner), "$", "$", ref(assembly), refs(parts))
+        return assembly
+
+    def pset(self, element: int, slot: int) -> None:
+        step = self.step
+        properties = [
+            step.add("IfcPropertySingleValue", string("IsExternal"), "$",
+                     f"IFCBOOLEAN({'.T.' if slot % 2 else '.F.'})", "$"),
+            step.add("IfcPropertySingleValue", string("FireRating"), "$", f"IFCLABEL('EI{30 * (slot % 4)}')", "$"),
+        ]
+        pset = step.add("IfcPropertySet", self.guid(), ref(self.owner), string("Pset_Common"), "$", refs(properties))
+        step.add("IfcRelDefinesByProperties", self.guid(), ref(self.owner), "$", "$", refs([element]), ref(pset))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--storeys", type=int, default=10)
+    parser.add_argument("--products-per-storey", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=0, help="decomposition depth of element assemblies, 0 for none")
+    parser.add_argument("--assembly-every", type=int, default=10, help="every n-th product slot is an assembly")
+    parser.add_argument("--shared", type=float, default=0.5, help="fraction of products mapping a type representation")
+    parser.add_argument("--vocabulary", default=",".join(VOCABULARY), help="comma separated words used in names")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generate(path: str, args: argparse.Namespace) -> int:
+    """Write the model described by args to path, returning the number of products"""
+    with open(path, "w", encoding="ascii", newline="\n") as f:
+        return SyntheticModel(args).write(f)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output")
+    add_arguments(parser)
+    args = parser.parse_args()
+    products = generate(args.output, args)
+    print(f"{args.output}: {products} products")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
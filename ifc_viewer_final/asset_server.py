@@ -0,0 +1,278 @@
+import errno
+import hashlib
+import ipaddress
+import mimetypes
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Union
+
+from shared_cache import evict_least_recently_used
+
+DEFAULT_ASSET_DIR = os.environ.get("IFC_ASSET_DIR", os.path.join(tempfile.gettempdir(), "ifc_assets"))
+DEFAULT_ASSET_PORT = int(os.environ.get("IFC_ASSET_PORT", 8502))
+# Only browsers on this host reach the default; binding anything else requires IFC_ASSET_URL
+DEFAULT_ASSET_HOST = os.environ.get("IFC_ASSET_HOST", "127.0.0.1")
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_ASSET_BYTES", 4 * 1024 ** 3))
+# URL under which browsers reach the asset server, e.g. https://example.com/assets behind a proxy
+ASSET_BASE_URL = os.environ.get("IFC_ASSET_URL")
+TOKEN_FILE = ".token"
+
+ASSET_NAME = re.compile(r"^/([0-9A-Za-z_-]{43})/([0-9a-f]{64}\.[a-z0-9]+)?$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 1024 * 1024
+
+mimetypes.add_type("model/gltf-binary", ".glb")
+mimetypes.add_type("application/x-step", ".ifc")
+mimetypes.add_type("application/zip", ".ifczip")
+
+
+def read_token(directory: str) -> str:
+    """The secret every asset URL of directory starts with, created on first use and shared by its processes"""
+    path = os.path.join(directory, TOKEN_FILE)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_urlsafe(32))
+    # A process that lost the race may read before the winner wrote
+    for _ in range(100):
+        with open(path, "r") as f:
+            token = f.read().strip()
+        if token:
+            return token
+        threading.Event().wait(0.01)
+    raise RuntimeError(f"{path} is empty")
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+class AssetRequestHandler(BaseHTTPRequestHandler):
+    """Serves content-addressed files with single-range support.
+
+    Paths are /<token>/<sha256>.<extension>; anything else is a 404, so only
+    pages that were handed a URL can fetch the files. /<token>/ itself
+    answers 204, which is how other processes recognise the server.
+    """
+    directory: str = DEFAULT_ASSET_DIR
+    token: str = ""
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.end_headers()
+
+    def send_cors_headers(self):
+        # The viewer component is rendered in a sandboxed iframe with an opaque origin; the token in the path
+        # is what keeps other pages out
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Headers", "Range")
+        self.send_header("Access-Control-Expose-Headers", "Content-Length, Content-Range, Accept-Ranges")
+
+    def serve(self, send_body: bool):
+        match = ASSET_NAME.match(self.path.split("?", 1)[0])
+        if match is None or not secrets.compare_digest(match.group(1), self.token):
+            self.send_error(404)
+            return
+        if match.group(2) is None:
+            self.send_response(204)
+            self.end_headers()
+            return
+        path = os.path.join(self.directory, match.group(2))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        range_match = RANGE.match(range_header.strip()) if range_header else None
+        # Malformed ranges are ignored and the whole file is sent, as RFC 9110 allows
+        if range_match and (range_match.group(1) or range_match.group(2)):
+            if range_match.group(1):
+                start = int(range_match.group(1))
+                if range_match.group(2):
+                    end = min(int(range_match.group(2)), size - 1)
+            else:
+                start = max(size - int(range_match.group(2)), 0)
+            status = 206
+            if start > end or start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_cors_headers()
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{os.path.splitext(os.path.basename(path))[0]}"')
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_cors_headers()
+        self.end_headers()
+        if not send_body:
+            return
+        os.utime(path)
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AssetServer:
+    """Background HTTP server for filtered IFC and GLB files, addressed by content hash.
+
+    Lets the viewer fetch models by URL instead of receiving them base64
+    inlined in the component HTML. Every process of the app sharing
+    directory shares one server: the first binds host:port, and the others
+    find it there serving the same directory and only publish files into it.
+    Whichever process publishes next takes over the port if its owner has
+    exited. URLs carry a secret token kept in the directory.
+
+    The server binds 127.0.0.1 by default, which only browsers on the same
+    host can reach. To serve remote browsers, bind another host and set
+    base_url (IFC_ASSET_URL) to the address they reach it under, usually a
+    proxy in front of it; without base_url this is refused.
+    """
+
+    def __init__(
+            self,
+            directory: str = DEFAULT_ASSET_DIR,
+            port: int = DEFAULT_ASSET_PORT,
+            base_url: Union[str, None] = ASSET_BASE_URL,
+            budget_bytes: int = DEFAULT_BUDGET_BYTES,
+            host: str = DEFAULT_ASSET_HOST
+    ):
+        if not base_url and not is_loopback(host):
+            raise ValueError(f"Serving assets on {host} needs the URL browsers reach them under; set IFC_ASSET_URL")
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.host = host
+        self.port = port
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.token = read_token(directory)
+        self.handler = type("BoundAssetRequestHandler", (AssetRequestHandler,),
+                            {"directory": directory, "token": self.token})
+        self.server: Union[ThreadingHTTPServer, None] = None
+        self.thread: Union[threading.Thread, None] = None
+        self.ensure_serving()
+        self.base_url = (base_url or f"http://localhost:{self.port}").rstrip("/")
+
+    def ensure_serving(self) -> None:
+        """Serve directory on host:port, unless this or another process of the app already does"""
+        with self._lock:
+            if self.server is not None or self.served_elsewhere():
+                return
+            try:
+                server = ThreadingHTTPServer((self.host, self.port), self.handler)
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
+                if self.served_elsewhere():
+                    return
+                raise RuntimeError(f"Port {self.port} is taken by something other than an asset server for "
+                                   f"{self.directory}; set IFC_ASSET_PORT to a free port") from e
+            server.daemon_threads = True
+            # Port 0 asks for any free one
+            self.server, self.port = server, server.server_address[1]
+            self.thread = threading.Thread(target=server.serve_forever, name="AssetServer", daemon=True)
+            self.thread.start()
+
+    def served_elsewhere(self) -> bool:
+        """Whether a server on the port answers for the token of directory, so it serves the same files"""
+        if not self.port:
+            return False
+        host = "127.0.0.1" if self.host in ("0.0.0.0", "") else self.host
+        url = f"http://{'[' + host + ']' if ':' in host else host}:{self.port}/{self.token}/"
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=1) as response:
+                return response.status == 204
+        except OSError:
+            return False
+
+    def url(self, name: str) -> str:
+        self.ensure_serving()
+        return f"{self.base_url}/{self.token}/{name}"
+
+    def publish_file(self, path: str, extension: str) -> str:
+        """Make a file available by content hash, returning its URL"""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        name = f"{digest.hexdigest()}.{extension.lstrip('.')}"
+        target = os.path.join(self.directory, name)
+        if os.path.exists(target):
+            os.utime(target)
+            return self.url(name)
+        tmp_path = os.path.join(self.directory, f"{name}.{uuid.uuid4().hex}.tmp.part")
+        try:
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=target)
+        return self.url(name)
+
+    def publish_bytes(self, data: bytes, extension: str) -> str:
+        name = f"{hashlib.sha256(data).hexdigest()}.{extension.lstrip('.')}"
+        target = os.path.join(self.directory, name)
+        if os.path.exists(target):
+            os.utime(target)
+            return self.url(name)
+        tmp_path = os.path.join(self.directory, f"{name}.{uuid.uuid4().hex}.tmp.part")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=target)
+        return self.url(name)
+
+    def evict(self, keep: str = "") -> None:
+        with self._lock:
+            evict_least_recently_used(self.directory, self.budget_bytes, keep=keep,
+                                      suffixes=tuple(f".{ext}" for ext in ("glb", "ifc", "ifczip", "json", "bin")))
+
+    def shutdown(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
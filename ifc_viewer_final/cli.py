@@ -0,0 +1,199 @@
+"""Headless batch filtering of IFC models.
+
+    python cli.py models/ --spec nightly.json --output out/ --workers 4 --memory-limit 4096
+
+The spec file is JSON, either one filter spec or a list of them:
+
+    [
+        {"name": "doors", "filter_option": "IFC Product and Keywords", "ifc_product": "IfcDoor",
+         "stories": ["Level 1", "Level 2"], "keywords": ["fire", "!temporary"], "keyword_mode": "word"},
+        {"name": "ducts", "filter_option": "Keywords Only", "keywords": "duct, pipe"},
+        {"name": "rated walls", "query": "IfcWall and Pset_WallCommon.FireRating = \"EI60\" and not name ~ temp"}
+    ]
+
+Omitted stories keep all storeys. A spec with a query defaults to the Query
+filter option; see query.Query for the syntax. Each model is opened once, in its own worker
+process, and every spec is applied to it. A manifest with per-model and
+per-spec timings is written to the output directory.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Union
+
+from model_cache import open_model
+from model_index import ModelIndex
+from patcher import Patcher
+
+logger = logging.getLogger("IFCLogger")
+
+MODEL_EXTENSIONS = (".ifc", ".ifczip")
+
+
+def find_models(inputs: list[str]) -> list[str]:
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            candidates = sorted(glob.glob(pattern, recursive=True))
+        paths.extend(p for p in candidates if os.path.isfile(p) and p.lower().endswith(MODEL_EXTENSIONS))
+    return list(dict.fromkeys(paths))
+
+
+def output_stems(paths: list[str]) -> dict[str, str]:
+    """Output filename prefix per model, unique even when models in different folders share a name"""
+    stems = {}
+    taken = set()
+    for path in paths:
+        stem = base = os.path.splitext(os.path.basename(path))[0]
+        n = 1
+        while stem in taken:
+            n += 1
+            stem = f"{base}_{n}"
+        taken.add(stem)
+        stems[path] = stem
+    return stems
+
+
+def load_specs(path: str) -> list[dict]:
+    with open(path, "r") as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [specs]
+    for i, spec in enumerate(specs):
+        keywords = spec.get("keywords") or []
+        if isinstance(keywords, str):
+            keywords = keywords.split(",")
+        spec["keywords"] = [kw.strip() for kw in keywords if kw.strip()]
+        spec.setdefault("name", f"spec{i + 1}")
+        spec.setdefault("ifc_product", None)
+        spec.setdefault("query", None)
+        spec.setdefault("filter_option", "Query" if spec["query"] else
+                        "IFC Product and Keywords" if spec["ifc_product"] else "Keywords Only")
+        spec.setdefault("keyword_mode", "substring")
+        spec.setdefault("stories", None)
+    return specs
+
+
+def limit_memory(memory_limit_mb: Union[int, None]) -> None:
+    """Worker initializer capping the address space of the worker process"""
+    if not memory_limit_mb:
+        return
+    try:
+        import resource
+    except ImportError:
+        logger.warning("Per-worker memory limits are not supported on this platform")
+        return
+    limit = memory_limit_mb * 1024 ** 2
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def process_model(path: str, stem: str, specs: list[dict], output_dir: str) -> dict:
+    result = {"model": path, "outputs": [], "error": None}
+    start = time.perf_counter()
+    try:
+        file, size = open_model(path)
+        result["ifc_bytes"] = size
+        result["parse_seconds"] = time.perf_counter() - start
+
+        index_start = time.perf_counter()
+        index = ModelIndex.for_file(file)
+        all_stories = sorted({story.Name for story in file.by_type("IfcBuildingStorey") if story.Name})
+        result["products"] = len(index)
+        result["index_seconds"] = time.perf_counter() - index_start
+
+        for spec in specs:
+            output = {"spec": spec["name"], "error": None}
+            try:
+                patcher = Patcher(
+                    file=file,
+                    logger=logger,
+                    stories=spec["stories"] or all_stories,
+                    keywords=spec["keywords"],
+                    ifc_product=spec["ifc_product"],
+                    filter_option=spec["filter_option"],
+                    keyword_mode=spec["keyword_mode"],
+                    index=index,
+                    bulk_copy=True,
+                    query=spec["query"]
+                )
+                patch_start = time.perf_counter()
+                patcher.patch()
+                output["patch_seconds"] = time.perf_counter() - patch_start
+                output["products"] = len(patcher.file.by_type("IfcProduct"))
+
+                write_start = time.perf_counter()
+                output_path = os.path.join(output_dir, f"{stem}__{spec['name']}.ifc")
+                patcher.file.write(output_path)
+                output["path"] = output_path
+                output["write_seconds"] = time.perf_counter() - write_start
+            except Exception as e:
+                output["error"] = f"{type(e).__name__}: {e}"
+            result["outputs"].append(output)
+    except MemoryError:
+        result["error"] = "MemoryError: worker memory limit exceeded"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def main(argv: Union[list[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(description="Filter many IFC models headlessly.")
+    parser.add_argument("inputs", nargs="+", help="directories, files or glob patterns of .ifc/.ifczip models")
+    parser.add_argument("--spec", required=True, help="JSON filter spec file")
+    parser.add_argument("--output", required=True, help="directory for filtered models and the manifest")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--memory-limit", type=int, default=None, help="per-worker address space limit in MB")
+    parser.add_argument("--manifest", default="manifest.json", help="manifest filename inside the output directory")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    models = find_models(args.inputs)
+    if not models:
+        logger.error("No .ifc or .ifczip files found")
+        return 1
+    specs = load_specs(args.spec)
+    stems = output_stems(models)
+    os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    # One model per worker process, so memory from large models is returned to the OS
+    with ProcessPoolExecutor(
+            max_workers=min(args.workers, len(models)),
+            initializer=limit_memory,
+            initargs=(args.memory_limit,),
+            max_tasks_per_child=1
+    ) as executor:
+        futures = {executor.submit(process_model, path, stems[path], specs, args.output): path for path in models}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"model": futures[future], "outputs": [], "error": f"{type(e).__name__}: {e}"}
+            logger.info("%s: %s", result["model"], result["error"] or f"done in {result['seconds']:.1f}s")
+            results.append(result)
+
+    results.sort(key=lambda r: models.index(r["model"]))
+    manifest = {
+        "specs": specs,
+        "workers": args.workers,
+        "memory_limit_mb": args.memory_limit,
+        "seconds": time.perf_counter() - start,
+        "failed": sum(1 for r in results if r["error"] or any(o["error"] for o in r["outputs"])),
+        "models": results,
+    }
+    with open(os.path.join(args.output, args.manifest), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return 1 if manifest["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+import csv
+import hashlib
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Iterable, Union
+
+import ifcopenshell
+import numpy as np
+
+import shared_cache
+from instrumentation import span
+from model_index import ModelIndex
+
+DEFAULT_TABLE_DIR = os.environ.get("IFC_TABLE_DIR", shared_cache.cache_dir("tables"))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_TABLE_BYTES", 1024 ** 3))
+# Property sets whose values become columns, by default the standard Pset_<Class>Common sets
+DEFAULT_PROPERTY_SETS = os.environ.get("IFC_TABLE_PROPERTY_SETS", r"^Pset_\w*Common$")
+CSV_CHUNK_ROWS = 50_000
+TABLE_FORMATS = {"CSV": ".csv", "NPZ": ".npz"}
+TABLE_VERSION = 1
+MISSING = -1
+
+
+def categorical(values_by_position: dict[int, str], rows: int) -> tuple[np.ndarray, np.ndarray]:
+    """Codes per row into sorted categories, MISSING for rows without a value"""
+    categories = sorted(set(values_by_position.values()))
+    code_of = {category: code for code, category in enumerate(categories)}
+    codes = np.full(rows, MISSING, dtype=np.int32)
+    if values_by_position:
+        positions = np.fromiter(values_by_position, dtype=np.int64, count=len(values_by_position))
+        codes[positions] = np.fromiter((code_of[value] for value in values_by_position.values()), dtype=np.int32,
+                                       count=len(values_by_position))
+    return codes, np.array(categories, dtype=str)
+
+
+def grouped(groups: dict[str, set[int]], rows: int) -> tuple[np.ndarray, np.ndarray]:
+    """Codes of a categorical column given the rows of each category, as the ModelIndex keeps them"""
+    categories = sorted(name for name, members in groups.items() if members)
+    codes = np.full(rows, MISSING, dtype=np.int32)
+    for code, name in enumerate(categories):
+        codes[np.fromiter(groups[name], dtype=np.int64, count=len(groups[name]))] = code
+    return codes, np.array(categories, dtype=str)
+
+
+class ElementTable:
+    """One row per IfcProduct of a model, in ModelIndex order, stored by column.
+
+    Columns with few distinct values, such as the class, storey, type and
+    property values, are categorical: int32 codes into an array of
+    categories, with MISSING for rows without a value. Properties whose
+    values are all numbers are float64 columns with NaN for missing values.
+    GlobalId and Name are plain string arrays.
+    """
+
+    def __init__(self, columns: dict[str, np.ndarray], categories: dict[str, np.ndarray]):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return len(self.columns["GlobalId"])
+
+    @classmethod
+    def build(cls, file: ifcopenshell.file, index: Union[ModelIndex, None] = None,
+              property_sets: str = DEFAULT_PROPERTY_SETS) -> "ElementTable":
+        """Extract the table from the model, using the lookups the ModelIndex has or builds anyway"""
+        index = index if index is not None and index.file is file else ModelIndex.for_file(file)
+        rows = len(index)
+        products = index.products()
+        columns = {}
+        categories = {}
+        # GlobalId and Name, read by position
+        columns["GlobalId"] = np.array([element[0] for element in products], dtype=str)
+        columns["Name"] = np.array([element[2] or "" for element in products], dtype=str)
+        columns["Class"], categories["Class"] = grouped(index.by_class, rows)
+        columns["Storey"], categories["Storey"] = grouped(
+            {storey: members for storey, members in index.by_storey.items() if storey}, rows
+        )
+        types = {}
+        for element_type, positions in index.typed_occurrences():
+            if element_type.Name:
+                types.setdefault(element_type.Name, set()).update(positions)
+        columns["Type"], categories["Type"] = grouped(types, rows)
+
+        pattern = re.compile(property_sets)
+        # Spelled as in the first definition of each set
+        names = sorted(file.by_id(definitions[0][0])[2] for definitions in index.property_sets().values())
+        names = [name for name in names if pattern.search(name)]
+        for pset in names:
+            for prop, by_position in sorted(index.occurrence_properties(pset).items()):
+                name = f"{pset}.{prop}"
+                values = {position: values for position, values in by_position.items() if values}
+                if values and all(len(value) == 1 and isinstance(value[0], (int, float))
+                                  and not isinstance(value[0], bool) for value in values.values()):
+                    column = np.full(rows, np.nan)
+                    column[np.fromiter(values, dtype=np.int64, count=len(values))] = np.fromiter(
+                        (value[0] for value in values.values()), dtype=np.float64, count=len(values)
+                    )
+                    columns[name] = column
+                else:
+                    columns[name], categories[name] = categorical(
+                        {position: "; ".join(map(str, value)) for position, value in values.items()}, rows
+                    )
+        return cls(columns, categories)
+
+    def take(self, rows: np.ndarray) -> "ElementTable":
+        """The given rows of the table; categories are shared"""
+        return ElementTable({name: column[rows] for name, column in self.columns.items()}, self.categories)
+
+    def decoded(self, name: str, rows: Union[slice, np.ndarray] = slice(None)) -> np.ndarray:
+        """Values of a column as shown to users, "" or NaN where missing"""
+        column = self.columns[name][rows]
+        if name not in self.categories:
+            return column
+        # Code MISSING picks the "" appended at the end
+        return np.append(self.categories[name], "")[column]
+
+    def to_dict(self, limit: Union[int, None] = None) -> dict[str, np.ndarray]:
+        return {name: self.decoded(name, slice(0, limit)) for name in self.columns}
+
+    def save(self, path: str, compressed: bool = True) -> None:
+        """Write the table as .npz, one array at a time: the columns, then "<column>#categories" for categoricals"""
+        arrays = {"#columns": np.array(list(self.columns), dtype=str)}
+        arrays.update(self.columns)
+        arrays.update({f"{name}#categories": categories for name, categories in self.categories.items()})
+        (np.savez_compressed if compressed else np.savez)(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "ElementTable":
+        with np.load(path, allow_pickle=False) as arrays:
+            names = [str(name) for name in arrays["#columns"]]
+            return cls({name: arrays[name] for name in names},
+                       {name: arrays[f"{name}#categories"] for name in names if f"{name}#categories" in arrays})
+
+    def write_csv(self, f, chunk_rows: int = CSV_CHUNK_ROWS) -> None:
+        """Write the table as CSV to a text file, decoding chunk_rows rows at a time"""
+        writer = csv.writer(f)
+        writer.writerow(list(self.columns))
+        for start in range(0, len(self), chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            columns = []
+            for name in self.columns:
+                column = self.decoded(name, rows)
+                if column.dtype.kind == "f":
+                    column = np.where(np.isnan(column), "", column.astype(str))
+                columns.append(column.tolist())
+            writer.writerows(zip(*columns))
+
+
+class TableStore:
+    """Element tables of source models on disk as <model_key>-v<TABLE_VERSION>.npz, built once per model.
+
+    Tables are stored uncompressed, since compressing the GlobalId column
+    alone takes longer than loading the file; the few most recently used are
+    also kept in memory. Exports of a selection of rows are written next to
+    them, keyed by the model and the rows, so a download is produced once
+    however often the result page is shown. A table or export another
+    process is writing is waited for rather than written again. Least
+    recently used files are deleted once the store exceeds budget_bytes, or
+    the shared cache its global budget.
+    """
+
+    def __init__(self, directory: str = DEFAULT_TABLE_DIR, budget_bytes: int = DEFAULT_BUDGET_BYTES,
+                 max_open: int = 4):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.max_open = max_open
+        self.open_tables: OrderedDict[str, ElementTable] = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, model_key: str) -> str:
+        return os.path.join(self.directory, f"{model_key}-v{TABLE_VERSION}.npz")
+
+    def get(self, model_key: str) -> Union[ElementTable, None]:
+        path = self.path(model_key)
+        if not shared_cache.touch(path):
+            with self._lock:
+                self.open_tables.pop(path, None)
+            return None
+        with self._lock:
+            table = self.open_tables.get(path)
+        if table is None:
+            try:
+                table = ElementTable.load(path)
+            except (FileNotFoundError, zipfile.BadZipFile):
+                return None
+        with self._lock:
+            self.open_tables[path] = table
+            self.open_tables.move_to_end(path)
+            while len(self.open_tables) > self.max_open:
+                self.open_tables.popitem(last=False)
+        return table
+
+    def build(self, model_key: str, file: ifcopenshell.file, index: Union[ModelIndex, None] = None) -> str:
+        """Path of the model's table, extracting it from file on a cache miss"""
+        path = self.path(model_key)
+
+        def save(tmp_path: str) -> None:
+            with span("element_table"):
+                ElementTable.build(file, index).save(tmp_path, compressed=False)
+
+        if shared_cache.build_once(path, save):
+            self.evict(keep=path)
+        return path
+
+    def export(self, model_key: str, table: ElementTable, rows: Iterable[int], table_format: str = "CSV") -> str:
+        """Path of the given rows of the model's table in table_format, one of TABLE_FORMATS"""
+        rows = np.asarray(sorted(rows), dtype=np.int64)
+        rows_key = hashlib.sha256(rows.tobytes()).hexdigest()[:16]
+        path = os.path.join(self.directory, f"{model_key}-v{TABLE_VERSION}-{rows_key}{TABLE_FORMATS[table_format]}")
+
+        def write(tmp_path: str) -> None:
+            selected = table.take(rows)
+            with span("table_export"):
+                if table_format == "CSV":
+                    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+                        selected.write_csv(f)
+                else:
+                    selected.save(tmp_path)
+
+        if shared_cache.build_once(path, write):
+            self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str = "") -> None:
+        with self._lock:
+            shared_cache.evict_least_recently_used(self.directory, self.budget_bytes, keep=keep,
+                                                   suffixes=tuple(TABLE_FORMATS.values()))
+        shared_cache.evict(keep=keep)
@@ -0,0 +1,553 @@
+import json
+import math
+import os
+import struct
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple, Union
+
+import ifcopenshell
+import ifcopenshell.geom
+import numpy as np
+
+GLB_MAGIC = 0x46546C67
+GLB_VERSION = 2
+JSON_CHUNK = 0x4E4F534A
+BIN_CHUNK = 0x004E4942
+
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+BYTE = 5120
+SHORT = 5122
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+FLOAT = 5126
+
+# Raised whenever the GLB written for the same meshes changes, so cached previews are written again
+WRITER_VERSION = 2
+
+# Position component type per quantization level, see GlbWriter
+QUANTIZATION = {"off": None, "high": np.int16, "low": np.int8}
+# Used instead for vertices spanning the whole model, where 8 bits would leave steps of decimetres
+MERGED_QUANTIZATION = {"off": None, "high": np.int16, "low": np.int16}
+
+DEFAULT_COLOR = (0.8, 0.8, 0.8, 1.0)
+# IFC is Z-up, glTF is Y-up
+Z_UP_TO_Y_UP = [1, 0, 0, 0, 0, 0, -1, 0, 0, 1, 0, 0, 0, 0, 0, 1]
+
+Progress = Callable[[int, float, int], None]
+
+
+class GeometryError(RuntimeError):
+    pass
+
+
+class Mesh(NamedTuple):
+    """Tessellated representation of one element, in the element's local coordinates"""
+    guid: str
+    ifc_class: str
+    name: str
+    geometry_id: str
+    positions: np.ndarray  # (n, 3) float32
+    normals: np.ndarray  # (n, 3) float32
+    indices: np.ndarray  # (m, 3) uint32
+    material_ids: np.ndarray  # (m,) int32, -1 for triangles without a material
+    materials: tuple  # ((name, (r, g, b, a)), ...)
+    matrix: np.ndarray  # (4, 4) float64 placement, column vectors
+
+
+def geometry_settings() -> ifcopenshell.geom.settings:
+    # Local coordinates (the default) keep placements separate from shared representations
+    return ifcopenshell.geom.settings()
+
+
+def tessellate(
+        file: ifcopenshell.file,
+        threads: Union[int, None] = None,
+        progress: Union[Progress, None] = None
+) -> Iterator[Mesh]:
+    """Tessellate every product of file with the multi-threaded geometry iterator.
+
+    progress is called after each element with the number of elements done, the
+    iterator's estimate of the fraction complete and the triangles emitted so far.
+    """
+    iterator = ifcopenshell.geom.iterator(geometry_settings(), file, threads or os.cpu_count() or 1)
+    if not iterator.initialize():
+        return
+    done = 0
+    triangles = 0
+    while True:
+        mesh = shape_mesh(iterator.get())
+        yield mesh
+        done += 1
+        triangles += len(mesh.indices)
+        if progress:
+            progress(done, iterator.progress() / 100, triangles)
+        if not iterator.next():
+            break
+
+
+def shape_mesh(shape) -> Mesh:
+    geometry = shape.geometry
+    positions = np.asarray(geometry.verts, dtype=np.float32).reshape(-1, 3)
+    indices = np.asarray(geometry.faces, dtype=np.uint32).reshape(-1, 3)
+    normals = np.asarray(geometry.normals, dtype=np.float32).reshape(-1, 3)
+    if len(normals) != len(positions):
+        normals = vertex_normals(positions, indices)
+    material_ids = np.asarray(geometry.material_ids, dtype=np.int32)
+    if len(material_ids) != len(indices):
+        material_ids = np.full(len(indices), -1, dtype=np.int32)
+    return Mesh(
+        guid=shape.guid,
+        ifc_class=shape.type,
+        name=shape.name or "",
+        geometry_id=str(geometry.id),
+        positions=positions,
+        normals=normals,
+        indices=indices,
+        material_ids=material_ids,
+        materials=tuple((m.name, material_color(m)) for m in geometry.materials),
+        matrix=placement_matrix(shape.transformation.matrix),
+    )
+
+
+def placement_matrix(matrix) -> np.ndarray:
+    """4x4 matrix from the iterator's column-major 4x3 (0.7) or 4x4 (0.8+) placement"""
+    values = np.asarray(getattr(matrix, "data", matrix), dtype=np.float64)
+    if len(values) == 12:
+        result = np.eye(4)
+        result[:3, :] = values.reshape(4, 3).T
+        return result
+    return values.reshape(4, 4).T
+
+
+def material_color(material) -> tuple:
+    diffuse = getattr(material, "diffuse", None)
+    if diffuse is None or not getattr(material, "has_diffuse", True):
+        return DEFAULT_COLOR
+    r, g, b = (float(c) for c in getattr(diffuse, "components", diffuse))
+    transparency = getattr(material, "transparency", None)
+    alpha = 1.0 if transparency is None or math.isnan(transparency) else 1.0 - float(transparency)
+    return r, g, b, alpha
+
+
+def vertex_normals(positions: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """Area weighted vertex normals for meshes the iterator returned without normals"""
+    normals = np.zeros_like(positions)
+    if len(indices):
+        triangles = positions[indices]
+        faces = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        for corner in range(3):
+            np.add.at(normals, indices[:, corner], faces)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals / np.where(lengths == 0, 1, lengths)
+
+
+class GlbWriter:
+    """Binary glTF with one node per element and one primitive per element material.
+
+    Vertex and index data are packed with NumPy into a single binary buffer.
+    Indices are 16 bit wherever a primitive has few enough vertices. With
+    quantization "high" or "low", positions are stored as normalized 16 or 8 bit
+    integers against each mesh's bounds and normals as normalized 8 bit
+    integers (KHR_mesh_quantization); the node transform maps them back.
+    Meshes merged across elements keep 16 bit positions with "low", since
+    their bounds are those of the whole model.
+    """
+
+    def __init__(self, quantization: str = "off"):
+        if quantization not in QUANTIZATION:
+            raise ValueError(f"Unknown quantization {quantization!r}")
+        self.quantization = quantization
+        self.nodes = []
+        self.meshes = []
+        self.materials = []
+        self.material_index = {}
+        self.accessors = []
+        self.buffer_views = []
+        self.chunks = []
+        self.byte_length = 0
+        self.extensions_used = []
+        self.extras = {}
+
+    def add_material(self, name: str, color: tuple) -> int:
+        key = (name, color)
+        if key not in self.material_index:
+            material = {
+                "name": name,
+                "pbrMetallicRoughness": {"baseColorFactor": list(color), "metallicFactor": 0.0, "roughnessFactor": 1.0},
+                "doubleSided": True,
+            }
+            if color[3] < 1.0:
+                material["alphaMode"] = "BLEND"
+            self.material_index[key] = len(self.materials)
+            self.materials.append(material)
+        return self.material_index[key]
+
+    def add_buffer_view(self, data: np.ndarray, target: Union[int, None]) -> int:
+        data = np.ascontiguousarray(data)
+        padding = -self.byte_length % 4
+        if padding:
+            self.chunks.append(b"\0" * padding)
+            self.byte_length += padding
+        buffer_view = {"buffer": 0, "byteOffset": self.byte_length, "byteLength": data.nbytes}
+        if target is not None:
+            buffer_view["target"] = target
+        self.buffer_views.append(buffer_view)
+        self.chunks.append(data.tobytes())
+        self.byte_length += data.nbytes
+        return len(self.buffer_views) - 1
+
+    def add_accessor(self, data: np.ndarray, component_type: int, accessor_type: str, target: Union[int, None],
+                     bounds: bool = False) -> int:
+        accessor = {
+            "bufferView": self.add_buffer_view(data, target),
+            "componentType": component_type,
+            "count": len(data) if data.ndim > 1 else data.size,
+            "type": accessor_type,
+        }
+        if bounds:
+            accessor["min"] = data.min(axis=0).tolist()
+            accessor["max"] = data.max(axis=0).tolist()
+        self.accessors.append(accessor)
+        return len(self.accessors) - 1
+
+    def add_quantized_accessor(self, data: np.ndarray, component_type: int, bounds: bool = False) -> int:
+        """Normalized VEC3 accessor over integers padded to four components, keeping vertex strides 4-byte aligned"""
+        buffer_view = self.add_buffer_view(data, ARRAY_BUFFER)
+        self.buffer_views[buffer_view]["byteStride"] = data.strides[0]
+        accessor = {
+            "bufferView": buffer_view,
+            "componentType": component_type,
+            "normalized": True,
+            "count": len(data),
+            "type": "VEC3",
+        }
+        if bounds:
+            accessor["min"] = data[:, :3].min(axis=0).tolist()
+            accessor["max"] = data[:, :3].max(axis=0).tolist()
+        self.accessors.append(accessor)
+        return len(self.accessors) - 1
+
+    def add_vertices(self, positions: np.ndarray, normals: np.ndarray,
+                     merged: bool = False) -> tuple[dict, np.ndarray]:
+        """POSITION and NORMAL accessors, and the matrix mapping stored positions back to positions.
+
+        merged is set for vertices of several elements, see MERGED_QUANTIZATION.
+        """
+        dtype = (MERGED_QUANTIZATION if merged else QUANTIZATION)[self.quantization]
+        if dtype is None:
+            return {
+                "POSITION": self.add_accessor(positions.astype(np.float32, copy=False), FLOAT, "VEC3", ARRAY_BUFFER,
+                                              bounds=True),
+                "NORMAL": self.add_accessor(normals.astype(np.float32, copy=False), FLOAT, "VEC3", ARRAY_BUFFER),
+            }, np.eye(4)
+
+        if "KHR_mesh_quantization" not in self.extensions_used:
+            self.extensions_used.append("KHR_mesh_quantization")
+        positions = np.asarray(positions, dtype=np.float64)
+        low, high = positions.min(axis=0), positions.max(axis=0)
+        center = (low + high) / 2
+        extent = (high - low) / 2
+        extent[extent == 0] = 1
+        limit = np.iinfo(dtype).max
+        quantized = np.zeros((len(positions), 4), dtype=dtype)
+        quantized[:, :3] = np.rint((positions - center) / extent * limit)
+        # Normals are stored in the scaled space too, so the renderer's normal matrix restores them
+        scaled = normals * extent
+        lengths = np.linalg.norm(scaled, axis=1, keepdims=True)
+        quantized_normals = np.zeros((len(normals), 4), dtype=np.int8)
+        quantized_normals[:, :3] = np.rint(scaled / np.where(lengths == 0, 1, lengths) * 127)
+        dequantize = np.diag([*extent, 1.0])
+        dequantize[:3, 3] = center
+        return {
+            "POSITION": self.add_quantized_accessor(quantized, SHORT if dtype is np.int16 else BYTE, bounds=True),
+            "NORMAL": self.add_quantized_accessor(quantized_normals, BYTE),
+        }, dequantize
+
+    def add_indices(self, indices: np.ndarray, vertex_count: int) -> int:
+        # 65535 is reserved for primitive restart
+        if vertex_count < 0xFFFF:
+            return self.add_accessor(indices.reshape(-1).astype(np.uint16), UNSIGNED_SHORT, "SCALAR",
+                                     ELEMENT_ARRAY_BUFFER)
+        return self.add_accessor(indices.reshape(-1).astype(np.uint32), UNSIGNED_INT, "SCALAR", ELEMENT_ARRAY_BUFFER)
+
+    def material_groups(self, mesh: Mesh) -> Iterator[tuple[int, np.ndarray]]:
+        """Material index and triangles of each material used by mesh"""
+        for material_id in np.unique(mesh.material_ids):
+            if 0 <= material_id < len(mesh.materials):
+                material = self.add_material(*mesh.materials[material_id])
+            else:
+                material = self.add_material("Default", DEFAULT_COLOR)
+            yield material, mesh.indices[mesh.material_ids == material_id]
+
+    def add_mesh(self, mesh: Mesh) -> Union[int, None]:
+        if not len(mesh.indices):
+            return None
+        attributes, dequantize = self.add_vertices(mesh.positions, mesh.normals)
+        primitives = [
+            {
+                "attributes": attributes,
+                "indices": self.add_indices(indices, len(mesh.positions)),
+                "material": material,
+            }
+            for material, indices in self.material_groups(mesh)
+        ]
+        self.meshes.append({"name": mesh.geometry_id, "primitives": primitives})
+        node = {
+            "name": mesh.guid,
+            "mesh": len(self.meshes) - 1,
+            "extras": {"ifc_class": mesh.ifc_class, "name": mesh.name},
+        }
+        matrix = mesh.matrix @ dequantize
+        if not np.allclose(matrix, np.eye(4)):
+            node["matrix"] = matrix.T.reshape(-1).tolist()
+        self.nodes.append(node)
+        return len(self.nodes) - 1
+
+    def gltf(self) -> dict:
+        root = {"name": "IfcModel", "matrix": Z_UP_TO_Y_UP, "children": list(range(len(self.nodes)))}
+        gltf = {
+            "asset": {"version": "2.0", "generator": f"IfcOpenShell {ifcopenshell.version}"},
+            "scene": 0,
+            "scenes": [{"nodes": [len(self.nodes)]}],
+            "nodes": self.nodes + [root],
+        }
+        if self.extras:
+            gltf["asset"]["extras"] = self.extras
+        if self.extensions_used:
+            gltf["extensionsUsed"] = self.extensions_used
+        if "KHR_mesh_quantization" in self.extensions_used:
+            gltf["extensionsRequired"] = ["KHR_mesh_quantization"]
+        if self.meshes:
+            gltf.update(
+                meshes=self.meshes,
+                materials=self.materials,
+                accessors=self.accessors,
+                bufferViews=self.buffer_views,
+                buffers=[{"byteLength": self.byte_length + (-self.byte_length % 4)}],
+            )
+        return gltf
+
+    def finish(self) -> None:
+        """Emit anything held back by add_mesh, called once before writing"""
+
+    def write(self, output: Union[str, BinaryIO]) -> None:
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                self.write(f)
+            return
+        self.finish()
+        json_chunk = json.dumps(self.gltf(), separators=(",", ":")).encode("utf-8")
+        json_chunk += b" " * (-len(json_chunk) % 4)
+        bin_length = self.byte_length + (-self.byte_length % 4)
+        total = 12 + 8 + len(json_chunk) + (8 + bin_length if self.meshes else 0)
+        output.write(struct.pack("<III", GLB_MAGIC, GLB_VERSION, total))
+        output.write(struct.pack("<II", len(json_chunk), JSON_CHUNK))
+        output.write(json_chunk)
+        if self.meshes:
+            output.write(struct.pack("<II", bin_length, BIN_CHUNK))
+            for chunk in self.chunks:
+                output.write(chunk)
+            output.write(b"\0" * (bin_length - self.byte_length))
+
+
+def rigid_transform(matrix: np.ndarray) -> Union[tuple, None]:
+    """Translation, quaternion (x, y, z, w) and scale of matrix, or None if it mirrors or shears"""
+    linear = matrix[:3, :3]
+    scale = np.linalg.norm(linear, axis=0)
+    if np.any(scale == 0):
+        return None
+    rotation = linear / scale
+    if np.linalg.det(rotation) <= 0 or not np.allclose(rotation.T @ rotation, np.eye(3), atol=1e-6):
+        return None
+    w = np.sqrt(max(0.0, 1.0 + rotation.trace())) / 2
+    x = np.copysign(np.sqrt(max(0.0, 1.0 + rotation[0, 0] - rotation[1, 1] - rotation[2, 2])) / 2,
+                    rotation[2, 1] - rotation[1, 2])
+    y = np.copysign(np.sqrt(max(0.0, 1.0 - rotation[0, 0] + rotation[1, 1] - rotation[2, 2])) / 2,
+                    rotation[0, 2] - rotation[2, 0])
+    z = np.copysign(np.sqrt(max(0.0, 1.0 - rotation[0, 0] - rotation[1, 1] + rotation[2, 2])) / 2,
+                    rotation[1, 0] - rotation[0, 1])
+    quaternion = np.array([x, y, z, w])
+    return matrix[:3, 3], quaternion / np.linalg.norm(quaternion), scale
+
+
+class BatchedGlbWriter(GlbWriter):
+    """Binary glTF with repeated representations instanced and everything else merged by material.
+
+    Elements sharing a representation (same geometry id and materials) are
+    drawn with EXT_mesh_gpu_instancing, one node per representation with the
+    instance GlobalIds in its extras. The remaining elements are transformed
+    into model coordinates and merged into one primitive per material, whose
+    extras map triangle ranges back to GlobalIds. A summary of draw calls and
+    buffer bytes before and after is stored in the asset extras.
+    """
+
+    def __init__(self, quantization: str = "off", min_instances: int = 2):
+        super().__init__(quantization)
+        self.min_instances = min_instances
+        self.pending: list[Mesh] = []
+        self.origin = np.zeros(3)
+        self.finished = False
+
+    def add_mesh(self, mesh: Mesh) -> Union[int, None]:
+        if not len(mesh.indices):
+            return None
+        self.pending.append(mesh)
+        return len(self.pending) - 1
+
+    def finish(self) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        if not self.pending:
+            return
+        # Stored relative to the first element's placement to keep float32 precision for georeferenced models
+        self.origin = self.pending[0].matrix[:3, 3].copy()
+        groups: dict[tuple, list[tuple[Mesh, tuple]]] = {}
+        static = []
+        for mesh in self.pending:
+            transform = rigid_transform(mesh.matrix)
+            if transform is None:
+                static.append(mesh)
+            else:
+                groups.setdefault((mesh.geometry_id, mesh.materials), []).append((mesh, transform))
+        for members in groups.values():
+            if len(members) < self.min_instances:
+                static.extend(mesh for mesh, _ in members)
+            else:
+                self.add_instanced(members)
+        if static:
+            self.add_merged(static)
+
+        if any("extensions" in node for node in self.nodes):
+            self.extensions_used.append("EXT_mesh_gpu_instancing")
+        self.extras["batching"] = {
+            "elements": len(self.pending),
+            "instanced_elements": len(self.pending) - len(static),
+            "instance_groups": sum(1 for node in self.nodes if "extensions" in node),
+            "draw_calls_before": sum(len(np.unique(mesh.material_ids)) for mesh in self.pending),
+            "draw_calls_after": sum(len(mesh["primitives"]) for mesh in self.meshes),
+            "bytes_before": sum(mesh.positions.nbytes + mesh.normals.nbytes + mesh.indices.nbytes
+                                for mesh in self.pending),
+            "bytes_after": self.byte_length,
+        }
+        self.pending = []
+
+    def add_instanced(self, members: list[tuple[Mesh, tuple]]) -> None:
+        mesh = members[0][0]
+        attributes, dequantize = self.add_vertices(mesh.positions, mesh.normals)
+        primitives = [
+            {
+                "attributes": attributes,
+                "indices": self.add_indices(indices, len(mesh.positions)),
+                "material": material,
+            }
+            for material, indices in self.material_groups(mesh)
+        ]
+        self.meshes.append({"name": mesh.geometry_id, "primitives": primitives})
+        # Instance transforms can't be followed by a node transform, so dequantization is folded into them
+        center, extent = dequantize[:3, 3], np.diag(dequantize)[:3]
+        translations = np.array([t - self.origin + member.matrix[:3, :3] @ center for member, (t, _, _) in members],
+                                dtype=np.float32)
+        rotations = np.array([r for _, (_, r, _) in members], dtype=np.float32)
+        scales = np.array([s * extent for _, (_, _, s) in members], dtype=np.float32)
+        instancing = {
+            "TRANSLATION": self.add_accessor(translations, FLOAT, "VEC3", None),
+            "ROTATION": self.add_accessor(rotations, FLOAT, "VEC4", None),
+        }
+        if not np.allclose(scales, 1):
+            instancing["SCALE"] = self.add_accessor(scales, FLOAT, "VEC3", None)
+        self.nodes.append({
+            "name": mesh.geometry_id,
+            "mesh": len(self.meshes) - 1,
+            "translation": self.origin.tolist(),
+            "extensions": {"EXT_mesh_gpu_instancing": {"attributes": instancing}},
+            "extras": {"guids": [member.guid for member, _ in members]},
+        })
+
+    def add_merged(self, meshes: list[Mesh]) -> None:
+        batches: dict[int, dict[str, list]] = {}
+        for mesh in meshes:
+            linear = mesh.matrix[:3, :3]
+            positions = (mesh.positions @ linear.T + (mesh.matrix[:3, 3] - self.origin)).astype(np.float32)
+            normals = mesh.normals @ np.linalg.inv(linear)
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            normals = (normals / np.where(lengths == 0, 1, lengths)).astype(np.float32)
+            for material, indices in self.material_groups(mesh):
+                batch = batches.setdefault(material, {
+                    "positions": [], "normals": [], "indices": [], "ranges": [], "vertices": 0, "triangles": 0
+                })
+                # Only the vertices used by this material go into the batch
+                used, remapped = np.unique(indices, return_inverse=True)
+                batch["positions"].append(positions[used])
+                batch["normals"].append(normals[used])
+                batch["indices"].append(remapped.reshape(-1, 3).astype(np.uint32) + np.uint32(batch["vertices"]))
+                batch["ranges"].append([mesh.guid, batch["triangles"], len(indices)])
+                batch["vertices"] += len(used)
+                batch["triangles"] += len(indices)
+
+        # One mesh per material, each with its own bounds for quantization
+        for material, batch in batches.items():
+            attributes, dequantize = self.add_vertices(np.concatenate(batch["positions"]),
+                                                       np.concatenate(batch["normals"]), merged=True)
+            primitive = {
+                "attributes": attributes,
+                "indices": self.add_indices(np.concatenate(batch["indices"]), batch["vertices"]),
+                "material": material,
+                # [GlobalId, first triangle, triangle count] per element
+                "extras": {"triangle_ranges": batch["ranges"]},
+            }
+            self.meshes.append({"name": f"Batched {self.materials[material]['name']}", "primitives": [primitive]})
+            matrix = np.eye(4)
+            matrix[:3, 3] = self.origin
+            self.nodes.append({
+                "name": "Batched",
+                "mesh": len(self.meshes) - 1,
+                "matrix": (matrix @ dequantize).T.reshape(-1).tolist(),
+            })
+
+
+def read_glb_json(path: str) -> dict:
+    """The JSON chunk of a binary glTF file, without reading the binary chunk"""
+    with open(path, "rb") as f:
+        magic, _, _ = struct.unpack("<III", f.read(12))
+        length, chunk_type = struct.unpack("<II", f.read(8))
+        if magic != GLB_MAGIC or chunk_type != JSON_CHUNK:
+            raise GeometryError(f"{path} is not a binary glTF file")
+        return json.loads(f.read(length))
+
+
+def write_meshes(
+        meshes: Iterable[Mesh],
+        output: Union[str, BinaryIO],
+        batch: bool = False,
+        quantization: str = "off"
+) -> int:
+    """Write meshes as binary glTF, returning the number of elements written.
+
+    With batch, repeated representations are instanced and the rest merged by
+    material. quantization is one of QUANTIZATION, see GlbWriter.
+    """
+    writer = BatchedGlbWriter(quantization) if batch else GlbWriter(quantization)
+    count = 0
+    try:
+        for mesh in meshes:
+            if writer.add_mesh(mesh) is not None:
+                count += 1
+    except RuntimeError as e:
+        raise GeometryError(str(e)) from e
+    if not count:
+        raise GeometryError("No element geometry could be tessellated.")
+    writer.write(output)
+    return count
+
+
+def write_glb(
+        file: ifcopenshell.file,
+        output: Union[str, BinaryIO],
+        threads: Union[int, None] = None,
+        progress: Union[Progress, None] = None,
+        batch: bool = False,
+        quantization: str = "off"
+) -> int:
+    """Tessellate file in process and write it as binary glTF, returning the number of elements written"""
+    return write_meshes(tessellate(file, threads, progress), output, batch=batch, quantization=quantization)
@@ -0,0 +1,201 @@
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Iterator, Union
+
+import ifcopenshell
+import numpy as np
+
+import shared_cache
+from geometry import GeometryError, Mesh, Progress, tessellate
+from instrumentation import span
+
+DEFAULT_CACHE_DIR = os.environ.get("IFC_GEOMETRY_CACHE_DIR", shared_cache.cache_dir("geometry"))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_GEOMETRY_CACHE_BYTES", 4 * 1024 ** 3))
+ARRAYS = ("positions", "normals", "indices", "material_ids", "matrices", "vertex_offsets", "triangle_offsets")
+
+
+class Tessellation:
+    """Tessellated elements of one source model, stored as concatenated arrays.
+
+    The arrays are memory-mapped, so slicing out the meshes of a filter
+    selection only reads the pages of the selected elements.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "elements.json"), "r") as f:
+            self.elements = json.load(f)["elements"]
+        self.arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        self.rows = {element["guid"]: row for row, element in enumerate(self.elements)}
+
+    def __len__(self) -> int:
+        return len(self.elements)
+
+    def __contains__(self, guid: str) -> bool:
+        return guid in self.rows
+
+    def mesh(self, guid: str) -> Mesh:
+        row = self.rows[guid]
+        element = self.elements[row]
+        vertices = slice(*self.arrays["vertex_offsets"][row:row + 2])
+        triangles = slice(*self.arrays["triangle_offsets"][row:row + 2])
+        return Mesh(
+            guid=guid,
+            ifc_class=element["ifc_class"],
+            name=element["name"],
+            geometry_id=element["geometry_id"],
+            positions=self.arrays["positions"][vertices],
+            normals=self.arrays["normals"][vertices],
+            indices=self.arrays["indices"][triangles],
+            material_ids=self.arrays["material_ids"][triangles],
+            materials=tuple((name, tuple(color)) for name, color in element["materials"]),
+            matrix=self.arrays["matrices"][row],
+        )
+
+    def meshes(self, guids: Iterable[str]) -> Iterator[Mesh]:
+        """Meshes of the given elements that have geometry, skipping the others"""
+        for guid in guids:
+            if guid in self.rows:
+                yield self.mesh(guid)
+
+    @staticmethod
+    def save(meshes: Iterable[Mesh], directory: str) -> None:
+        elements = []
+        parts = {name: [] for name in ("positions", "normals", "indices", "material_ids", "matrices")}
+        vertex_offsets = [0]
+        triangle_offsets = [0]
+        for mesh in meshes:
+            elements.append({
+                "guid": mesh.guid,
+                "ifc_class": mesh.ifc_class,
+                "name": mesh.name,
+                "geometry_id": mesh.geometry_id,
+                "materials": [[name, list(color)] for name, color in mesh.materials],
+            })
+            parts["positions"].append(mesh.positions)
+            parts["normals"].append(mesh.normals)
+            parts["indices"].append(mesh.indices)
+            parts["material_ids"].append(mesh.material_ids)
+            parts["matrices"].append(mesh.matrix[np.newaxis])
+            vertex_offsets.append(vertex_offsets[-1] + len(mesh.positions))
+            triangle_offsets.append(triangle_offsets[-1] + len(mesh.indices))
+
+        empty = {
+            "positions": np.empty((0, 3), np.float32),
+            "normals": np.empty((0, 3), np.float32),
+            "indices": np.empty((0, 3), np.uint32),
+            "material_ids": np.empty(0, np.int32),
+            "matrices": np.empty((0, 4, 4), np.float64),
+        }
+        for name, arrays in parts.items():
+            np.save(os.path.join(directory, f"{name}.npy"), np.concatenate(arrays) if arrays else empty[name])
+        np.save(os.path.join(directory, "vertex_offsets.npy"), np.asarray(vertex_offsets, dtype=np.int64))
+        np.save(os.path.join(directory, "triangle_offsets.npy"), np.asarray(triangle_offsets, dtype=np.int64))
+        with open(os.path.join(directory, "elements.json"), "w") as f:
+            json.dump({"version": ifcopenshell.version, "elements": elements}, f)
+
+
+class GeometryCache:
+    """Per source model tessellations on disk, so each uploaded model is tessellated once.
+
+    Entries are directories named after the model's content key and the
+    IfcOpenShell version. A model another process is tessellating is waited
+    for rather than tessellated again. Least recently used entries are
+    deleted once the cache exceeds budget_bytes, or the shared cache its
+    global budget; the few most recent are also kept open.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, budget_bytes: int = DEFAULT_BUDGET_BYTES,
+                 max_open: int = 4):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.max_open = max_open
+        self.open_tessellations: OrderedDict[str, Tessellation] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, model_key: str) -> str:
+        return os.path.join(self.directory, f"{model_key}-{ifcopenshell.version}")
+
+    def get(self, model_key: str) -> Union[Tessellation, None]:
+        path = self.path(model_key)
+        with self._lock:
+            if path in self.open_tessellations and shared_cache.touch(path):
+                self.open_tessellations.move_to_end(path)
+                self.hits += 1
+                return self.open_tessellations[path]
+        if not shared_cache.touch(path):
+            return None
+        tessellation = Tessellation(path)
+        with self._lock:
+            self.hits += 1
+            self.keep_open(path, tessellation)
+        return tessellation
+
+    def tessellate(
+            self,
+            model_key: str,
+            file: ifcopenshell.file,
+            threads: Union[int, None] = None,
+            progress: Union[Progress, None] = None
+    ) -> Tessellation:
+        """Return the tessellation of file, running the geometry iterator only on a cache miss"""
+        tessellation = self.get(model_key)
+        if tessellation is not None:
+            return tessellation
+
+        path = self.path(model_key)
+
+        def save(tmp_path: str) -> None:
+            os.makedirs(tmp_path)
+            try:
+                with span("tessellate"):
+                    Tessellation.save(tessellate(file, threads, progress), tmp_path)
+            except RuntimeError as e:
+                raise GeometryError(str(e)) from e
+
+        if shared_cache.build_once(path, save):
+            self.misses += 1
+        else:
+            self.hits += 1
+        tessellation = Tessellation(path)
+        with self._lock:
+            self.keep_open(path, tessellation)
+        self.evict(keep=path)
+        return tessellation
+
+    def keep_open(self, path: str, tessellation: Tessellation) -> None:
+        self.open_tessellations[path] = tessellation
+        self.open_tessellations.move_to_end(path)
+        while len(self.open_tessellations) > self.max_open:
+            self.open_tessellations.popitem(last=False)
+
+    def evict(self, keep: str = "") -> None:
+        cutoff = time.time() - shared_cache.MIN_AGE_SECONDS
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if ".tmp" in name or name == shared_cache.LOCK_DIR or not os.path.isdir(path):
+                    continue
+                size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+                entries.append((os.stat(path).st_mtime, size, path))
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= self.budget_bytes:
+                    break
+                if path == keep or mtime > cutoff:
+                    continue
+                self.open_tessellations.pop(path, None)
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+        shared_cache.evict(keep=keep)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "open": len(self.open_tessellations)}
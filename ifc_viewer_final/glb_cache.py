@@ -0,0 +1,61 @@
+import hashlib
+import os
+import threading
+from typing import Callable, Sequence
+
+import shared_cache
+
+DEFAULT_CACHE_DIR = os.environ.get("IFC_GLB_CACHE_DIR", shared_cache.cache_dir("glb"))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_GLB_CACHE_BYTES", 2 * 1024 ** 3))
+
+
+class GlbCache:
+    """GLB files of tessellated selections, keyed by the selection, the writer version and options.
+
+    Files live in directory as <key>.glb. Hits refresh the file's mtime and the
+    least recently used files are deleted once the directory exceeds budget_bytes,
+    or the shared cache its global budget. A GLB another process is already
+    writing is waited for rather than written again.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, budget_bytes: int = DEFAULT_BUDGET_BYTES):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, selection: bytes, version: str, options: Sequence[str] = ()) -> str:
+        digest = hashlib.sha256(selection)
+        digest.update(version.encode())
+        digest.update("\0".join(options).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.glb")
+
+    def build(self, selection: bytes, version: str, options: Sequence[str], writer: Callable[[str], None]) -> str:
+        """Return the path of the GLB for selection, calling writer(path) to create it only on a cache miss.
+
+        selection identifies the meshes written, such as a model key followed
+        by the GlobalIds of its elements. version and options identify the
+        writer so upgrades and option changes miss the cache.
+        """
+        key = self.key(selection, version, options)
+        glb_path = self.path(key)
+        if not shared_cache.build_once(glb_path, writer):
+            self.hits += 1
+            return glb_path
+
+        self.misses += 1
+        self.evict(keep=glb_path)
+        return glb_path
+
+    def evict(self, keep: str = "") -> None:
+        with self._lock:
+            shared_cache.evict_least_recently_used(self.directory, self.budget_bytes, keep=keep, suffixes=(".glb",))
+        shared_cache.evict(keep=keep)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import zipfile
+from typing import BinaryIO, Callable, Iterable, NamedTuple, Union
+
+from instrumentation import span
+from shared_cache import evict_least_recently_used, touch
+
+DEFAULT_UPLOAD_DIR = os.environ.get("IFC_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "ifc_uploads"))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_UPLOAD_BYTES", 8 * 1024 ** 3))
+CHUNK_SIZE = 1024 ** 2
+SUFFIXES = (".ifc", ".ifczip")
+
+
+class Upload(NamedTuple):
+    """An uploaded model stored on disk under the SHA-256 of its bytes"""
+    key: str
+    path: str
+    filename: str
+
+
+def model_suffix(filename: str) -> str:
+    return ".ifczip" if filename.lower().endswith(".ifczip") else ".ifc"
+
+
+def extract_first_ifc(zip_path: str, output_path: str) -> None:
+    """Decompress the first .ifc member of an IFCZIP to output_path, a chunk at a time"""
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        members = [info for info in zip_ref.infolist() if info.filename.lower().endswith(".ifc")]
+        if not members:
+            raise ValueError("No IFC files found in the uploaded IFCZIP.")
+        tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with zip_ref.open(members[0], "r") as source, open(tmp_path, "wb") as target:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class UploadStore:
+    """Uploaded models streamed to disk once, keyed by content.
+
+    An upload is copied in CHUNK_SIZE pieces while it is hashed, so it never
+    exists as a second full copy in memory. The IFC text of an IFCZIP is
+    decompressed next to it on first use, as <key>.ifc, and is what the parser
+    opens. Least recently used files are deleted once the store exceeds
+    budget_bytes, except those of the keys in_use() returns, such as the
+    uploads sessions show and queued jobs will read.
+    """
+
+    def __init__(self, directory: str = DEFAULT_UPLOAD_DIR, budget_bytes: int = DEFAULT_BUDGET_BYTES,
+                 in_use: Callable[[], Iterable[str]] = tuple):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.in_use = in_use
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def ingest(self, stream: BinaryIO, filename: str) -> Upload:
+        """Copy stream from its current position to the store"""
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.tmp.upload")
+        try:
+            with span("upload"), open(tmp_path, "wb") as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            key = digest.hexdigest()
+            path = os.path.join(self.directory, key + model_suffix(filename))
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+        return Upload(key, path, filename)
+
+    def ifc_path(self, upload: Upload) -> str:
+        """Path of the upload's IFC text, decompressing an IFCZIP on first use.
+
+        Marks the upload as used, so it outlives newer uploads while a session keeps opening it.
+        """
+        touch(upload.path)
+        if not upload.path.endswith(".ifczip"):
+            return upload.path
+        path = os.path.join(self.directory, f"{upload.key}.ifc")
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            with span("unzip"):
+                extract_first_ifc(upload.path, path)
+            self.evict(keep=path)
+        return path
+
+    def get(self, key: str, filename: str) -> Union[Upload, None]:
+        path = os.path.join(self.directory, key + model_suffix(filename))
+        return Upload(key, path, filename) if os.path.exists(path) else None
+
+    def evict(self, keep: str = "") -> int:
+        in_use = {os.path.join(self.directory, key + suffix) for key in self.in_use() for suffix in SUFFIXES}
+        with self._lock:
+            return evict_least_recently_used(self.directory, self.budget_bytes, keep=keep, suffixes=SUFFIXES,
+                                             in_use=in_use)
@@ -0,0 +1,210 @@
+import contextlib
+import contextvars
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Iterator, Union
+
+try:
+    import resource
+except ImportError:  # Windows; peak resident memory then reads as 0
+    resource = None
+
+# "0" turns collection off, "tracemalloc" also traces Python allocations
+MODE = os.environ.get("IFC_INSTRUMENTATION", "1").lower()
+METRICS_DIR = os.environ.get("IFC_METRICS_DIR", tempfile.gettempdir())
+FIELDS = ("calls", "wall_seconds", "cpu_seconds", "rss_delta_bytes", "peak_rss_growth_bytes", "python_peak_bytes")
+
+_current: contextvars.ContextVar[Union["Recorder", None]] = contextvars.ContextVar("ifc_recorder", default=None)
+_null_span = contextlib.nullcontext()
+
+
+def resident_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def peak_resident_bytes() -> int:
+    """High water mark of the process' resident memory"""
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Span:
+    __slots__ = ("recorder", "name", "memory", "wall", "cpu", "rss", "peak_rss", "python_start", "python_outer_peak",
+                 "python_child_peak")
+
+    def __init__(self, recorder: "Recorder", name: str, memory: bool):
+        self.recorder = recorder
+        self.name = name
+        self.memory = memory
+
+    def __enter__(self) -> "Span":
+        if self.memory:
+            self.rss = resident_bytes()
+            self.peak_rss = peak_resident_bytes()
+            if self.recorder.trace_python:
+                # reset_peak() forgets the enclosing span's peak so far; it is handed back to it on exit
+                self.python_start, self.python_outer_peak = tracemalloc.get_traced_memory()
+                self.python_child_peak = 0
+                tracemalloc.reset_peak()
+                self.recorder.python_stack.append(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stats = self.recorder.spans.get(self.name)
+        if stats is None:
+            stats = self.recorder.spans[self.name] = dict.fromkeys(FIELDS, 0)
+        stats["calls"] += 1
+        stats["wall_seconds"] += wall
+        stats["cpu_seconds"] += cpu
+        if not self.memory:
+            return
+        stats["rss_delta_bytes"] += resident_bytes() - self.rss
+        stats["peak_rss_growth_bytes"] = max(stats["peak_rss_growth_bytes"], peak_resident_bytes() - self.peak_rss)
+        if self.recorder.trace_python:
+            self.recorder.python_stack.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], self.python_child_peak)
+            stats["python_peak_bytes"] = max(stats["python_peak_bytes"], peak - self.python_start)
+            if self.recorder.python_stack:
+                parent = self.recorder.python_stack[-1]
+                parent.python_child_peak = max(parent.python_child_peak, self.python_outer_peak, peak)
+
+
+class Recorder:
+    """Per request timings of named spans, aggregated by name in the order they were first entered.
+
+    Each span records calls, wall and CPU seconds and, unless opened with
+    memory=False, the change in resident memory, how far it raised the
+    process' peak resident memory and, with trace_python, the peak of traced
+    Python allocations above the span's start.
+    """
+
+    def __init__(self, trace_python: bool = False):
+        self.trace_python = trace_python
+        self.spans: dict[str, dict[str, float]] = {}
+        self.python_stack: list[Span] = []
+
+    @classmethod
+    def create(cls) -> Union["Recorder", None]:
+        """A recorder configured by IFC_INSTRUMENTATION, None when collection is off"""
+        if MODE in ("0", "off", "false", "no"):
+            return None
+        trace_python = MODE == "tracemalloc"
+        if trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return cls(trace_python=trace_python)
+
+    def span(self, name: str, memory: bool = True) -> Span:
+        return Span(self, name, memory)
+
+    def add(self, spans: dict[str, dict[str, float]]) -> None:
+        """Merge spans recorded elsewhere, such as by a job in a worker process"""
+        for name, stats in spans.items():
+            totals = self.spans.setdefault(name, dict.fromkeys(FIELDS, 0))
+            for field in ("calls", "wall_seconds", "cpu_seconds", "rss_delta_bytes"):
+                totals[field] += stats.get(field, 0)
+            for field in ("peak_rss_growth_bytes", "python_peak_bytes"):
+                totals[field] = max(totals[field], stats.get(field, 0))
+
+    def summary(self) -> list[dict[str, Union[str, int, float]]]:
+        """One row per span with times in seconds and memory in MiB, for display"""
+        rows = []
+        for name, stats in self.spans.items():
+            row = {
+                "Stage": name,
+                "Calls": int(stats["calls"]),
+                "Wall (s)": round(stats["wall_seconds"], 3),
+                "CPU (s)": round(stats["cpu_seconds"], 3),
+                "RSS Change (MiB)": round(stats["rss_delta_bytes"] / 1024 ** 2, 1),
+                "Peak RSS Growth (MiB)": round(stats["peak_rss_growth_bytes"] / 1024 ** 2, 1),
+            }
+            if self.trace_python:
+                row["Python Peak (MiB)"] = round(stats["python_peak_bytes"] / 1024 ** 2, 1)
+            rows.append(row)
+        return rows
+
+
+def span(name: str, memory: bool = True) -> contextlib.AbstractContextManager:
+    """Time a stage into the current recorder; a shared no-op when nothing is recording"""
+    recorder = _current.get()
+    if recorder is None:
+        return _null_span
+    return Span(recorder, name, memory)
+
+
+@contextlib.contextmanager
+def recording(recorder: Union[Recorder, None]) -> Iterator[Union[Recorder, None]]:
+    """Make recorder current for spans opened in this block, then add what they recorded to the metrics file"""
+    if recorder is None:
+        yield None
+        return
+    before = {name: dict(stats) for name, stats in recorder.spans.items()}
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
+        metrics.add(recorder.spans, before)
+
+
+class Metrics:
+    """Process wide totals of every recorded span, exported in the Prometheus text format.
+
+    The file is meant for node_exporter's textfile collector and is named
+    after the process id, so several app processes can share IFC_METRICS_DIR.
+    """
+
+    def __init__(self, directory: str = METRICS_DIR):
+        self.path = os.path.join(directory, f"ifc_metrics_{os.getpid()}.prom")
+        self.totals: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, spans: dict[str, dict[str, float]], before: dict[str, dict[str, float]]) -> None:
+        with self._lock:
+            for name, stats in spans.items():
+                previous = before.get(name, {})
+                totals = self.totals.setdefault(name, dict.fromkeys(FIELDS, 0))
+                for field in ("calls", "wall_seconds", "cpu_seconds"):
+                    totals[field] += stats[field] - previous.get(field, 0)
+                for field in ("peak_rss_growth_bytes", "python_peak_bytes"):
+                    totals[field] = max(totals[field], stats[field])
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def write(self) -> None:
+        lines = []
+        for metric, field, kind, help_text in (
+                ("ifc_span_calls_total", "calls", "counter", "Number of times each stage ran."),
+                ("ifc_span_seconds_total", "wall_seconds", "counter", "Wall time spent in each stage."),
+                ("ifc_span_cpu_seconds_total", "cpu_seconds", "counter", "CPU time spent in each stage."),
+                ("ifc_span_peak_rss_growth_bytes", "peak_rss_growth_bytes", "gauge",
+                 "Largest rise of the process' peak resident memory during one run of each stage."),
+                ("ifc_span_python_peak_bytes", "python_peak_bytes", "gauge",
+                 "Largest peak of traced Python allocations during one run of each stage."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, totals in self.totals.items():
+                lines.append(f'{metric}{{span="{name}"}} {totals[field]}')
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+metrics = Metrics()
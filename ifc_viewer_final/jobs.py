@@ -0,0 +1,416 @@
+import contextlib
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Union
+
+import ifcopenshell
+import numpy as np
+
+from element_table import TableStore
+from geometry_cache import GeometryCache
+from instrumentation import Recorder, recording
+from lod import storey_chunks
+from model_cache import open_model
+from model_index import ModelIndex
+from output_store import OutputStore
+from patcher import Patcher
+from shared_cache import locked, remove_stale_locks
+
+DEFAULT_JOB_DIR = os.environ.get("IFC_JOB_DIR", os.path.join(tempfile.gettempdir(), "ifc_jobs"))
+DEFAULT_WORKERS = int(os.environ.get("IFC_JOB_WORKERS", max(1, min(2, os.cpu_count() or 1))))
+DEFAULT_TTL_SECONDS = int(os.environ.get("IFC_JOB_TTL_SECONDS", 24 * 3600))
+INCREMENTAL_SESSIONS = int(os.environ.get("IFC_INCREMENTAL_SESSIONS", 4))
+ACTIVE_STATES = ("queued", "running")
+JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+JOB_KEY = re.compile(r"^[0-9a-f]{64}$")
+# Subscribers refresh themselves while they show a job; one silent for longer has left, e.g. closed its tab
+SUBSCRIBER_TIMEOUT_SECONDS = 10
+# Identifies the app process that submitted a job, so other processes sharing the job directory leave it alone
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+logger = logging.getLogger("IFCLogger")
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function once the job has been asked to stop"""
+
+
+def write_json(path: str, data: dict) -> None:
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+class JobContext:
+    """Handed to a job function in the worker to report progress and notice cancellation"""
+
+    def __init__(self, directory: str, interval: float = 0.25):
+        self.directory = directory
+        self.interval = interval
+        self.progress: dict = {}
+        self._reported = 0.0
+
+    def cancelled(self) -> bool:
+        return os.path.exists(os.path.join(self.directory, "cancel"))
+
+    def report(self, **progress) -> None:
+        """Record progress, writing it out at most every interval; raises JobCancelled when cancelled"""
+        self.progress.update(progress)
+        now = time.monotonic()
+        if now - self._reported < self.interval:
+            return
+        self._reported = now
+        self.flush()
+        if self.cancelled():
+            raise JobCancelled()
+
+    def flush(self) -> None:
+        write_json(os.path.join(self.directory, "progress.json"), self.progress)
+
+
+def owner_alive(owner: str) -> bool:
+    """Whether the app process that submitted a job may still be running"""
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        # Written on another machine, such as a job directory copied over; its processes cannot be checked from here
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+
+def run_job(directory: str, function: Callable, args: tuple) -> None:
+    """Runs in the worker process; the outcome is written to the job's status.json"""
+    status_path = os.path.join(directory, "status.json")
+    status = read_json(status_path)
+    context = JobContext(directory)
+    if context.cancelled():
+        status.update(state="cancelled", finished=time.time())
+        write_json(status_path, status)
+        return
+    status.update(state="running", started=time.time(), pid=os.getpid())
+    write_json(status_path, status)
+    try:
+        status["result"] = function(context, *args)
+        status["state"] = "done"
+    except JobCancelled:
+        status["state"] = "cancelled"
+    except MemoryError:
+        status.update(state="failed", error="MemoryError: the job ran out of memory")
+    except Exception as e:
+        logger.exception("Job %s failed", os.path.basename(directory))
+        status.update(state="failed", error=f"{type(e).__name__}: {e}")
+    context.flush()
+    status["finished"] = time.time()
+    write_json(status_path, status)
+
+
+class JobRunner:
+    """Runs jobs in a bounded pool of worker processes shared by every session of the app.
+
+    Each worker process has its own queue. Jobs submitted with the same pin
+    always run in the same worker, so state a job leaves there, such as a
+    parsed model, is found by the next one; other jobs go to the worker with
+    the fewest jobs queued.
+
+    Each job has a directory holding its status, progress, cancel flag and
+    output files, so a job outlives the rerun and the browser tab that started
+    it and can be picked up again by its id. Several app processes on one
+    host can share the directory, which has to be on a local filesystem: a
+    job submitted under a key that is already queued, running or done, by
+    any of them, is not run again. Every session waiting for a job is
+    recorded as a subscriber of it, and the job only stops once all of them
+    have cancelled or left. Finished jobs are deleted after ttl_seconds.
+    """
+
+    def __init__(self, directory: str = DEFAULT_JOB_DIR, max_workers: int = DEFAULT_WORKERS,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        self.futures: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executors = [self._new_executor() for _ in range(max_workers)]
+        self._queued = [0] * max_workers
+        os.makedirs(directory, exist_ok=True)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # Forking the threaded Streamlit server is unsafe, so workers are spawned
+        return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+    def worker(self, pin: Union[str, None] = None) -> int:
+        """The worker the next job pinned to pin, or the next unpinned one, runs in; call with the lock held"""
+        if pin is None:
+            return min(range(self.max_workers), key=self._queued.__getitem__)
+        return int(hashlib.sha256(pin.encode("utf-8")).hexdigest(), 16) % self.max_workers
+
+    def path(self, job_id: str, *names: str) -> str:
+        if not JOB_ID.match(job_id):
+            raise ValueError(f"Invalid job id: {job_id!r}")
+        return os.path.join(self.directory, job_id, *names)
+
+    def submit(self, kind: str, function: Callable, *args, params: Union[dict, None] = None,
+               key: Union[str, None] = None, reuse: Union[Callable[[dict], bool], None] = None,
+               subscriber: Union[str, None] = None, pin: Union[str, None] = None) -> str:
+        """Queue function(context, *args) and return the job id; function must be importable by the workers.
+
+        key is the SHA-256 of everything the job's result depends on. If a
+        job with the same key is queued or running and not being cancelled,
+        or done and reuse accepts its status, its id is returned instead of
+        starting another. subscriber, such as a session id, is added to the
+        subscribers of the job either way. A job started here runs in the
+        worker of pin, if given.
+        """
+        self.cleanup()
+        if key is None:
+            return self._submit(kind, function, args, params, subscriber, pin)
+        if not JOB_KEY.match(key):
+            raise ValueError(f"Invalid job key: {key!r}")
+        keys = os.path.join(self.directory, "keys")
+        os.makedirs(keys, exist_ok=True)
+        with locked(keys, f"{key}.json"):
+            status = self.status(read_json(os.path.join(keys, f"{key}.json")).get("id"))
+            if status is not None and (status["state"] in ACTIVE_STATES and self.subscribe(status["id"], subscriber)
+                                       or status["state"] == "done" and (reuse is None or reuse(status))):
+                return status["id"]
+            job_id = self._submit(kind, function, args, params, subscriber, pin)
+            write_json(os.path.join(keys, f"{key}.json"), {"id": job_id})
+            return job_id
+
+    def _submit(self, kind: str, function: Callable, args: tuple, params: Union[dict, None],
+                subscriber: Union[str, None] = None, pin: Union[str, None] = None) -> str:
+        job_id = uuid.uuid4().hex
+        directory = self.path(job_id)
+        os.makedirs(directory)
+        self.subscribe(job_id, subscriber)
+        write_json(self.path(job_id, "status.json"), {"id": job_id, "kind": kind, "params": params or {},
+                                                      "state": "queued", "created": time.time(), "owner": OWNER})
+        with self._lock:
+            worker = self.worker(pin)
+            try:
+                future = self._executors[worker].submit(run_job, directory, function, args)
+            except BrokenProcessPool:
+                # The worker died, e.g. killed for using too much memory; start a fresh one in its place
+                self._executors[worker] = self._new_executor()
+                future = self._executors[worker].submit(run_job, directory, function, args)
+            self._queued[worker] += 1
+            self.futures[job_id] = future
+        future.add_done_callback(lambda f: self._finished(job_id, f, worker))
+        return job_id
+
+    def _finished(self, job_id: str, future: Future, worker: int) -> None:
+        with self._lock:
+            self.futures.pop(job_id, None)
+            self._queued[worker] -= 1
+        if future.cancelled():
+            self._mark(job_id, "cancelled")
+        elif future.exception() is not None:
+            self._mark(job_id, "failed", f"{type(future.exception()).__name__}: {future.exception()}")
+
+    def _mark(self, job_id: str, state: str, error: Union[str, None] = None) -> None:
+        """Record the end of a job that did not get to record it itself"""
+        status_path = self.path(job_id, "status.json")
+        status = read_json(status_path)
+        if status and status.get("state") in ACTIVE_STATES:
+            status.update(state=state, error=error, finished=time.time())
+            write_json(status_path, status)
+
+    def status(self, job_id: str) -> Union[dict, None]:
+        """The job's status with its latest progress, or None for unknown or expired jobs"""
+        if not JOB_ID.match(job_id or ""):
+            return None
+        status = read_json(self.path(job_id, "status.json"))
+        if not status:
+            return None
+        with self._lock:
+            orphaned = job_id not in self.futures
+        owner = status.get("owner", OWNER)
+        if owner != OWNER:
+            orphaned = not owner_alive(owner)
+        if status["state"] in ACTIVE_STATES and orphaned:
+            # Started by an earlier run of the app whose worker pool is gone
+            self._mark(job_id, "failed", "The job was interrupted by a restart of the app.")
+            status = read_json(self.path(job_id, "status.json"))
+        status["progress"] = read_json(self.path(job_id, "progress.json"))
+        return status
+
+    def active_params(self, name: str) -> set:
+        """Values of the parameter name of the queued and running jobs of every process sharing the directory"""
+        values = set()
+        for job_id in os.listdir(self.directory):
+            status = self.status(job_id)
+            if status is not None and status["state"] in ACTIVE_STATES and name in status["params"]:
+                values.add(status["params"][name])
+        return values
+
+    def subscriber_path(self, job_id: str, subscriber: str) -> str:
+        # Hashed, since the name comes from outside and is only compared
+        return self.path(job_id, "subscribers", hashlib.sha256(subscriber.encode("utf-8")).hexdigest()[:32])
+
+    def subscribe(self, job_id: str, subscriber: Union[str, None]) -> bool:
+        """Add subscriber to the job's subscribers or refresh it, unless the job is being cancelled.
+
+        Returns False if it is, or the job no longer exists.
+        """
+        if not os.path.isdir(self.path(job_id)):
+            return False
+        with locked(self.path(job_id), "subscribers"):
+            if os.path.exists(self.path(job_id, "cancel")):
+                return False
+            if subscriber is not None:
+                os.makedirs(self.path(job_id, "subscribers"), exist_ok=True)
+                open(self.subscriber_path(job_id, subscriber), "w").close()
+            return True
+
+    def cancel(self, job_id: str, subscriber: Union[str, None] = None) -> bool:
+        """Stop a queued or running job, returning whether it was asked to stop.
+
+        With subscriber, only that subscriber is removed, and the job is
+        stopped only if no other subscriber refreshed itself within
+        SUBSCRIBER_TIMEOUT_SECONDS.
+        """
+        status = self.status(job_id)
+        if status is None or status["state"] not in ACTIVE_STATES:
+            return False
+        with locked(self.path(job_id), "subscribers"):
+            if subscriber is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.subscriber_path(job_id, subscriber))
+                subscribers = self.path(job_id, "subscribers")
+                cutoff = time.time() - SUBSCRIBER_TIMEOUT_SECONDS
+                for name in os.listdir(subscribers) if os.path.isdir(subscribers) else ():
+                    with contextlib.suppress(FileNotFoundError):
+                        if os.path.getmtime(os.path.join(subscribers, name)) > cutoff:
+                            return False
+            open(self.path(job_id, "cancel"), "w").close()
+        with self._lock:
+            future = self.futures.get(job_id)
+        if future is not None:
+            # Only succeeds while queued; a running job sees the cancel file at its next progress report
+            future.cancel()
+        return True
+
+    def cleanup(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            active = set(self.futures)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if JOB_ID.match(name) and name not in active and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        keys = os.path.join(self.directory, "keys")
+        for name in os.listdir(keys) if os.path.isdir(keys) else ():
+            path = os.path.join(keys, name)
+            if name.endswith(".json") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        if os.path.isdir(keys):
+            remove_stale_locks(keys)
+
+    def shutdown(self) -> None:
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# The last model a worker parsed, so consecutive filters of one upload skip the parse. The app pins the filter
+# jobs of a model to one worker, so they all find it here, along with the patchers of its sessions
+_models: dict[str, ifcopenshell.file] = {}
+# The patchers of the sessions that last filtered that model here, least recently used first
+_patchers: OrderedDict[str, Patcher] = OrderedDict()
+
+
+def filter_model(context: JobContext, model_path: str, model_key: str, spec: dict, geometry_threads: int,
+                 session_id: str = "") -> dict:
+    """Filter job: patch the model, write the result to the OutputStore and tessellate the source model.
+
+    The element table of the source model is extracted into the TableStore
+    once per model, and the rows of the selected elements are written to the
+    job's rows.npy, so the result page can show them without the model.
+
+    When this worker filtered the same model for session_id before, the
+    previous output is updated with only the difference between the two
+    filters. The source is tessellated into the shared GeometryCache, from
+    which the app builds the preview; the storey chunks of the filtered model
+    are written to the job's chunks.json.
+    """
+    recorder = Recorder.create()
+    with recording(recorder):
+        context.report(stage="parsing")
+        file = _models.get(model_key)
+        if file is None:
+            _models.clear()
+            _patchers.clear()
+            file = _models[model_key] = open_model(model_path)[0]
+            ModelIndex.for_file(file, model_key)
+
+        context.report(stage="filtering")
+        progress = lambda copied, total: context.report(copied=copied, to_copy=total)
+        # Taken out while it runs, since a cancelled refilter leaves its output half updated
+        patcher = _patchers.pop(session_id, None) if session_id else None
+        if patcher is not None:
+            patcher.progress = progress
+            patcher.refilter(spec["stories"], spec["keywords"], spec["ifc_product"], spec["filter_option"],
+                             spec["keyword_mode"], spec.get("query"))
+        else:
+            patcher = Patcher(
+                file=file,
+                logger=logger,
+                stories=spec["stories"],
+                keywords=spec["keywords"],
+                ifc_product=spec["ifc_product"],
+                filter_option=spec["filter_option"],
+                keyword_mode=spec["keyword_mode"],
+                bulk_copy=True,
+                progress=progress,
+                query=spec.get("query")
+            )
+            patcher.patch()
+        if session_id:
+            _patchers[session_id] = patcher
+            while len(_patchers) > INCREMENTAL_SESSIONS:
+                _patchers.popitem(last=False)
+        products = len(patcher.file.by_type("IfcProduct"))
+        context.report(stage="tabulating")
+        index = ModelIndex.for_file(file)
+        TableStore().build(model_key, file, index)
+        rows = np.fromiter(sorted(index.positions[element_id] for element_id in patcher.selection), dtype=np.int64)
+        np.save(os.path.join(context.directory, "rows.npy"), rows)
+        artifact = OutputStore().write(patcher.file)
+        chunks = [chunk._asdict() for chunk in storey_chunks(patcher.file)]
+        write_json(os.path.join(context.directory, "chunks.json"), {"chunks": chunks})
+
+        if products:
+            context.report(stage="tessellating")
+            GeometryCache().tessellate(
+                model_key, file, threads=geometry_threads,
+                progress=lambda done, fraction, triangles: context.report(
+                    tessellated=done, fraction=fraction, triangles=triangles
+                )
+            )
+    context.progress["stage"] = "done"
+    return {"products": products, "artifact": artifact._asdict(), "spans": recorder.spans if recorder else {}}
@@ -0,0 +1,97 @@
+import bisect
+import re
+from typing import Iterable, Sequence, Union
+
+MODES = ("substring", "word", "prefix")
+NEGATION_PREFIX = "!"
+
+
+def _trie_pattern(keywords: Iterable[str]) -> str:
+    """Regex alternation of the keywords, factored by common prefix so that the
+    regex engine does not try every keyword at every position"""
+    trie: dict = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        is_end = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        group = "(?:" + "|".join(branches) + ")"
+        return group + "?" if is_end else group
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """Keyword list compiled once into a single include and a single exclude regex.
+
+    Matching ignores case. Keywords prefixed with ``!`` exclude matching names.
+    mode is one of "substring" (keyword anywhere in the name), "word" (whole
+    words only) or "prefix" (start of a word).
+    """
+
+    def __init__(self, keywords: Iterable[str], mode: str = "substring"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown keyword mode {mode!r}, expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.keywords: list[str] = []
+        self.excluded: list[str] = []
+        for keyword in keywords:
+            keyword = keyword.strip()
+            if keyword.startswith(NEGATION_PREFIX):
+                keyword = keyword[len(NEGATION_PREFIX):].strip()
+                target = self.excluded
+            else:
+                target = self.keywords
+            if keyword and "\n" not in keyword:
+                target.append(keyword.lower())
+        self.include = self._compile(self.keywords)
+        self.exclude = self._compile(self.excluded)
+
+    def _compile(self, keywords: list[str]) -> Union[re.Pattern, None]:
+        if not keywords:
+            return None
+        pattern = f"(?:{_trie_pattern(set(keywords))})"
+        if self.mode in ("word", "prefix"):
+            pattern = r"(?<!\w)" + pattern
+        if self.mode == "word":
+            pattern += r"(?!\w)"
+        return re.compile(pattern, re.IGNORECASE)
+
+    def __bool__(self) -> bool:
+        return bool(self.keywords or self.excluded)
+
+    def matches(self, text: Union[str, None]) -> bool:
+        text = text or ""
+        if self.exclude is not None and self.exclude.search(text):
+            return False
+        return self.include is None or self.include.search(text) is not None
+
+    def filter(self, texts: Sequence[str]) -> set[int]:
+        """Positions of the texts that match, scanning all of them in one regex pass"""
+        if not self:
+            return set()
+        matched = set(range(len(texts))) if self.include is None else self._search_lines(self.include, texts)
+        if self.exclude is not None:
+            matched -= self._search_lines(self.exclude, texts)
+        return matched
+
+    @staticmethod
+    def _search_lines(pattern: re.Pattern, texts: Sequence[str]) -> set[int]:
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + 1
+        blob = "\n".join(texts)
+        lines = set()
+        for match in pattern.finditer(blob):
+            lines.add(bisect.bisect_right(starts, match.start()) - 1)
+        return lines
@@ -0,0 +1,130 @@
+from typing import Iterable, NamedTuple, Union
+
+import ifcopenshell
+import numpy as np
+
+from geometry import Mesh, vertex_normals
+
+# Coarse chunks snap vertices to a grid with this many cells across the chunk's largest dimension
+COARSE_CELLS = 64
+UNCONTAINED = "Other"
+
+
+class Chunk(NamedTuple):
+    """Elements shown together in the progressive preview, usually one storey"""
+    name: str
+    elevation: Union[float, None]
+    guids: list[str]
+
+
+def storey_chunks(file: ifcopenshell.file) -> list[Chunk]:
+    """Products of file grouped by the storey containing them or their decomposition parent, bottom storey first.
+
+    Products outside every storey, such as site elements, form a last chunk.
+    """
+    chunks = []
+    assigned = set()
+    storeys = sorted(file.by_type("IfcBuildingStorey"), key=lambda s: (s.Elevation is None, s.Elevation or 0.0))
+    for storey in storeys:
+        guids = []
+        stack = [storey]
+        while stack:
+            element = stack.pop()
+            for rel in getattr(element, "ContainsElements", []):
+                stack.extend(rel.RelatedElements)
+            for rel in getattr(element, "IsDecomposedBy", []):
+                stack.extend(rel.RelatedObjects)
+            if element.is_a("IfcProduct") and element.GlobalId not in assigned:
+                assigned.add(element.GlobalId)
+                guids.append(element.GlobalId)
+        chunks.append(Chunk(storey.Name or storey.GlobalId, float(storey.Elevation or 0.0), guids))
+    remaining = [product.GlobalId for product in file.by_type("IfcProduct") if product.GlobalId not in assigned]
+    if remaining:
+        chunks.append(Chunk(UNCONTAINED, None, remaining))
+    return [chunk for chunk in chunks if chunk.guids]
+
+
+def world_bounds(meshes: Iterable[Mesh]) -> Union[tuple[np.ndarray, np.ndarray], None]:
+    low, high = np.full(3, np.inf), np.full(3, -np.inf)
+    for mesh in meshes:
+        if not len(mesh.positions):
+            continue
+        positions = mesh.positions @ mesh.matrix[:3, :3].T + mesh.matrix[:3, 3]
+        low = np.minimum(low, positions.min(axis=0))
+        high = np.maximum(high, positions.max(axis=0))
+    return (low, high) if np.all(low <= high) else None
+
+
+BOX_CORNERS = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float32)
+BOX_TRIANGLES = np.array([
+    [0, 2, 3], [0, 3, 1], [4, 5, 7], [4, 7, 6], [0, 1, 5], [0, 5, 4],
+    [2, 6, 7], [2, 7, 3], [0, 4, 6], [0, 6, 2], [1, 3, 7], [1, 7, 5],
+], dtype=np.uint32)
+
+
+def bounding_box(mesh: Mesh) -> Mesh:
+    """The mesh's local bounding box, in its most used material"""
+    low = mesh.positions.min(axis=0)
+    high = mesh.positions.max(axis=0)
+    positions = (low + BOX_CORNERS * (high - low)).astype(np.float32)
+    material_ids, counts = np.unique(mesh.material_ids, return_counts=True)
+    return mesh._replace(
+        geometry_id=f"{mesh.geometry_id}-box",
+        positions=positions,
+        normals=vertex_normals(positions, BOX_TRIANGLES),
+        indices=BOX_TRIANGLES,
+        material_ids=np.full(len(BOX_TRIANGLES), material_ids[counts.argmax()], dtype=np.int32),
+    )
+
+
+def decimate(mesh: Mesh, cell_size: float) -> Union[Mesh, None]:
+    """Vertex clustering: snap vertices to a grid of cell_size, merging each cell into its mean vertex.
+
+    Triangles that collapse are dropped. Meshes that are already no more
+    detailed than a box are kept as they are, and meshes that collapse
+    entirely or that clustering leaves with as many triangles as before are
+    replaced by their bounding box. None is returned for meshes without
+    triangles.
+    """
+    if not len(mesh.indices):
+        return None
+    if len(mesh.indices) <= len(BOX_TRIANGLES):
+        return mesh
+    cells = np.floor(np.asarray(mesh.positions, dtype=np.float64) / cell_size).astype(np.int64)
+    _, cluster = np.unique(cells, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    counts = np.bincount(cluster)
+    positions = np.stack(
+        [np.bincount(cluster, weights=mesh.positions[:, axis]) / counts for axis in range(3)], axis=1
+    ).astype(np.float32)
+
+    triangles = cluster[mesh.indices]
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (
+            triangles[:, 0] != triangles[:, 2])
+    triangles = triangles[keep]
+    material_ids = mesh.material_ids[keep]
+    # Several fine triangles often collapse onto the same coarse one
+    _, unique = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    unique.sort()
+    if len(unique) == 0 or len(unique) >= len(mesh.indices):
+        return bounding_box(mesh)
+    triangles = triangles[unique].astype(np.uint32)
+
+    return mesh._replace(
+        geometry_id=f"{mesh.geometry_id}-lod",
+        positions=positions,
+        normals=vertex_normals(positions, triangles),
+        indices=triangles,
+        material_ids=material_ids[unique],
+    )
+
+
+def coarse_meshes(meshes: list[Mesh], cells: int = COARSE_CELLS) -> list[Mesh]:
+    """Decimated copies of meshes, with the grid sized to their combined bounds"""
+    bounds = world_bounds(meshes)
+    if bounds is None:
+        return []
+    cell_size = float(np.max(bounds[1] - bounds[0])) / cells
+    if cell_size <= 0:
+        return list(meshes)
+    return [coarse for coarse in (decimate(mesh, cell_size) for mesh in meshes) if coarse is not None]
@@ -1,189 +1,225 @@
+import hashlib
 import ifcopenshell
-import ifcopenshell.api
-from typing import Union
 import streamlit as st
-import tempfile
 import logging
 import os
 import zipfile
-import base64
-import subprocess
-import uuid
+import json
 import textwrap
-import requests
-from pathlib import Path
+import time
+import uuid
+
+import numpy as np
+
+import shared_cache
+from asset_server import AssetServer
+from element_table import TABLE_FORMATS, TableStore
+from geometry import WRITER_VERSION, GeometryError, read_glb_json, write_meshes
+from geometry_cache import GeometryCache, Tessellation
+from glb_cache import GlbCache
+from ingest import UploadStore
+from instrumentation import Recorder, metrics, recording, span
+from jobs import ACTIVE_STATES, JobRunner, filter_model, read_json
+from lod import COARSE_CELLS, Chunk, coarse_meshes
+from model_cache import ModelCache
+from model_index import ModelIndex
+from output_store import DEFAULT_COMPRESSLEVEL, OUTPUT_FORMATS, OutputStore
+from patcher import Patcher
+from query import Query, QueryError
+from session_store import SessionStore
+from splitter import SPLIT_OPTIONS, Splitter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("IFCLogger")
 
 @st.cache_resource
-def install_ifcconvert():
-    ifcconvert_path = Path("/tmp/IfcConvert")
-    
-    if not ifcconvert_path.exists():
-        st.write("🔄 Cloning IfcOpenShell repository...")
-        subprocess.run([
-            "git", "clone", "https://github.com/IfcOpenShell/IfcOpenShell.git", "/tmp/IfcOpenShell"
-        ], check=True)
-        
-        st.write("🔄 Building ifcconvert from source...")
-        build_dir = "/tmp/IfcOpenShell/build"
-        os.makedirs(build_dir, exist_ok=True)
-        
-        subprocess.run([
-            "cmake", ".."
-        ], cwd=build_dir, check=True)
-        
-        subprocess.run([
-            "make", "-j4"
-        ], cwd=build_dir, check=True)
-        
-        # Assume the binary is located at /tmp/IfcOpenShell/build/bin/IfcConvert
-        built_binary = Path(build_dir) / "bin" / "IfcConvert"
-        if built_binary.exists():
-            built_binary.chmod(0o755)
-            ifcconvert_path.symlink_to(built_binary)
-            st.write("✅ ifcconvert built and ready to use.")
-        else:
-            st.error("🚨 ifcconvert binary not found after build.")
-            st.stop()
-    
-    return str(ifcconvert_path)
-
-class Patcher:
-    def __init__(
-            self,
-            file: ifcopenshell.file,
-            logger: logging.Logger,
-            stories: list[str],
-            keywords: list[str],
-            ifc_product: Union[str, None],
-            filter_option: str
-    ):
-        self.file = file
-        self.logger = logger
-        self.stories = stories
-        self.keywords = keywords
-        self.ifc_product = ifc_product
-        self.filter_option = filter_option
-
-    def patch(self):
-        self.contained_ins: dict[str, set[ifcopenshell.entity_instance]] = {}
-        self.aggregates: dict[str, set[ifcopenshell.entity_instance]] = {}
-        self.new = ifcopenshell.file(schema=self.file.schema)
-        self.owner_history = None
-        self.reuse_identities: dict[int, ifcopenshell.entity_instance] = {}
-
-        for owner_history in self.file.by_type("IfcOwnerHistory"):
-            self.owner_history = self.new.add(owner_history)
-            break
-
-        self.add_element(self.file.by_type("IfcProject")[0])
-
-        for element in self.filter_elements():
-            self.add_element(element)
-
-        self.create_spatial_tree()
-
-        self.file = self.new
-
-    def filter_elements(self):
-        elements = self.file.by_type("IfcProduct")
-        filtered_elements = []
-        for element in elements:
-            if self.filter_option == "IFC Product and Keywords":
-                if element.is_a(self.ifc_product) and (
-                        not self.keywords
-                        or any(keyword.lower() in (element.Name or "").lower() for keyword in self.keywords)
-                ):
-                    if any(
-                            story in [rel.RelatingStructure.Name for rel in
-                                      getattr(element, "ContainedInStructure", [])]
-                            for story in self.stories
-                    ):
-                        filtered_elements.append(element)
-            elif self.filter_option == "Keywords Only":
-                if any(keyword.lower() in (element.Name or "").lower() for keyword in self.keywords):
-                    if any(
-                            story in [rel.RelatingStructure.Name for rel in
-                                      getattr(element, "ContainedInStructure", [])]
-                            for story in self.stories
-                    ):
-                        filtered_elements.append(element)
-        return filtered_elements
-
-    def add_element(self, element: ifcopenshell.entity_instance) -> None:
-        new_element = self.append_asset(element)
-        if not new_element:
-            return
-        self.add_spatial_structures(element, new_element)
-        self.add_decomposition_parents(element, new_element)
-
-    def append_asset(self, element: ifcopenshell.entity_instance) -> Union[ifcopenshell.entity_instance, None]:
-        try:
-            return self.new.by_guid(element.GlobalId)
-        except:
-            pass
-        if element.is_a("IfcProject"):
-            return self.new.add(element)
-        return ifcopenshell.api.run(
-            "project.append_asset",
-            self.new,
-            library=self.file,
-            element=element,
-            reuse_identities=self.reuse_identities
-        )
+def get_model_cache():
+    return ModelCache()
 
-    def add_spatial_structures(self, element: ifcopenshell.entity_instance,
-                               new_element: ifcopenshell.entity_instance) -> None:
-        for rel in getattr(element, "ContainedInStructure", []):
-            spatial_element = rel.RelatingStructure
-            new_spatial_element = self.append_asset(spatial_element)
-            self.contained_ins.setdefault(spatial_element.GlobalId, set()).add(new_element)
-            self.add_decomposition_parents(spatial_element, new_spatial_element)
-
-    def add_decomposition_parents(self, element: ifcopenshell.entity_instance,
-                                  new_element: ifcopenshell.entity_instance) -> None:
-        for rel in getattr(element, "Decomposes", []):
-            parent = rel.RelatingObject
-            new_parent = self.append_asset(parent)
-            self.aggregates.setdefault(parent.GlobalId, set()).add(new_element)
-            self.add_decomposition_parents(parent, new_parent)
-            self.add_spatial_structures(parent, new_parent)
-
-    def create_spatial_tree(self) -> None:
-        for relating_structure_guid, related_elements in self.contained_ins.items():
-            self.new.createIfcRelContainedInSpatialStructure(
-                ifcopenshell.guid.new(),
-                self.owner_history,
-                None,
-                None,
-                list(related_elements),
-                self.new.by_guid(relating_structure_guid),
+@st.cache_resource
+def get_glb_cache():
+    return GlbCache()
+
+@st.cache_resource
+def get_geometry_cache():
+    return GeometryCache()
+
+@st.cache_resource
+def get_asset_server():
+    return AssetServer()
+
+@st.cache_resource
+def get_upload_store():
+    return UploadStore(in_use=uploads_in_use)
+
+@st.cache_resource
+def get_output_store():
+    return OutputStore()
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+@st.cache_resource
+def get_session_store():
+    return SessionStore()
+
+@st.cache_resource
+def get_table_store():
+    return TableStore()
+
+# Filter settings stored with each job, so a reloaded page can show the job it belongs to
+JOB_PARAMS = ("uploaded_file_name", "output_filename", "stories", "keywords", "ifc_product", "filter_option",
+              "keyword_mode", "query", "model_key", "model_path")
+
+# Rows of the element table shown on the result page; the downloads have all of them
+TABLE_PREVIEW_ROWS = 1000
+
+# How long the match preview waits for the filter options to stop changing before it counts
+PREVIEW_DEBOUNCE_SECONDS = float(os.environ.get("IFC_PREVIEW_DEBOUNCE_SECONDS", 0.5))
+
+def uploads_in_use() -> set[str]:
+    """Keys of the uploads the sessions of this process show and the queued and running jobs read"""
+    return get_session_store().keys("model") | get_job_runner().active_params("model_key")
+
+def release_models(keys: set[str]):
+    """Drop parsed models that no session refers to any more from the model cache"""
+    for key in keys:
+        get_model_cache().discard(key)
+
+def open_uploaded_model() -> ifcopenshell.file:
+    cache = get_model_cache()
+    upload = st.session_state.upload
+    file = cache.open_path(upload.key, get_upload_store().ifc_path(upload))
+    # Indexed once per model across processes; later lookups without the key find this index
+    ModelIndex.for_file(file, upload.key)
+    release_models(get_session_store().bind(st.session_state.session_id, "model", upload.key))
+    logger.debug("Model cache: %s", cache.stats())
+    return file
+
+def open_job_model(params: dict) -> ifcopenshell.file:
+    """The source model of a filter job, from the input stored for its workers"""
+    file = get_model_cache().open_path(params["model_key"], params["model_path"])
+    release_models(get_session_store().bind(st.session_state.session_id, "model", params["model_key"]))
+    return file
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def count_matches(model_key: str, spec: tuple, _file: ifcopenshell.file) -> dict:
+    """Elements a filter spec selects, in total, per storey and per class, from the model index without copying.
+
+    Cached per model and spec for every session; _file is not part of the key.
+    """
+    stories, keywords, ifc_product, filter_option, keyword_mode, query = spec
+    index = ModelIndex.for_file(_file)
+    patcher = Patcher(_file, logger, list(stories), list(keywords), ifc_product, filter_option, keyword_mode,
+                      index=index, query=query)
+    positions = patcher.filter_positions()
+    return {
+        "total": len(positions),
+        "by_storey": index.storey_counts(positions, stories),
+        "by_class": index.class_counts(positions),
+    }
+
+def show_match_preview(placeholder, file: ifcopenshell.file, spec: tuple):
+    """Fill placeholder with the match counts of spec once the filter options have settled"""
+    key = (st.session_state.upload.key, spec)
+    if st.session_state.preview_spec != key:
+        placeholder.caption("🔎 Waiting for the filter options to settle...")
+        time.sleep(PREVIEW_DEBOUNCE_SECONDS)
+        # Drawing stops this run here if a widget changed during the wait, before anything is counted
+        placeholder.caption("🔎 Counting matching elements...")
+    matches = count_matches(st.session_state.upload.key, spec, file)
+    st.session_state.preview_spec = key
+    with placeholder.container():
+        if not matches["total"]:
+            st.warning("⚠️ No objects match the current filter options.")
+            return
+        st.write(f"🔎 **{matches['total']:,}** elements match the current filter options.")
+        with st.expander("Matches per Storey and Class"):
+            storey_column, class_column = st.columns(2)
+            storey_column.dataframe(
+                [{"Storey": storey, "Elements": count} for storey, count in matches["by_storey"].items()],
+                hide_index=True, use_container_width=True
             )
-        for relating_object_guid, related_objects in self.aggregates.items():
-            self.new.createIfcRelAggregates(
-                ifcopenshell.guid.new(),
-                self.owner_history,
-                None,
-                None,
-                self.new.by_guid(relating_object_guid),
-                list(related_objects),
+            class_column.dataframe(
+                [{"Class": ifc_class, "Elements": count} for ifc_class, count in matches["by_class"].items()],
+                hide_index=True, use_container_width=True
             )
 
+def build_preview(model_key: str, tessellation: Tessellation, chunks: list[Chunk], quantization: str):
+    """Publish a coarse and a detailed GLB per chunk, returning the manifest URL and summed batching stats.
+
+    The viewer loads every coarse chunk first and then swaps in the detailed ones.
+    """
+    glb_cache = get_glb_cache()
+    asset_server = get_asset_server()
+    manifest = {"chunks": []}
+    batching = {}
+    for chunk in chunks:
+        meshes = list(tessellation.meshes(chunk.guids))
+        if not meshes:
+            continue
+        selection = "\n".join([model_key, *chunk.guids]).encode("utf-8")
+        version = f"geometry-cache-{ifcopenshell.version}-w{WRITER_VERSION}"
+        detail_path = glb_cache.build(
+            selection, version, ("batch", quantization),
+            lambda path: write_meshes(meshes, path, batch=True, quantization=quantization)
+        )
+        coarse_path = glb_cache.build(
+            selection, version, ("batch", quantization, f"coarse-{COARSE_CELLS}"),
+            lambda path: write_meshes(coarse_meshes(meshes), path, batch=True, quantization=quantization)
+        )
+        manifest["chunks"].append({
+            "name": chunk.name,
+            "elevation": chunk.elevation,
+            "elements": len(meshes),
+            "coarse": {"url": asset_server.publish_file(coarse_path, "glb"), "bytes": os.path.getsize(coarse_path)},
+            "detail": {"url": asset_server.publish_file(detail_path, "glb"), "bytes": os.path.getsize(detail_path)},
+        })
+        for name, value in read_glb_json(detail_path)["asset"].get("extras", {}).get("batching", {}).items():
+            batching[name] = batching.get(name, 0) + value
+    if not manifest["chunks"]:
+        raise GeometryError("No element geometry could be tessellated.")
+    manifest_url = asset_server.publish_bytes(json.dumps(manifest).encode("utf-8"), "json")
+    return manifest_url, batching
+
+def show_performance(recorder):
+    if recorder is None or not recorder.spans:
+        return
+    with st.expander("⏱️ Performance"):
+        st.dataframe(recorder.summary(), hide_index=True, use_container_width=True)
+        st.caption(f"Totals across requests are exported to {metrics.path}")
+
+def show_memory_usage():
+    usage = get_session_store().usage()
+    models = get_model_cache().stats()
+    cache = shared_cache.usage()
+    with st.sidebar.expander("💾 Memory Usage"):
+        st.write({
+            "Sessions": usage["sessions"],
+            "Parsed models": f"{models['entries']} ({models['bytes'] / 1024 ** 2:.0f} of {models['budget_bytes'] / 1024 ** 2:.0f} MiB, estimated)",
+            "Session payloads in memory": f"{usage['memory_payloads']} ({usage['memory_bytes'] / 1024 ** 2:.1f} of {usage['memory_budget_bytes'] / 1024 ** 2:.0f} MiB)",
+            "Session payloads on disk": f"{usage['disk_payloads']} ({usage['disk_bytes'] / 1024 ** 2:.1f} MiB)",
+            "Shared cache": f"{cache['bytes'] / 1024 ** 2:.0f} of {cache['budget_bytes'] / 1024 ** 2:.0f} MiB",
+        })
+
 def main():
     st.title("🛠️ IFC Filtering and Conversion App")
 
     # Initialize session state variables
-    if 'filtered_ifc_data' not in st.session_state:
-        st.session_state.filtered_ifc_data = None
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None
     if 'output_filename' not in st.session_state:
         st.session_state.output_filename = ""
-    if 'patcher' not in st.session_state:
-        st.session_state.patcher = None
-    if 'file_bytes' not in st.session_state:
-        st.session_state.file_bytes = None
+    if 'model_key' not in st.session_state:
+        st.session_state.model_key = None
+    if 'model_path' not in st.session_state:
+        st.session_state.model_path = None
+    if 'upload' not in st.session_state:
+        st.session_state.upload = None
+    if 'upload_file_id' not in st.session_state:
+        st.session_state.upload_file_id = None
     if 'uploaded_file_name' not in st.session_state:
         st.session_state.uploaded_file_name = ""
     if 'stories' not in st.session_state:
@@ -194,120 +230,115 @@ def main():
         st.session_state.filter_option = ""
     if 'ifc_product' not in st.session_state:
         st.session_state.ifc_product = None
-    if 'ifcconvert_path' not in st.session_state:
-        st.session_state.ifcconvert_path = None
-
-    # Step 1: Install ifcconvert
-    if st.session_state.ifcconvert_path is None:
-        st.session_state.ifcconvert_path = install_ifcconvert()
+    if 'keyword_mode' not in st.session_state:
+        st.session_state.keyword_mode = "substring"
+    if 'query' not in st.session_state:
+        st.session_state.query = ""
+    if 'recorder' not in st.session_state:
+        st.session_state.recorder = None
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if 'split_for' not in st.session_state:
+        st.session_state.split_for = None
+    if 'preview_spec' not in st.session_state:
+        st.session_state.preview_spec = None
+
+    # Large payloads live in the session store, keyed from here; idle sessions give theirs back
+    session_store = get_session_store()
+    session_store.touch(st.session_state.session_id)
+    release_models(session_store.expire())
+    show_memory_usage()
+
+    # A reload starts a new session; the job id in the URL reconnects it to its job
+    if st.session_state.job_id is None and "job" in st.query_params:
+        job = get_job_runner().status(st.query_params["job"])
+        if job is not None:
+            st.session_state.job_id = job["id"]
+            for name in JOB_PARAMS:
+                st.session_state[name] = job["params"].get(name)
 
     def filter_ifc_callback():
-        if st.session_state.file_bytes is None:
+        if st.session_state.upload is None:
             st.error("No file uploaded.")
             return
 
-        # Save the uploaded file to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".ifc") as tmp_file:
-            tmp_file.write(st.session_state.file_bytes)
-            tmp_file_path = tmp_file.name
-
-        # Handle IFCZIP files
-        if st.session_state.uploaded_file_name.endswith('.ifczip'):
-            try:
-                with zipfile.ZipFile(tmp_file_path, 'r') as zip_ref:
-                    extract_dir = tempfile.mkdtemp()
-                    zip_ref.extractall(extract_dir)
-                    extracted_files = zip_ref.namelist()
-                    ifc_files = [f for f in extracted_files if f.endswith(".ifc")]
-                    if ifc_files:
-                        tmp_file_path = os.path.join(extract_dir, ifc_files[0])
-                    else:
-                        st.error("No IFC files found in the uploaded IFCZIP.")
-                        return
-            except zipfile.BadZipFile:
-                st.error("Uploaded file is not a valid zip archive.")
-                return
-            except Exception as e:
-                st.error(f"Error extracting IFCZIP file: {e}")
-                return
+        # Filtering and tessellation run in a worker process; this rerun only queues the job
+        runner = get_job_runner()
+        st.session_state.model_key = st.session_state.upload.key
+        st.session_state.model_path = get_upload_store().ifc_path(st.session_state.upload)
+        st.session_state.output_filename = st.session_state.output_filename or f"filtered_{st.session_state.uploaded_file_name}"
+        spec = {
+            "stories": st.session_state.stories,
+            "keywords": st.session_state.keywords,
+            "ifc_product": st.session_state.ifc_product,
+            "filter_option": st.session_state.filter_option,
+            "keyword_mode": st.session_state.keyword_mode,
+            "query": st.session_state.query,
+        }
+        geometry_threads = max(1, (os.cpu_count() or 1) // runner.max_workers)
+        # Identical filters of the same model, from any session or app process, share one job
+        key = hashlib.sha256(json.dumps([st.session_state.model_key, spec], sort_keys=True).encode("utf-8")).hexdigest()
+        st.session_state.job_id = runner.submit(
+            "filter", filter_model, st.session_state.model_path, st.session_state.model_key, spec, geometry_threads,
+            st.session_state.session_id, params={name: st.session_state[name] for name in JOB_PARAMS}, key=key,
+            reuse=lambda job: get_output_store().get(job["result"]["artifact"]["key"]) is not None,
+            subscriber=st.session_state.session_id, pin=st.session_state.model_key
+        )
+        st.query_params["job"] = st.session_state.job_id
 
-        try:
-            file = ifcopenshell.open(tmp_file_path)
-        except Exception as e:
-            st.error(f"Failed to open IFC file: {e}")
+    def cancel_job_callback():
+        runner = get_job_runner()
+        if runner.cancel(st.session_state.job_id, st.session_state.session_id):
             return
-
-        # Initialize logger
-        logger = logging.getLogger("IFCLogger")
-        logger.setLevel(logging.DEBUG)
-        if not logger.handlers:
-            ch = logging.StreamHandler()
-            ch.setLevel(logging.DEBUG)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            ch.setFormatter(formatter)
-            logger.addHandler(ch)
-
-        # Initialize and run the patcher
-        patcher = Patcher(
-            file=file,
-            logger=logger,
-            stories=st.session_state.stories,
-            keywords=st.session_state.keywords,
-            ifc_product=st.session_state.ifc_product,
-            filter_option=st.session_state.filter_option
-        )
-        try:
-            patcher.patch()
-            st.session_state.patcher = patcher
-            st.session_state.filtered_ifc_data = patcher.file.to_string()
-            st.session_state.output_filename = st.session_state.output_filename or f"filtered_{st.session_state.uploaded_file_name}"
-        except Exception as e:
-            st.error(f"Error during filtering: {e}")
+        job = runner.status(st.session_state.job_id)
+        if job is not None and job["state"] in ACTIVE_STATES:
+            # Other sessions are waiting for the same shared job, so this one only stops following it
+            st.session_state.job_id = None
+            st.query_params.clear()
 
     def reset_filter_callback():
-        st.session_state.filtered_ifc_data = None
+        st.session_state.job_id = None
+        st.query_params.clear()
         st.session_state.output_filename = ""
-        st.session_state.patcher = None
-        st.session_state.file_bytes = None
+        st.session_state.model_key = None
+        st.session_state.model_path = None
+        st.session_state.upload = None
+        st.session_state.upload_file_id = None
         st.session_state.uploaded_file_name = ""
         st.session_state.stories = []
         st.session_state.keywords = []
         st.session_state.filter_option = ""
         st.session_state.ifc_product = None
+        st.session_state.keyword_mode = "substring"
+        st.session_state.query = ""
+        st.session_state.recorder = None
+        st.session_state.split_for = None
+        st.session_state.preview_spec = None
 
-    if st.session_state.filtered_ifc_data is None:
+    if st.session_state.job_id is None:
         uploaded_file = st.file_uploader("🔽 Choose an IFC or IFCZIP file", type=["ifc", "ifczip"])
         if uploaded_file is not None:
-            st.session_state.file_bytes = uploaded_file.read()
+            # Each rerun of the options page starts a new request; filtering and conversion add to it
+            st.session_state.recorder = Recorder.create()
+            # Each new upload is streamed to disk once; reruns for the other widgets reuse it
+            if st.session_state.upload_file_id != uploaded_file.file_id:
+                uploaded_file.seek(0)
+                with recording(st.session_state.recorder):
+                    st.session_state.upload = get_upload_store().ingest(uploaded_file, uploaded_file.name)
+                st.session_state.upload_file_id = uploaded_file.file_id
             st.session_state.uploaded_file_name = uploaded_file.name
             st.header("📋 Filter Options")
 
-            # Handle file extraction if IFCZIP
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".ifc") as tmp_file:
-                tmp_file.write(st.session_state.file_bytes)
-                tmp_file_path = tmp_file.name
-
-            if uploaded_file.name.endswith('.ifczip'):
-                try:
-                    with zipfile.ZipFile(tmp_file_path, 'r') as zip_ref:
-                        extract_dir = tempfile.mkdtemp()
-                        zip_ref.extractall(extract_dir)
-                        extracted_files = zip_ref.namelist()
-                        ifc_files = [f for f in extracted_files if f.endswith(".ifc")]
-                        if ifc_files:
-                            tmp_file_path = os.path.join(extract_dir, ifc_files[0])
-                        else:
-                            st.error("No IFC files found in the uploaded IFCZIP.")
-                            st.stop()
-                except zipfile.BadZipFile:
-                    st.error("Uploaded file is not a valid zip archive.")
-                    st.stop()
-                except Exception as e:
-                    st.error(f"Error extracting IFCZIP file: {e}")
-                    st.stop()
-
+            # Parse the upload once; later reruns and the filter callback hit the cache
             try:
-                file = ifcopenshell.open(tmp_file_path)
+                with recording(st.session_state.recorder):
+                    file = open_uploaded_model()
+            except zipfile.BadZipFile:
+                st.error("Uploaded file is not a valid zip archive.")
+                st.stop()
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
             except Exception as e:
                 st.error(f"Failed to open IFC file: {e}")
                 st.stop()
@@ -321,19 +352,50 @@ def main():
 
             filter_option = st.selectbox(
                 "🔹 Choose Filtering Option",
-                options=["IFC Product and Keywords", "Keywords Only"]
+                options=["IFC Product and Keywords", "Keywords Only", "Query"]
             )
             st.session_state.filter_option = filter_option
 
             if filter_option == "IFC Product and Keywords":
-                ifc_products = sorted({entity.is_a() for entity in file.by_type("IfcProduct")})
+                ifc_products = ModelIndex.for_file(file).classes()
                 ifc_product = st.selectbox("🔹 Select IFC Product to Filter", options=ifc_products)
                 st.session_state.ifc_product = ifc_product
             else:
                 st.session_state.ifc_product = None
 
-            keywords_input = st.text_input("🔹 Enter Keywords to Filter Elements (comma separated)")
-            keywords = [kw.strip() for kw in keywords_input.split(',') if kw.strip()]
+            query_valid = True
+            if filter_option == "Query":
+                query_text = st.text_area(
+                    "🔹 Enter Query",
+                    placeholder='IfcWall and Pset_WallCommon.FireRating = "EI60" and not name ~ temporary',
+                    help="Conditions on class, storey, name, type, material, classification, PropertySet.Property "
+                         "or any attribute, with =, !=, ~ (contains), <, <=, >, >= and joined by and, or, not "
+                         "and parentheses. A bare IFC class name such as IfcDoor tests the class."
+                )
+                st.session_state.query = query_text.strip()
+                keywords = []
+                if st.session_state.query:
+                    try:
+                        query = Query(st.session_state.query)
+                    except QueryError as e:
+                        st.error(f"Invalid query: {e}")
+                        query_valid = False
+                    else:
+                        with st.expander("🔎 Query Plan"):
+                            st.code("\n".join(query.explain(ModelIndex.for_file(file))), language=None)
+                else:
+                    query_valid = False
+            else:
+                st.session_state.query = ""
+                keywords_input = st.text_input(
+                    "🔹 Enter Keywords to Filter Elements (comma separated)",
+                    help="Prefix a keyword with ! to exclude elements whose name contains it."
+                )
+                keywords = [kw.strip() for kw in keywords_input.split(',') if kw.strip()]
+
+                keyword_modes = {"Anywhere in Name": "substring", "Whole Words": "word", "Start of Words": "prefix"}
+                keyword_mode = st.selectbox("🔹 Match Keywords", options=list(keyword_modes))
+                st.session_state.keyword_mode = keyword_modes[keyword_mode]
             st.session_state.keywords = keywords
 
             # Generate default output filename
@@ -347,71 +409,193 @@ def main():
             output_filename = st.text_input("🔹 Output IFC Filename (optional)", value=default_output_filename)
             st.session_state.output_filename = output_filename
 
+            # Counts of what the current options select, filled in at the end of the run
+            match_preview = st.empty()
+
             # Filter Button
-            st.button("🔄 Filter IFC Model", on_click=filter_ifc_callback)
+            st.button("🔄 Filter IFC Model", on_click=filter_ifc_callback, disabled=not query_valid)
+
+            # Split into one IFC per storey or per class from a single parse
+            with st.expander("🗂️ Split Model Into One IFC per Storey or Class"):
+                split_option = st.radio("🔹 Split", options=list(SPLIT_OPTIONS), horizontal=True)
+                if st.button("📦 Build Split ZIP"):
+                    splitter = Splitter(file, logger, SPLIT_OPTIONS[split_option], stories=stories)
+                    with st.spinner("🔄 Splitting IFC model..."):
+                        try:
+                            # Written to the output store a model at a time; other sessions reuse the zip
+                            split_path, counts = get_output_store().split(
+                                st.session_state.upload.key, splitter, input_filename
+                            )
+                        except Exception as e:
+                            st.error(f"Error during splitting: {e}")
+                            counts = None
+                    if counts == {}:
+                        st.error("No objects found matching the given criteria.")
+                    elif counts:
+                        st.session_state.split_for = (st.session_state.upload.key, split_option, stories, counts,
+                                                      split_path)
+                split_for = st.session_state.split_for
+                if split_for is not None and split_for[:3] == (st.session_state.upload.key, split_option, stories):
+                    split_zip = open(split_for[4], "rb") if shared_cache.touch(split_for[4]) else None
+                    if split_zip is not None:
+                        st.write({filename: f"{products} products" for filename, products in split_for[3].items()})
+                        with split_zip:
+                            st.download_button(
+                                "📥 Download Split IFCs",
+                                data=split_zip,
+                                file_name=f"{input_filename}_split_{SPLIT_OPTIONS[split_option]}.zip",
+                                mime="application/zip"
+                            )
+
+            if query_valid:
+                show_match_preview(match_preview, file, (
+                    tuple(stories), tuple(keywords), st.session_state.ifc_product, filter_option,
+                    st.session_state.keyword_mode, st.session_state.query or None
+                ))
     else:
-        patcher = st.session_state.patcher
-        filtered_ifc_data = st.session_state.filtered_ifc_data
+        runner = get_job_runner()
+        job_id = st.session_state.job_id
+        job = runner.status(job_id)
         output_filename = st.session_state.output_filename
-        if not patcher or not filtered_ifc_data:
-            st.error("No filtered data available.")
+        if job is None:
+            st.error("This filter job has expired. Please upload the model again.")
+        elif job["state"] in ACTIVE_STATES:
+            progress = job["progress"]
+            if job["state"] == "queued":
+                st.progress(0.0, text="⏳ Waiting for a free worker...")
+            elif progress.get("stage") == "tessellating":
+                st.progress(
+                    min(progress.get("fraction", 0.0), 1.0),
+                    text=f"🔄 Tessellating IFC model... {progress.get('tessellated', 0):,} elements, "
+                         f"{progress.get('triangles', 0):,} triangles"
+                )
+            elif progress.get("to_copy"):
+                st.progress(
+                    progress["copied"] / progress["to_copy"],
+                    text=f"🔄 Filtering IFC model... {progress['copied']:,} of {progress['to_copy']:,} entities copied"
+                )
+            else:
+                st.progress(0.0, text=f"🔄 {progress.get('stage', 'starting').capitalize()} IFC model...")
+            # Also subscribes a session that reconnected to the job after a reload
+            runner.subscribe(job_id, st.session_state.session_id)
+            st.button("⏹️ Cancel", on_click=cancel_job_callback)
+            # Poll until the worker is done; the job keeps running if the page is left or reloaded
+            time.sleep(0.5)
+            st.rerun()
+        elif job["state"] == "cancelled":
+            st.warning("Filtering was cancelled.")
+        elif job["state"] == "failed":
+            st.error(f"Error during filtering: {job['error']}")
         else:
-            filtered_products = patcher.file.by_type("IfcProduct")
-            if not filtered_products:
+            if st.session_state.get("merged_job_spans") != job_id:
+                # Stage timings from the worker join this session's performance panel
+                st.session_state.recorder = st.session_state.recorder or Recorder.create()
+                if st.session_state.recorder is not None:
+                    st.session_state.recorder.add(job["result"]["spans"])
+                st.session_state.merged_job_spans = job_id
+            if not job["result"]["products"]:
                 st.error("No objects found matching the given criteria.")
             else:
                 st.header(f"📁 Filtered IFC: {st.session_state.uploaded_file_name}")
                 st.write(f"**Stories:** {', '.join(st.session_state.stories)}")
                 if st.session_state.ifc_product:
                     st.write(f"**IFC Product:** {st.session_state.ifc_product}")
-                st.write(f"**Keywords:** {', '.join(st.session_state.keywords)}")
-
-                # Ensure output filename has .ifc extension
-                if not output_filename.lower().endswith(".ifc"):
-                    output_filename += ".ifc"
-
-                # Download Button for Filtered IFC
-                st.download_button(
-                    "📥 Download Filtered IFC",
-                    data=filtered_ifc_data,
-                    file_name=output_filename
-                )
-
-                # Conversion to GLB
-                unique_id = uuid.uuid4().hex
-                glb_filename = f"filtered_model_{unique_id}.glb"
-                with tempfile.NamedTemporaryFile(suffix=".ifc", delete=False) as filtered_ifc:
-                    filtered_ifc.write(filtered_ifc_data.encode("utf-8"))
-                    filtered_ifc_path = filtered_ifc.name
+                if st.session_state.query:
+                    st.write(f"**Query:** `{st.session_state.query}`")
+                else:
+                    st.write(f"**Keywords:** {', '.join(st.session_state.keywords)}")
 
-                glb_path = os.path.join(tempfile.gettempdir(), glb_filename)
-                
-                # Construct the absolute path to ifcconvert
-                ifcconvert_path = st.session_state.ifcconvert_path
-
-                # Define the conversion command using the absolute path
-                convert_cmd = f'"{ifcconvert_path}" "{filtered_ifc_path}" "{glb_path}"'
-
-                # Run the conversion
-                with st.spinner("🔄 Converting IFC to GLB..."):
-                    retcode = subprocess.run(
-                        convert_cmd,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE
-                    )
-
-                if retcode.returncode != 0:
-                    st.error("🚨 Conversion to GLB failed. Ensure ifcconvert is installed correctly.")
-                    st.error(retcode.stderr.decode())
+                # The job wrote the filtered model to disk once; the download is served from that file
+                artifact = get_output_store().get(job["result"]["artifact"]["key"])
+                if artifact is None:
+                    st.error("The filtered model has expired. Please filter the model again.")
                 else:
-                    try:
-                        with open(glb_path, "rb") as f:
-                            glb_content = f.read()
-                        glb_base64 = base64.b64encode(glb_content).decode("utf-8")
-                    except Exception as e:
-                        st.error(f"Error reading GLB file: {e}")
-                        return
+                    output_format = st.radio("🔹 Download Format", options=list(OUTPUT_FORMATS), horizontal=True)
+                    compresslevel = DEFAULT_COMPRESSLEVEL
+                    if output_format == "IFCZIP":
+                        compresslevel = st.slider(
+                            "🔹 Compression Level", min_value=1, max_value=9, value=DEFAULT_COMPRESSLEVEL,
+                            help="Higher levels make smaller files but take longer to compress."
+                        )
+                    with recording(st.session_state.recorder):
+                        output_path, download_name = get_output_store().output(
+                            artifact, output_filename, output_format, compresslevel
+                        )
+                    with open(output_path, "rb") as f:
+                        st.download_button(
+                            f"📥 Download Filtered {output_format}",
+                            data=f,
+                            file_name=download_name
+                        )
+
+                # The job extracted the element table of the source model and saved which of its rows it selected
+                table = get_table_store().get(st.session_state.model_key)
+                rows_path = runner.path(job_id, "rows.npy")
+                if table is not None and os.path.exists(rows_path):
+                    rows = np.load(rows_path)
+                    with st.expander(f"📋 Element Table ({len(rows):,} elements)"):
+                        st.dataframe(table.take(rows[:TABLE_PREVIEW_ROWS]).to_dict(), hide_index=True,
+                                     use_container_width=True)
+                        if len(rows) > TABLE_PREVIEW_ROWS:
+                            st.caption(f"Showing the first {TABLE_PREVIEW_ROWS:,} rows; the download has all of them.")
+                        table_format = st.radio("🔹 Table Format", options=list(TABLE_FORMATS), horizontal=True)
+                        with recording(st.session_state.recorder):
+                            table_path = get_table_store().export(st.session_state.model_key, table, rows, table_format)
+                        with open(table_path, "rb") as f:
+                            st.download_button(
+                                f"📥 Download Element Table ({table_format})",
+                                data=f,
+                                file_name=f"{os.path.splitext(output_filename)[0]}_elements{TABLE_FORMATS[table_format]}"
+                            )
+
+                # Quantized vertices (KHR_mesh_quantization) are decoded natively by the viewer's GLTFLoader
+                preview_qualities = {
+                    "High (16-bit positions)": "high",
+                    "Compact (8-bit positions for repeated elements)": "low",
+                    "Full Precision": "off",
+                }
+                preview_quality = st.selectbox("🔹 Preview Quality", options=list(preview_qualities))
+                quantization = preview_qualities[preview_quality]
+
+                # The source model is tessellated once per upload; each filter only reassembles cached meshes
+                manifest_url = None
+                progress_bar = st.progress(0.0, text="🔄 Tessellating IFC model...")
+                shown = {"percent": -1}
+
+                def report_progress(done: int, fraction: float, triangles: int):
+                    # One UI update per percent, not per element
+                    percent = min(int(fraction * 100), 100)
+                    if percent != shown["percent"]:
+                        shown["percent"] = percent
+                        progress_bar.progress(percent / 100, text=f"🔄 Tessellating IFC model... {done} elements, {triangles:,} triangles")
+
+                try:
+                    with recording(st.session_state.recorder):
+                        # The job tessellated the model already, unless the cache has since evicted it
+                        model_key = st.session_state.model_key
+                        tessellation = get_geometry_cache().get(model_key)
+                        if tessellation is None:
+                            params = {name: st.session_state[name] for name in JOB_PARAMS}
+                            tessellation = get_geometry_cache().tessellate(model_key, open_job_model(params), progress=report_progress)
+                        progress_bar.progress(1.0, text="🔄 Building preview...")
+                        chunks = [Chunk(**chunk) for chunk in read_json(runner.path(job_id, "chunks.json"))["chunks"]]
+                        with span("conversion"):
+                            manifest_url, batching = build_preview(model_key, tessellation, chunks, quantization)
+                except GeometryError as e:
+                    st.error("🚨 Conversion to GLB failed.")
+                    st.error(str(e))
+                except OSError as e:
+                    st.error(f"Error publishing GLB files: {e}")
+                finally:
+                    progress_bar.empty()
+
+                if manifest_url is not None:
+                    if batching:
+                        st.caption(
+                            f"Draw calls: {batching['draw_calls_before']:,} → {batching['draw_calls_after']:,} "
+                            f"({batching['instanced_elements']:,} elements in {batching['instance_groups']:,} instance groups); "
+                            f"geometry: {batching['bytes_before'] / 1024 ** 2:.1f} MB → {batching['bytes_after'] / 1024 ** 2:.1f} MB"
+                        )
 
                     # Embed 3D Viewer using Three.js
                     html_snippet = textwrap.dedent(f"""
@@ -497,45 +681,90 @@ def main():
                             dirLight.position.set(0, 20, 10);
                             scene.add(dirLight);
                 
-                            const base64Data = "{glb_base64}";
-                            const binary = atob(base64Data);
-                            const array = new Uint8Array(binary.length);
-                            for (let i = 0; i < binary.length; i++) {{
-                              array[i] = binary.charCodeAt(i);
+                            const manifestUrl = "{manifest_url}";
+                
+                            async function fetchModel(url) {{
+                              const response = await fetch(url);
+                              if (!response.ok) {{
+                                throw new Error("HTTP " + response.status);
+                              }}
+                              const total = Number(response.headers.get('Content-Length')) || 0;
+                              const chunks = [];
+                              let loaded = 0;
+                              const reader = response.body.getReader();
+                              while (true) {{
+                                const {{ done, value }} = await reader.read();
+                                if (done) break;
+                                chunks.push(value);
+                                loaded += value.length;
+                                if (total) {{
+                                  console.log((loaded / total * 100).toFixed(0) + '% loaded');
+                                }}
+                              }}
+                              return await new Blob(chunks).arrayBuffer();
                             }}
-                            const blob = new Blob([array], {{ type: 'model/gltf-binary' }});
-                            const glbUrl = URL.createObjectURL(blob);
                 
                             const loader = new GLTFLoader();
-                            loader.load(
-                              glbUrl,
-                              (gltf) => {{
-                                console.log("GLB model loaded successfully.");
-                                scene.add(gltf.scene);
+                            function parseModel(data) {{
+                              return new Promise((resolve, reject) => loader.parse(data, '', resolve, reject));
+                            }}
+                
+                            function dispose(object) {{
+                              object.traverse((child) => {{
+                                if (child.geometry) child.geometry.dispose();
+                              }});
+                            }}
+                
+                            function frame(object) {{
+                              const box = new THREE.Box3().setFromObject(object);
+                              const center = box.getCenter(new THREE.Vector3());
+                              const size = box.getSize(new THREE.Vector3());
+                
+                              const maxDim = Math.max(size.x, size.y, size.z);
+                              const fov = camera.fov * (Math.PI / 180);
+                              let cameraZ = Math.abs(maxDim / 2 * Math.tan(fov * 2));
                 
-                                const box = new THREE.Box3().setFromObject(gltf.scene);
-                                const center = box.getCenter(new THREE.Vector3());
-                                const size = box.getSize(new THREE.Vector3());
+                              camera.position.z = cameraZ * 2;
+                              camera.lookAt(center);
                 
-                                const maxDim = Math.max(size.x, size.y, size.z);
-                                const fov = camera.fov * (Math.PI / 180);
-                                let cameraZ = Math.abs(maxDim / 2 * Math.tan(fov * 2));
+                              controls.target.copy(center);
+                              controls.update();
+                            }}
                 
-                                camera.position.z = cameraZ * 2;
-                                camera.lookAt(center);
+                            // Every storey is shown coarse first, then replaced by its detailed chunk, bottom storey first
+                            async function loadProgressively() {{
+                              const manifest = await (await fetch(manifestUrl)).json();
+                              const model = new THREE.Group();
+                              scene.add(model);
+                              const shown = [];
+                              animate();
                 
-                                controls.target.copy(center);
-                                controls.update();
+                              await Promise.all(manifest.chunks.map(async (chunk, i) => {{
+                                const gltf = await parseModel(await fetchModel(chunk.coarse.url));
+                                if (!shown[i]) {{
+                                  shown[i] = gltf.scene;
+                                  model.add(gltf.scene);
+                                }}
+                              }}));
+                              frame(model);
+                              console.log("Coarse preview loaded.");
                 
-                                animate();
-                              }},
-                              (xhr) => {{
-                                console.log((xhr.loaded / xhr.total * 100) + '% loaded');
-                              }},
-                              (error) => {{
-                                console.error("Error loading GLB:", error);
+                              for (const [i, chunk] of manifest.chunks.entries()) {{
+                                if (chunk.detail.url === chunk.coarse.url) continue;
+                                const gltf = await parseModel(await fetchModel(chunk.detail.url));
+                                if (shown[i]) {{
+                                  model.remove(shown[i]);
+                                  dispose(shown[i]);
+                                }}
+                                shown[i] = gltf.scene;
+                                model.add(gltf.scene);
                               }}
-                            );
+                              console.log("GLB model loaded successfully.");
+                            }}
+                
+                            loadProgressively().catch((error) => {{
+                              console.error("Error loading GLB:", error);
+                            }});
                 
                             window.addEventListener('resize', onWindowResize, false);
                             function onWindowResize() {{
@@ -564,12 +793,12 @@ def main():
                         </html>
                     """)
 
-                    # Replace placeholder with actual base64 GLB data
-                    html_snippet = html_snippet.replace("{glb_base64}", glb_base64)
 
                     # Embed the 3D viewer
                     st.markdown("### 📊 3D Model Preview")
                     st.components.v1.html(html_snippet, height=600, scrolling=False)
+
+                show_performance(st.session_state.recorder)
         
         # Reset Button
         st.button("🔄 Filter New IFC Model", on_click=reset_filter_callback)
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Union
+
+import ifcopenshell
+
+from ingest import extract_first_ifc, model_suffix
+from instrumentation import span
+
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_MODEL_CACHE_BYTES", 2 * 1024 ** 3))
+# Memory of a parsed model per byte of its IFC text; measured at 5 to 8 for the synthetic benchmark models
+PARSED_BYTES_PER_TEXT_BYTE = float(os.environ.get("IFC_MODEL_PARSED_BYTES_PER_TEXT_BYTE", 6))
+
+
+def open_model(path: str) -> tuple[ifcopenshell.file, int]:
+    """Parse an IFC or IFCZIP file on disk, returning the model and the size of the IFC text"""
+    if not path.lower().endswith(".ifczip"):
+        with span("ifcopenshell.open"):
+            return ifcopenshell.open(path), os.path.getsize(path)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ifc_path = os.path.join(tmp_dir, "model.ifc")
+        with span("unzip"):
+            extract_first_ifc(path, ifc_path)
+        with span("ifcopenshell.open"):
+            return ifcopenshell.open(ifc_path), os.path.getsize(ifc_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_model(data: bytes, filename: str) -> tuple[ifcopenshell.file, int]:
+    """Parse uploaded IFC or IFCZIP bytes, returning the model and the size of the IFC text"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tmp_file_path = os.path.join(tmp_dir, "upload" + model_suffix(filename))
+        with open(tmp_file_path, "wb") as tmp_file:
+            tmp_file.write(data)
+        return open_model(tmp_file_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ModelCache:
+    """Parsed models keyed by the SHA-256 of the uploaded bytes.
+
+    Each entry is charged the memory its model is estimated to take, the size
+    of its IFC text times PARSED_BYTES_PER_TEXT_BYTE. Entries are evicted
+    least recently used first once their summed estimate exceeds
+    budget_bytes. The most recently used model is always kept, even if it is
+    larger than the budget on its own.
+    """
+
+    def __init__(self, budget_bytes: int = DEFAULT_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.entries: OrderedDict[str, tuple[ifcopenshell.file, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def open(self, data: bytes, filename: str) -> ifcopenshell.file:
+        key = self.key(data)
+        file = self.get(key)
+        if file is None:
+            file, size = load_model(data, filename)
+            self.put(key, file, size)
+        return file
+
+    def open_path(self, key: str, path: str) -> ifcopenshell.file:
+        """Like open, for a model already on disk whose content key is known"""
+        file = self.get(key)
+        if file is None:
+            file, size = open_model(path)
+            self.put(key, file, size)
+        return file
+
+    def get(self, key: str) -> Union[ifcopenshell.file, None]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, file: ifcopenshell.file, text_bytes: int) -> None:
+        """Add a parsed model whose IFC text is text_bytes long"""
+        with self._lock:
+            self.entries[key] = (file, int(text_bytes * PARSED_BYTES_PER_TEXT_BYTE))
+            self.entries.move_to_end(key)
+            while len(self.entries) > 1 and self.size > self.budget_bytes:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self.entries.pop(key, None)
+
+    @property
+    def size(self) -> int:
+        """Estimated memory of the cached models"""
+        return sum(size for _, size in self.entries.values())
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "budget_bytes": self.budget_bytes,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
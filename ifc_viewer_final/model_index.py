@@ -0,0 +1,407 @@
+import json
+import os
+import weakref
+from typing import Iterable, Union
+
+import ifcopenshell
+
+import shared_cache
+from keyword_matcher import KeywordMatcher
+
+DEFAULT_SNAPSHOT_DIR = os.environ.get("IFC_INDEX_DIR", shared_cache.cache_dir("indexes"))
+SNAPSHOT_VERSION = 1
+
+# A value as stored in the inverted indexes: a kind ("s" for text, "n" for
+# numbers, "b" for booleans, "" for a property without a comparable value) and
+# the normalized value, so that True and 1.0 stay apart
+ValueKey = tuple[str, Union[str, float, bool, None]]
+NO_VALUE: ValueKey = ("", None)
+
+
+def unwrap(value):
+    """Python value of an attribute or property value, unwrapping defined types such as IfcLabel"""
+    if isinstance(value, ifcopenshell.entity_instance):
+        return value[0] if not value.id() else None
+    return value
+
+
+def value_key(value) -> Union[ValueKey, None]:
+    """Index key of an attribute or property value; text is compared without case"""
+    value = unwrap(value)
+    if isinstance(value, bool):
+        return "b", value
+    if isinstance(value, (int, float)):
+        return "n", float(value)
+    if isinstance(value, str):
+        return "s", value.strip().lower()
+    return None
+
+
+def property_set_values(definition: ifcopenshell.entity_instance) -> dict[str, list]:
+    """Values of the properties or quantities of a property set definition by name, defined types unwrapped"""
+    # Attributes are read by position, which is several times faster than by name:
+    # HasProperties, Quantities, the Name of a property or quantity and its value or values
+    values = {}
+    if definition.is_a("IfcPropertySet"):
+        for prop in definition[4]:
+            if prop.is_a("IfcPropertySingleValue"):
+                raw = [prop[2]]
+            elif prop.is_a("IfcPropertyEnumeratedValue") or prop.is_a("IfcPropertyListValue"):
+                raw = prop[2] or ()
+            else:
+                raw = ()
+            values[prop[0]] = [value for value in map(unwrap, raw) if value is not None]
+    elif definition.is_a("IfcElementQuantity"):
+        for quantity in definition[5]:
+            if quantity.is_a("IfcPhysicalSimpleQuantity"):
+                values[quantity[0]] = [value for value in [unwrap(quantity[3])] if value is not None]
+    return values
+
+
+def material_names(material: ifcopenshell.entity_instance) -> set[str]:
+    """Names of the materials and material sets a material association refers to"""
+    names = set()
+    pending = [material]
+    while pending:
+        definition = pending.pop()
+        if definition is None:
+            continue
+        for attribute in ("Name", "LayerSetName"):
+            name = getattr(definition, attribute, None)
+            if isinstance(name, str) and name:
+                names.add(name)
+        for attribute in ("Material", "ForLayerSet", "ForProfileSet"):
+            if hasattr(definition, attribute):
+                pending.append(getattr(definition, attribute))
+        for attribute in ("Materials", "MaterialLayers", "MaterialConstituents", "MaterialProfiles"):
+            pending.extend(getattr(definition, attribute, None) or ())
+    return names
+
+
+class ModelIndex:
+    """Lookup tables over the IfcProducts of a model.
+
+    Products are referred to by their position in ``file.by_type("IfcProduct")``
+    so that any selection can be turned back into elements in model order.
+    Classes, names and storeys are indexed in a single pass up front. Inverted
+    indexes from attribute, property, type, material and classification values
+    to positions are built the first time they are asked for and kept, each
+    from the relationships it needs rather than from every product.
+
+    The up-front tables can be saved as a snapshot keyed by the model's
+    content key, so that other processes opening the same model read them
+    instead of indexing it again.
+
+    The index refers to the model only weakly and to products by id, so that
+    dropping the last reference to a model, such as when the ModelCache
+    evicts it, releases the model and its index together.
+    """
+
+    _indexes: "weakref.WeakKeyDictionary[ifcopenshell.file, ModelIndex]" = weakref.WeakKeyDictionary()
+
+    def __init__(self, file: ifcopenshell.file, snapshot: Union[dict, None] = None):
+        """snapshot is what snapshot() returned for the same model; it is ignored if the products differ"""
+        self._file = weakref.ref(file)
+        products = file.by_type("IfcProduct")
+        self.ids: list[int] = [element.id() for element in products]
+        self.positions: dict[int, int] = {}
+        self.names: list[str] = []
+        self.by_class: dict[str, set[int]] = {}
+        self.by_storey: dict[str, set[int]] = {}
+        self._class_cache: dict[str, frozenset[int]] = {}
+        self._attribute_index: dict[str, dict[ValueKey, set[int]]] = {}
+        self._property_index: dict[str, dict[str, dict[ValueKey, set[int]]]] = {}
+        self._property_sets: Union[dict[str, list[tuple[int, tuple[int, ...]]]], None] = None
+        self._occurrences: Union[dict[int, set[int]], None] = None
+        self._type_index: Union[dict[ValueKey, set[int]], None] = None
+        self._material_index: Union[dict[ValueKey, set[int]], None] = None
+        self._classification_index: Union[dict[ValueKey, set[int]], None] = None
+
+        ids = self.ids
+        if snapshot is not None and snapshot.get("version") == SNAPSHOT_VERSION and snapshot["ids"] == ids:
+            self.positions = {element_id: position for position, element_id in enumerate(ids)}
+            self.names = snapshot["names"]
+            self.by_class = {ifc_class: set(positions) for ifc_class, positions in snapshot["by_class"].items()}
+            self.by_storey = {storey: set(positions) for storey, positions in snapshot["by_storey"]}
+            return
+
+        for position, element in enumerate(products):
+            self.positions[ids[position]] = position
+            self.names.append((element.Name or "").lower())
+            self.by_class.setdefault(element.is_a(), set()).add(position)
+
+        for rel in file.by_type("IfcRelContainedInSpatialStructure"):
+            storey = rel.RelatingStructure.Name
+            contained = self.by_storey.setdefault(storey, set())
+            for element in rel.RelatedElements:
+                position = self.positions.get(element.id())
+                if position is not None:
+                    contained.add(position)
+
+    @classmethod
+    def for_file(cls, file: ifcopenshell.file, key: Union[str, None] = None,
+                 directory: str = DEFAULT_SNAPSHOT_DIR) -> "ModelIndex":
+        """The index of file, built once per parsed model.
+
+        With the content key of the model, the index is read from the snapshot
+        in directory, which the first process to index the model writes.
+        """
+        index = cls._indexes.get(file)
+        if index is None:
+            index = cls._indexes[file] = cls.from_snapshot(file, key, directory) if key else cls(file)
+        return index
+
+    @classmethod
+    def from_snapshot(cls, file: ifcopenshell.file, key: str, directory: str = DEFAULT_SNAPSHOT_DIR) -> "ModelIndex":
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{key}-v{SNAPSHOT_VERSION}.json")
+        built = []
+
+        def write(tmp_path: str) -> None:
+            built.append(cls(file))
+            with open(tmp_path, "w") as f:
+                json.dump(built[0].snapshot(), f)
+
+        if shared_cache.build_once(path, write):
+            shared_cache.evict(keep=path)
+            return built[0]
+        try:
+            with open(path, "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            snapshot = None
+        return cls(file, snapshot)
+
+    def snapshot(self) -> dict:
+        """The up-front tables in JSON form, for ModelIndex(file, snapshot)"""
+        return {
+            "version": SNAPSHOT_VERSION,
+            "ids": self.ids,
+            "names": self.names,
+            "by_class": {ifc_class: sorted(positions) for ifc_class, positions in self.by_class.items()},
+            # Storey names may be missing or repeated, so as pairs rather than an object
+            "by_storey": [[storey, sorted(positions)] for storey, positions in self.by_storey.items()],
+        }
+
+    @property
+    def file(self) -> ifcopenshell.file:
+        file = self._file()
+        if file is None:
+            raise ReferenceError("The model of this index has been released")
+        return file
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def products(self) -> list[ifcopenshell.entity_instance]:
+        """All products, in position order"""
+        return self.file.by_type("IfcProduct")
+
+    def product(self, position: int) -> ifcopenshell.entity_instance:
+        return self.file.by_id(self.ids[position])
+
+    @property
+    def all(self) -> set[int]:
+        return set(range(len(self.ids)))
+
+    def of_class(self, ifc_class: Union[str, None]) -> frozenset[int]:
+        """Products that are an instance of ifc_class or one of its subtypes"""
+        if not ifc_class:
+            return frozenset()
+        if ifc_class not in self._class_cache:
+            matched = set()
+            for exact_class, positions in self.by_class.items():
+                if self.product(next(iter(positions))).is_a(ifc_class):
+                    matched |= positions
+            self._class_cache[ifc_class] = frozenset(matched)
+        return self._class_cache[ifc_class]
+
+    def in_storeys(self, storeys: Iterable[str]) -> set[int]:
+        """Products contained in a spatial structure with one of the given names"""
+        result = set()
+        for storey in set(storeys):
+            result |= self.by_storey.get(storey, set())
+        return result
+
+    def with_keywords(self, matcher: KeywordMatcher) -> set[int]:
+        """Products whose Name is accepted by the keyword matcher"""
+        return matcher.filter(self.names)
+
+    def elements(self, positions: Iterable[int]) -> list[ifcopenshell.entity_instance]:
+        by_id = self.file.by_id
+        return [by_id(self.ids[position]) for position in sorted(positions)]
+
+    def classes(self) -> list[str]:
+        return sorted(self.by_class)
+
+    def class_counts(self, positions: set[int]) -> dict[str, int]:
+        """Number of the given products per exact class, for the classes that have any"""
+        counts = {ifc_class: len(positions & members) for ifc_class, members in self.by_class.items()}
+        return {ifc_class: count for ifc_class, count in sorted(counts.items()) if count}
+
+    def storey_counts(self, positions: set[int], storeys: Iterable[str]) -> dict[str, int]:
+        """Number of the given products contained in each of the named spatial structures"""
+        return {storey: len(positions & self.by_storey.get(storey, set())) for storey in storeys}
+
+    def built(self, kind: str, name: str = "") -> bool:
+        """Whether the index a lookup needs exists already.
+
+        kind is "attribute" or "property" with the attribute or property set
+        name, or "type", "material" or "classification".
+        """
+        if kind == "attribute":
+            return name in self._attribute_index
+        if kind == "property":
+            return name.lower() in self._property_index
+        return getattr(self, f"_{kind}_index") is not None
+
+    def attribute_values(self, attribute: str) -> dict[ValueKey, set[int]]:
+        """Positions by value of a direct attribute of the products, such as PredefinedType or Tag"""
+        index = self._attribute_index.get(attribute)
+        if index is None:
+            index = {}
+            for position, element in enumerate(self.products()):
+                key = value_key(getattr(element, attribute, None)) if hasattr(element, attribute) else None
+                if key is not None:
+                    index.setdefault(key, set()).add(position)
+            self._attribute_index[attribute] = index
+        return index
+
+    def property_values(self, pset: str, prop: Union[str, None] = None) -> dict[ValueKey, set[int]]:
+        """Positions by value of a property or quantity, or with prop None, by property name of a whole set.
+
+        Names are matched without case. Values set on an element type apply to
+        its occurrences unless the occurrence sets the same property itself.
+        """
+        properties = self._property_index.get(pset.lower())
+        if properties is None:
+            properties = self._property_index[pset.lower()] = self._index_property_set(pset.lower())
+        if prop is not None:
+            return properties.get(prop.lower(), {})
+        return {("s", name): set().union(*index.values()) for name, index in properties.items()}
+
+    def _index_property_set(self, pset: str) -> dict[str, dict[ValueKey, set[int]]]:
+        properties = {}
+        keys_of = {}
+        for name, by_position in self.occurrence_properties(pset).items():
+            index = properties.setdefault(name.lower(), {})
+            for position, values in by_position.items():
+                # The values of one definition are shared by all elements it is assigned to
+                keys = keys_of.get(id(values))
+                if keys is None:
+                    keys = keys_of[id(values)] = [key for key in map(value_key, values) if key is not None] or [NO_VALUE]
+                for key in keys:
+                    index.setdefault(key, set()).add(position)
+        return properties
+
+    def property_sets(self) -> dict[str, list[tuple[int, tuple[int, ...]]]]:
+        """Ids of the property set definitions by lowercase name, with the ids of the objects each is assigned to"""
+        if self._property_sets is None:
+            property_sets = {}
+            for rel in self.file.by_type("IfcRelDefinesByProperties"):
+                # RelatedObjects and RelatingPropertyDefinition, the latter a set of definitions in IFC4
+                related_objects, definitions = rel[4], rel[5]
+                for definition in definitions if isinstance(definitions, tuple) else (definitions,):
+                    name = definition[2]
+                    if name and definition.is_a("IfcPropertySetDefinition"):
+                        property_sets.setdefault(name.lower(), []).append(
+                            (definition.id(), tuple(element.id() for element in related_objects))
+                        )
+            self._property_sets = property_sets
+        return self._property_sets
+
+    def occurrence_properties(self, pset: str) -> dict[str, dict[int, list]]:
+        """Values of the properties of a property set by property name and product position.
+
+        pset is matched without case. Values set on an element type apply to
+        its occurrences unless the occurrence sets the same property itself.
+        """
+        occurrence_values: dict[str, dict[int, list]] = {}
+        for definition_id, related_ids in self.property_sets().get(pset.lower(), []):
+            values = property_set_values(self.file.by_id(definition_id))
+            for element_id in related_ids:
+                position = self.positions.get(element_id)
+                if position is not None:
+                    for name, value in values.items():
+                        occurrence_values.setdefault(name, {})[position] = value
+        for element_type, positions in self.typed_occurrences():
+            for definition in getattr(element_type, "HasPropertySets", None) or ():
+                if (definition.Name or "").lower() != pset.lower():
+                    continue
+                for name, value in property_set_values(definition).items():
+                    by_position = occurrence_values.setdefault(name, {})
+                    for position in positions:
+                        by_position.setdefault(position, value)
+        return occurrence_values
+
+    def typed_occurrences(self) -> list[tuple[ifcopenshell.entity_instance, set[int]]]:
+        """Element types with the positions of their occurrences"""
+        if self._occurrences is None:
+            occurrences = {}
+            for rel in self.file.by_type("IfcRelDefinesByType"):
+                positions = occurrences.setdefault(rel.RelatingType.id(), set())
+                for element in rel.RelatedObjects:
+                    position = self.positions.get(element.id())
+                    if position is not None:
+                        positions.add(position)
+            self._occurrences = occurrences
+        return [(self.file.by_id(type_id), positions) for type_id, positions in self._occurrences.items()]
+
+    def type_values(self) -> dict[ValueKey, set[int]]:
+        """Positions by the name of the element type they are an occurrence of"""
+        if self._type_index is None:
+            index = {}
+            for element_type, positions in self.typed_occurrences():
+                key = value_key(element_type.Name)
+                if key is not None and positions:
+                    index.setdefault(key, set()).update(positions)
+            self._type_index = index
+        return self._type_index
+
+    def material_values(self) -> dict[ValueKey, set[int]]:
+        """Positions by the name of their materials, taken from the element type if the occurrence has none"""
+        if self._material_index is None:
+            by_position = self._associations("IfcRelAssociatesMaterial",
+                                             lambda rel: material_names(rel.RelatingMaterial), inherit_if_missing=True)
+            self._material_index = self._invert(by_position)
+        return self._material_index
+
+    def classification_values(self) -> dict[ValueKey, set[int]]:
+        """Positions by the identification and name of the classification references of them or their type"""
+        if self._classification_index is None:
+            def references(rel):
+                reference = rel.RelatingClassification
+                return {value for attribute in ("Identification", "ItemReference", "Name")
+                        for value in [getattr(reference, attribute, None)] if isinstance(value, str) and value}
+            by_position = self._associations("IfcRelAssociatesClassification", references, inherit_if_missing=False)
+            self._classification_index = self._invert(by_position)
+        return self._classification_index
+
+    def _associations(self, rel_class: str, values, inherit_if_missing: bool) -> dict[int, set[str]]:
+        by_position: dict[int, set[str]] = {}
+        by_type: dict[int, set[str]] = {}
+        for rel in self.file.by_type(rel_class):
+            names = values(rel)
+            for element in rel.RelatedObjects:
+                position = self.positions.get(element.id())
+                if position is not None:
+                    by_position.setdefault(position, set()).update(names)
+                elif element.is_a("IfcTypeObject"):
+                    by_type.setdefault(element.id(), set()).update(names)
+        if by_type:
+            for element_type, positions in self.typed_occurrences():
+                names = by_type.get(element_type.id())
+                if not names:
+                    continue
+                for position in positions:
+                    if not inherit_if_missing or position not in by_position:
+                        by_position.setdefault(position, set()).update(names)
+        return by_position
+
+    @staticmethod
+    def _invert(by_position: dict[int, set[str]]) -> dict[ValueKey, set[int]]:
+        index = {}
+        for position, names in by_position.items():
+            for name in names:
+                index.setdefault(value_key(name), set()).add(position)
+        return index
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from typing import NamedTuple, Union
+
+import ifcopenshell
+
+import shared_cache
+from instrumentation import span
+from splitter import Splitter, read_counts
+
+DEFAULT_OUTPUT_DIR = os.environ.get("IFC_OUTPUT_DIR", shared_cache.cache_dir("outputs"))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_OUTPUT_BYTES", 4 * 1024 ** 3))
+DEFAULT_COMPRESSLEVEL = 6
+CHUNK_SIZE = 1024 ** 2
+OUTPUT_FORMATS = {"IFC": ".ifc", "IFCZIP": ".ifczip"}
+SPLIT_SUFFIX = ".zip"
+
+
+class Artifact(NamedTuple):
+    """A filtered model written to disk under the SHA-256 of its IFC text"""
+    key: str
+    path: str
+    size: int
+
+
+class OutputStore:
+    """Filtered models serialized to disk once and shared by the download, the viewer and conversion.
+
+    The model is written straight to a file by IfcOpenShell, so it never
+    exists as a Python string. Identical outputs share one file. IFCZIP
+    copies are compressed from that file a chunk at a time and kept per
+    compression level and member name, once even when several processes ask
+    for the same copy. Zips of split models are kept per model and split
+    the same way. Least recently used files are deleted once the store
+    exceeds budget_bytes, or the shared cache its global budget.
+    """
+
+    def __init__(self, directory: str = DEFAULT_OUTPUT_DIR, budget_bytes: int = DEFAULT_BUDGET_BYTES):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, file: ifcopenshell.file) -> Artifact:
+        tmp_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.tmp.ifc")
+        try:
+            with span("write"):
+                file.write(tmp_path)
+            digest = hashlib.sha256()
+            with open(tmp_path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            key = digest.hexdigest()
+            path = os.path.join(self.directory, f"{key}.ifc")
+            if not shared_cache.touch(path):
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+        return Artifact(key, path, os.path.getsize(path))
+
+    def get(self, key: str) -> Union[Artifact, None]:
+        path = os.path.join(self.directory, f"{key}.ifc")
+        if not shared_cache.touch(path):
+            return None
+        return Artifact(key, path, os.path.getsize(path))
+
+    def zipped(self, artifact: Artifact, member_name: str, compresslevel: int = DEFAULT_COMPRESSLEVEL) -> str:
+        """Path of an IFCZIP holding the artifact as member_name, compressed on first request"""
+        member_key = hashlib.sha256(member_name.encode("utf-8")).hexdigest()[:12]
+        path = os.path.join(self.directory, f"{artifact.key}-{member_key}-z{compresslevel}.ifczip")
+
+        def compress(tmp_path: str) -> None:
+            with span("zip"):
+                with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_ref:
+                    with open(artifact.path, "rb") as source, zip_ref.open(member_name, "w", force_zip64=True) as target:
+                        shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+        if shared_cache.build_once(path, compress):
+            self.evict(keep=path)
+        return path
+
+    def output(self, artifact: Artifact, filename: str, output_format: str = "IFC",
+               compresslevel: int = DEFAULT_COMPRESSLEVEL) -> tuple[str, str]:
+        """Path and download filename of the artifact in output_format, one of OUTPUT_FORMATS"""
+        stem, extension = os.path.splitext(filename)
+        if extension.lower() not in OUTPUT_FORMATS.values():
+            stem = filename
+        if output_format == "IFCZIP":
+            return self.zipped(artifact, f"{stem}.ifc", compresslevel), f"{stem}.ifczip"
+        return artifact.path, f"{stem}.ifc"
+
+    def split(self, model_key: str, splitter: Splitter, stem: str,
+              compresslevel: int = DEFAULT_COMPRESSLEVEL) -> tuple[str, dict[str, int]]:
+        """Path of the zip of splitter's outputs for the model, and the products per file, split on first request"""
+        spec = json.dumps([splitter.split_by, sorted(splitter.stories), stem, compresslevel]).encode("utf-8")
+        path = os.path.join(self.directory, f"{model_key}-split-{hashlib.sha256(spec).hexdigest()[:16]}{SPLIT_SUFFIX}")
+
+        def write(tmp_path: str) -> None:
+            with span("split"):
+                splitter.write_zip(tmp_path, stem, compresslevel)
+
+        if shared_cache.build_once(path, write):
+            self.evict(keep=path)
+        return path, read_counts(path)
+
+    def evict(self, keep: str = "") -> int:
+        with self._lock:
+            freed = shared_cache.evict_least_recently_used(self.directory, self.budget_bytes, keep=keep,
+                                                           suffixes=(*OUTPUT_FORMATS.values(), SPLIT_SUFFIX))
+        return freed + shared_cache.evict(keep=keep)
@@ -0,0 +1,306 @@
+import ifcopenshell
+import ifcopenshell.api
+import ifcopenshell.guid
+import logging
+from typing import Callable, Union
+
+from instrumentation import span
+from keyword_matcher import KeywordMatcher
+from model_index import ModelIndex
+from query import Query
+from subgraph_copy import CopyPlan, SubgraphCopier
+
+# IfcOpenShell removes a copied entity in time proportional to the number of
+# entities copied into the file; removing one costs about as much as copying
+# one entity per REMOVAL_SCAN entities in the output
+REMOVAL_SCAN = 1500
+
+
+class Patcher:
+    def __init__(
+            self,
+            file: ifcopenshell.file,
+            logger: logging.Logger,
+            stories: list[str],
+            keywords: list[str],
+            ifc_product: Union[str, None],
+            filter_option: str,
+            keyword_mode: str = "substring",
+            index: Union[ModelIndex, None] = None,
+            bulk_copy: bool = False,
+            progress: Union[Callable[[int, int], None], None] = None,
+            query: Union[str, None] = None
+    ):
+        """progress is called with the number of elements copied and the number to copy; in bulk copy mode
+        these count every entity of the copied subgraphs. query is the text of a Query, used by the "Query"
+        filter option; it raises QueryError if it does not parse."""
+        self.file = file
+        self.logger = logger
+        self.stories = stories
+        self.keywords = keywords
+        self.ifc_product = ifc_product
+        self.filter_option = filter_option
+        self.matcher = KeywordMatcher(keywords, mode=keyword_mode)
+        self.query = Query(query) if query else None
+        self.index = index
+        self.bulk_copy = bulk_copy
+        self.progress = progress
+
+    def patch(
+            self,
+            elements: Union[list[ifcopenshell.entity_instance], None] = None,
+            shared: Union[CopyPlan, None] = None
+    ):
+        """elements overrides filter_elements; shared is a precomputed copy of common ancestors"""
+        self.source = self.file
+        self.contained_ins: dict[str, set[ifcopenshell.entity_instance]] = {}
+        self.aggregates: dict[str, set[ifcopenshell.entity_instance]] = {}
+        self.containments: dict[str, ifcopenshell.entity_instance] = {}
+        self.decompositions: dict[str, ifcopenshell.entity_instance] = {}
+        self.affected: set[str] = set()
+        self.new = ifcopenshell.file(schema=self.file.schema)
+        self.owner_history = None
+        self.reuse_identities: dict[int, ifcopenshell.entity_instance] = {}
+        self.copied: dict[str, ifcopenshell.entity_instance] = {}
+        self.walked: set[str] = set()
+        self.pending: list[ifcopenshell.entity_instance] = []
+        self.copier = SubgraphCopier(self.file, self.new)
+
+        for owner_history in self.file.by_type("IfcOwnerHistory"):
+            self.owner_history = self.new.add(owner_history)
+            break
+
+        self.add_element(self.file.by_type("IfcProject")[0])
+
+        if shared is not None:
+            copies = self.copier.apply(shared)
+            for root in shared.roots:
+                self.copied[root.GlobalId] = copies[root.id()]
+
+        if elements is None:
+            with span("filter_elements"):
+                elements = self.filter_elements()
+        self.selection = {element.id(): element for element in elements}
+        for n, element in enumerate(elements, 1):
+            self.add_element(element)
+            if self.progress and not self.bulk_copy:
+                self.progress(n, len(elements))
+
+        if self.bulk_copy:
+            with span("copy_pending"):
+                self.copy_pending()
+
+        with span("create_spatial_tree"):
+            self.create_spatial_tree()
+
+        self.file = self.new
+
+    def refilter(
+            self,
+            stories: list[str],
+            keywords: list[str],
+            ifc_product: Union[str, None],
+            filter_option: str,
+            keyword_mode: str = "substring",
+            query: Union[str, None] = None
+    ) -> None:
+        """Change the filter of a bulk copy patch and update its output in place.
+
+        Only elements that entered the selection are copied and only those that
+        left it are removed, with the ancestors and subgraph entities nothing
+        else in the output uses. The containment and aggregation relationships
+        of the affected spatial structures are rewritten.
+        """
+        if not self.bulk_copy:
+            raise ValueError("Incremental filtering needs a bulk copy patch")
+        self.stories = stories
+        self.keywords = keywords
+        self.ifc_product = ifc_product
+        self.filter_option = filter_option
+        self.matcher = KeywordMatcher(keywords, mode=keyword_mode)
+        self.query = Query(query) if query else None
+        # filter_elements reads the source model
+        self.file = self.source
+        try:
+            with span("filter_elements"):
+                selection = {element.id(): element for element in self.filter_elements()}
+        finally:
+            self.file = self.new
+        added = [element for element_id, element in selection.items() if element_id not in self.selection]
+        removed = [element for element_id, element in self.selection.items() if element_id not in selection]
+        if len(added) + len(removed) * max(1.0, len(self.copier.copies) / REMOVAL_SCAN) > len(selection):
+            # Copying the new selection afresh is cheaper than editing the previous output
+            self.file = self.source
+            self.patch(list(selection.values()))
+            return
+        self.selection = selection
+        self.affected = set()
+
+        for element in added:
+            self.add_element(element)
+        with span("copy_pending"):
+            self.copy_pending()
+
+        dropped = []
+        for element in removed:
+            if not self.needed(element):
+                self.drop(element, dropped)
+        for element in dropped:
+            del self.copied[element.GlobalId]
+
+        with span("create_spatial_tree"):
+            self.create_spatial_tree(self.affected)
+
+        with span("remove_unused"):
+            self.copier.remove(dropped, keep=lambda copy: getattr(copy, "GlobalId", None) in self.copied)
+
+    def needed(self, element: ifcopenshell.entity_instance) -> bool:
+        """Whether element is selected or an ancestor of something in the output"""
+        return (element.id() in self.selection or element.GlobalId in self.contained_ins
+                or element.GlobalId in self.aggregates or element.is_a("IfcProject"))
+
+    def drop(self, element: ifcopenshell.entity_instance, dropped: list[ifcopenshell.entity_instance]) -> None:
+        """Take element out of its spatial structures and parents, dropping the ancestors only it needed"""
+        dropped.append(element)
+        self.walked.discard(element.GlobalId)
+        for rel in getattr(element, "ContainedInStructure", []):
+            self.leave(self.contained_ins, rel.RelatingStructure, element, dropped)
+        for rel in getattr(element, "Decomposes", []):
+            self.leave(self.aggregates, rel.RelatingObject, element, dropped)
+
+    def leave(self, groups: dict[str, set[ifcopenshell.entity_instance]], parent: ifcopenshell.entity_instance,
+              element: ifcopenshell.entity_instance, dropped: list[ifcopenshell.entity_instance]) -> None:
+        members = groups.get(parent.GlobalId)
+        if members is None:
+            return
+        members.discard(element)
+        self.affected.add(parent.GlobalId)
+        if not members:
+            del groups[parent.GlobalId]
+            if not self.needed(parent):
+                self.drop(parent, dropped)
+
+    def filter_elements(self):
+        positions = self.filter_positions()
+        return self.index.elements(positions)
+
+    def filter_positions(self) -> set[int]:
+        """Positions in the ModelIndex of the elements the filter selects; nothing is copied"""
+        if self.index is None or self.index.file is not self.file:
+            self.index = ModelIndex.for_file(self.file)
+        positions = self.index.in_storeys(self.stories)
+        if self.filter_option == "IFC Product and Keywords":
+            positions &= self.index.of_class(self.ifc_product)
+            if self.matcher:
+                positions &= self.index.with_keywords(self.matcher)
+        elif self.filter_option == "Keywords Only":
+            positions &= self.index.with_keywords(self.matcher)
+        elif self.filter_option == "Query" and self.query is not None:
+            if positions:
+                positions &= self.query.run(self.index)
+        else:
+            positions = set()
+        return positions
+
+    def add_element(self, element: ifcopenshell.entity_instance) -> None:
+        if not self.append_asset(element):
+            return
+        self.add_spatial_structures(element)
+        self.add_decomposition_parents(element)
+
+    def append_asset(self, element: ifcopenshell.entity_instance) -> Union[ifcopenshell.entity_instance, None]:
+        """In bulk copy mode the copy is deferred to copy_pending and element stands in for it"""
+        new_element = self.copied.get(element.GlobalId)
+        if new_element is not None:
+            return new_element
+        with span("append_asset", memory=False):
+            new_element = self._append_asset(element)
+        if new_element:
+            self.copied[element.GlobalId] = new_element
+        return new_element
+
+    def _append_asset(self, element: ifcopenshell.entity_instance) -> Union[ifcopenshell.entity_instance, None]:
+        if element.is_a("IfcProject"):
+            new_element = self.new.add(element)
+        elif self.bulk_copy:
+            self.pending.append(element)
+            new_element = element
+        else:
+            new_element = ifcopenshell.api.run(
+                "project.append_asset",
+                self.new,
+                library=self.file,
+                element=element,
+                reuse_identities=self.reuse_identities
+            )
+        return new_element
+
+    def copy_pending(self) -> None:
+        copies = self.copier.copy(self.pending, progress=self.progress)
+        for element in self.pending:
+            self.copied[element.GlobalId] = copies[element.id()]
+        self.pending = []
+
+    def add_spatial_structures(self, element: ifcopenshell.entity_instance) -> None:
+        """element is IfcElement"""
+        for rel in getattr(element, "ContainedInStructure", []):
+            spatial_element = rel.RelatingStructure
+            self.append_asset(spatial_element)
+            self.contained_ins.setdefault(spatial_element.GlobalId, set()).add(element)
+            self.affected.add(spatial_element.GlobalId)
+            self.add_ancestors(spatial_element)
+
+    def add_decomposition_parents(self, element: ifcopenshell.entity_instance) -> None:
+        """element is IfcObjectDefinition"""
+        for rel in getattr(element, "Decomposes", []):
+            parent = rel.RelatingObject
+            self.append_asset(parent)
+            self.aggregates.setdefault(parent.GlobalId, set()).add(element)
+            self.affected.add(parent.GlobalId)
+            self.add_ancestors(parent)
+
+    def add_ancestors(self, element: ifcopenshell.entity_instance) -> None:
+        """element is a spatial or decomposition ancestor, walked up at most once per patch"""
+        if element.GlobalId in self.walked:
+            return
+        self.walked.add(element.GlobalId)
+        self.add_decomposition_parents(element)
+        self.add_spatial_structures(element)
+
+    def create_spatial_tree(self, affected: Union[set[str], None] = None) -> None:
+        """Create the containment and aggregation relationships, or with affected only update those of the
+        given relating objects"""
+        for relating_structure_guid in self.contained_ins if affected is None else affected:
+            related_elements = [self.copied[element.GlobalId]
+                                for element in self.contained_ins.get(relating_structure_guid, ())]
+            rel = self.containments.get(relating_structure_guid)
+            if rel is None and related_elements:
+                self.containments[relating_structure_guid] = self.new.createIfcRelContainedInSpatialStructure(
+                    ifcopenshell.guid.new(),
+                    self.owner_history,
+                    None,
+                    None,
+                    related_elements,
+                    self.copied[relating_structure_guid],
+                )
+            elif related_elements:
+                rel.RelatedElements = related_elements
+            elif rel is not None:
+                self.new.remove(self.containments.pop(relating_structure_guid))
+        for relating_object_guid in self.aggregates if affected is None else affected:
+            related_objects = [self.copied[element.GlobalId]
+                               for element in self.aggregates.get(relating_object_guid, ())]
+            rel = self.decompositions.get(relating_object_guid)
+            if rel is None and related_objects:
+                self.decompositions[relating_object_guid] = self.new.createIfcRelAggregates(
+                    ifcopenshell.guid.new(),
+                    self.owner_history,
+                    None,
+                    None,
+                    self.copied[relating_object_guid],
+                    related_objects,
+                )
+            elif related_objects:
+                rel.RelatedObjects = related_objects
+            elif rel is not None:
+                self.new.remove(self.decompositions.pop(relating_object_guid))
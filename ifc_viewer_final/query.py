@@ -0,0 +1,343 @@
+import re
+from typing import NamedTuple, Union
+
+from model_index import ModelIndex, ValueKey, value_key
+
+FIELDS = ("class", "storey", "name", "type", "material", "classification")
+TOKEN = re.compile(r"""\s*(?:(?P<paren>[()])|(?P<op>!=|<=|>=|[=~<>])|"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<word>[^\s()=!~<>"]+))""")
+NUMBER = re.compile(r"^[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?$")
+
+
+class QueryError(ValueError):
+    """Raised for a query that cannot be parsed or uses an operator a field does not support"""
+
+
+class Predicate(NamedTuple):
+    """A test of one field; operator and value are None when it only asks whether the field is set"""
+    field: str
+    pset: Union[str, None]
+    operator: Union[str, None]
+    value: Union[str, None]
+    quoted: bool
+
+    def __str__(self) -> str:
+        field = f"{self.pset}.{self.field}" if self.pset else self.field
+        if self.operator is None:
+            return field
+        value = f'"{self.value}"' if self.quoted else self.value
+        return f"{field} {self.operator} {value}"
+
+
+class And(NamedTuple):
+    operands: tuple
+
+
+class Or(NamedTuple):
+    operands: tuple
+
+
+class Not(NamedTuple):
+    operand: Union[Predicate, And, Or, "Not"]
+
+
+Node = Union[Predicate, And, Or, Not]
+
+
+def tokenize(text: str) -> list[tuple[str, str]]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise QueryError(f"Unexpected {text[position:].strip()[:20]!r} at position {position}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "quoted":
+            value = re.sub(r"\\(.)", r"\1", value)
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """Recursive descent over the tokens: or binds loosest, then and, then not"""
+
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def parse(self) -> Node:
+        if not self.tokens:
+            raise QueryError("The query is empty")
+        node = self.parse_or()
+        if self.position < len(self.tokens):
+            raise QueryError(f"Unexpected {self.tokens[self.position][1]!r}, expected 'and', 'or' or ')'")
+        return node
+
+    def peek(self) -> Union[tuple[str, str], None]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def keyword(self, word: str) -> bool:
+        token = self.peek()
+        if token is not None and token[0] == "word" and token[1].lower() == word:
+            self.position += 1
+            return True
+        return False
+
+    def parse_or(self) -> Node:
+        operands = [self.parse_and()]
+        while self.keyword("or"):
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(tuple(operands))
+
+    def parse_and(self) -> Node:
+        operands = [self.parse_not()]
+        while self.keyword("and"):
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else And(tuple(operands))
+
+    def parse_not(self) -> Node:
+        if self.keyword("not"):
+            return Not(self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self) -> Node:
+        token = self.peek()
+        if token is None:
+            raise QueryError("The query ends where a condition was expected")
+        self.position += 1
+        if token == ("paren", "("):
+            node = self.parse_or()
+            if self.peek() != ("paren", ")"):
+                raise QueryError("Missing ')'")
+            self.position += 1
+            return node
+        if token[0] not in ("word", "quoted"):
+            raise QueryError(f"Unexpected {token[1]!r} where a condition was expected")
+        field, pset = self.field(token)
+
+        operator = self.peek()
+        if operator is None or operator[0] != "op":
+            if pset is None and token[0] == "word" and token[1].lower().startswith("ifc"):
+                # A bare IFC class name
+                return Predicate("class", None, "=", token[1], False)
+            return self.checked(Predicate(field, pset, None, None, False))
+        self.position += 1
+        value = self.peek()
+        if value is None or value[0] not in ("word", "quoted"):
+            raise QueryError(f"Expected a value after {operator[1]!r}")
+        self.position += 1
+        return self.checked(Predicate(field, pset, operator[1], value[1], value[0] == "quoted"))
+
+    @staticmethod
+    def checked(predicate: Predicate) -> Predicate:
+        """The predicate, if its field supports its operator and value"""
+        if predicate.pset is None and predicate.field == "class" and predicate.operator not in ("=", "!="):
+            raise QueryError(f"class supports only = and !=, not {predicate.operator or 'a bare field'}")
+        if predicate.operator in ("<", "<=", ">", ">=") and not NUMBER.match(predicate.value):
+            raise QueryError(f"{predicate.operator} compares numbers, got {predicate.value!r}")
+        return predicate
+
+    @staticmethod
+    def field(token: tuple[str, str]) -> tuple[str, Union[str, None]]:
+        """Field name and property set of a condition"""
+        text = token[1]
+        if "." in text:
+            pset, _, prop = text.rpartition(".")
+            if not pset or not prop:
+                raise QueryError(f"Expected PropertySet.Property, got {text!r}")
+            return prop, pset
+        if text.lower() in FIELDS:
+            return text.lower(), None
+        return text, None
+
+
+def parse(text: str) -> Node:
+    return Parser(text).parse()
+
+
+class Query:
+    """A filter over the products of a model, such as
+
+        IfcWall and Pset_WallCommon.FireRating = "EI60" and not storey = "Level 0"
+
+    Conditions are ``field operator value`` joined with and, or, not and
+    parentheses. Fields are class, storey, name, type (the name of the element
+    type), material, classification (identification or name of a reference),
+    PropertySet.Property for properties and quantities, or any other direct
+    attribute such as PredefinedType or Tag. A bare IFC class name tests the
+    class; a field without operator tests that it is set. Operators are =, !=,
+    ~ (contains) and <, <=, >, >= for numbers. Text compares without case, and
+    != only matches elements that have the field.
+
+    Each condition is answered from an inverted index of the ModelIndex, which
+    is built on first use and kept. Conditions joined by and are evaluated
+    cheapest first, ones whose index exists already before ones that need a
+    new index, and stop as soon as the result is empty.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tree = parse(text)
+
+    def run(self, index: ModelIndex) -> set[int]:
+        """Positions of the products in index that match"""
+        return evaluate(self.tree, index)
+
+    def explain(self, index: ModelIndex) -> list[str]:
+        """Plan of the query against index, one line per step, as run() would evaluate it without running it"""
+        lines = []
+        describe(self.tree, index, lines, 0)
+        return lines
+
+
+def predicate_cost(predicate: Predicate, index: ModelIndex) -> int:
+    """Rough order of the work a condition takes: 0 for the indexes built up front, 1 for cached ones,
+    2 and above for those that need a new index"""
+    field = predicate.field
+    if predicate.pset is not None:
+        return 1 if index.built("property", predicate.pset) else 3
+    if field in ("class", "storey"):
+        return 0
+    if field == "name":
+        return 1 if index.built("attribute", "Name") else 2
+    if field in ("type", "material", "classification"):
+        return 1 if index.built(field) else 3
+    return 1 if index.built("attribute", field) else 2
+
+
+def node_cost(node: Node, index: ModelIndex) -> int:
+    if isinstance(node, Predicate):
+        return predicate_cost(node, index)
+    if isinstance(node, Not):
+        return node_cost(node.operand, index)
+    return max(node_cost(operand, index) for operand in node.operands)
+
+
+def plan(node: And, index: ModelIndex) -> tuple[list[Node], list[Node]]:
+    """Operands of an and, split into those that select and those that exclude, each cheapest first"""
+    included = [operand for operand in node.operands if not isinstance(operand, Not)]
+    excluded = [operand.operand for operand in node.operands if isinstance(operand, Not)]
+    return (sorted(included, key=lambda operand: node_cost(operand, index)),
+            sorted(excluded, key=lambda operand: node_cost(operand, index)))
+
+
+def evaluate(node: Node, index: ModelIndex) -> set[int]:
+    if isinstance(node, Predicate):
+        return lookup(node, index)
+    if isinstance(node, Not):
+        return index.all - evaluate(node.operand, index)
+    if isinstance(node, Or):
+        result = set()
+        for operand in node.operands:
+            result |= evaluate(operand, index)
+        return result
+    included, excluded = plan(node, index)
+    result = None
+    for operand in included:
+        matched = evaluate(operand, index)
+        result = matched if result is None else result & matched
+        if not result:
+            return set()
+    if result is None:
+        result = index.all
+    for operand in excluded:
+        result -= evaluate(operand, index)
+        if not result:
+            break
+    return result
+
+
+def describe(node: Node, index: ModelIndex, lines: list[str], depth: int) -> None:
+    indent = "  " * depth
+    if isinstance(node, Predicate):
+        cost = predicate_cost(node, index)
+        source = "built up front" if cost == 0 else "cached index" if cost == 1 else "builds an index"
+        lines.append(f"{indent}{node}  ({source})")
+    elif isinstance(node, Not):
+        lines.append(f"{indent}all products except")
+        describe(node.operand, index, lines, depth + 1)
+    elif isinstance(node, Or):
+        lines.append(f"{indent}union of")
+        for operand in node.operands:
+            describe(operand, index, lines, depth + 1)
+    else:
+        included, excluded = plan(node, index)
+        lines.append(f"{indent}intersection of, stopping once empty" if included else f"{indent}all products")
+        for operand in included:
+            describe(operand, index, lines, depth + 1)
+        if excluded:
+            lines.append(f"{indent}minus")
+            for operand in excluded:
+                describe(operand, index, lines, depth + 1)
+
+
+def literal(predicate: Predicate) -> list[ValueKey]:
+    """Index keys the value of a condition can stand for; an unquoted number also matches as text"""
+    text = predicate.value
+    if predicate.quoted:
+        return [value_key(text)]
+    keys = [value_key(text)]
+    if NUMBER.match(text):
+        keys.insert(0, value_key(float(text)))
+    elif text.lower() in ("true", "false"):
+        keys.insert(0, value_key(text.lower() == "true"))
+    return keys
+
+
+def lookup(predicate: Predicate, index: ModelIndex) -> set[int]:
+    field = predicate.field
+    if predicate.pset is None and field == "class":
+        matched = set(index.of_class(predicate.value))
+        return matched if predicate.operator == "=" else index.all - matched
+    if predicate.pset is not None:
+        values = index.property_values(predicate.pset, field)
+    elif field == "storey":
+        values = {}
+        for storey, positions in index.by_storey.items():
+            key = value_key(storey)
+            if key is not None:
+                values.setdefault(key, set()).update(positions)
+    elif field == "name":
+        values = index.attribute_values("Name")
+    elif field == "type":
+        values = index.type_values()
+    elif field == "material":
+        values = index.material_values()
+    elif field == "classification":
+        values = index.classification_values()
+    else:
+        values = index.attribute_values(field)
+    return match(values, predicate)
+
+
+def match(values: dict[ValueKey, set[int]], predicate: Predicate) -> set[int]:
+    operator = predicate.operator
+    result = set()
+    if operator is None:
+        for positions in values.values():
+            result |= positions
+        return result
+    if operator in ("=", "!="):
+        keys = set(literal(predicate))
+        for key, positions in values.items():
+            if (key in keys) == (operator == "="):
+                result |= positions
+        if operator == "!=":
+            # An element with several values, such as a list property, must have none that is equal
+            for key in keys:
+                result -= values.get(key, set())
+        return result
+    if operator == "~":
+        needle = predicate.value.strip().lower()
+        for (kind, value), positions in values.items():
+            if kind == "s" and needle in value:
+                result |= positions
+        return result
+    bound = float(predicate.value)
+    compare = {"<": float.__lt__, "<=": float.__le__, ">": float.__gt__, ">=": float.__ge__}[operator]
+    for (kind, value), positions in values.items():
+        if kind == "n" and compare(value, bound):
+            result |= positions
+    return result
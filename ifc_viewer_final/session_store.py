@@ -0,0 +1,181 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import BinaryIO, NamedTuple, Union
+
+from shared_cache import evict_least_recently_used
+
+DEFAULT_SESSION_DIR = os.environ.get("IFC_SESSION_DIR", os.path.join(tempfile.gettempdir(), "ifc_sessions"))
+DEFAULT_MEMORY_BUDGET_BYTES = int(os.environ.get("IFC_SESSION_MEMORY_BYTES", 256 * 1024 ** 2))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_SESSION_BYTES", 2 * 1024 ** 3))
+DEFAULT_TTL_SECONDS = int(os.environ.get("IFC_SESSION_TTL_SECONDS", 3600))
+
+
+class Session(NamedTuple):
+    """Handles of one browser session, by name, and when it was last seen"""
+    handles: dict[str, str]
+    last_seen: float
+
+
+class SessionStore:
+    """Payloads of every session in the process, referenced from st.session_state only by content key.
+
+    Payloads are held in memory until their summed size exceeds
+    memory_budget_bytes, then the least recently used are spilled to directory
+    as <key>.payload and read from there. Handles can also name things held
+    elsewhere, such as the key of a parsed model, so that expire() can tell
+    which of them no session uses any more. Sessions not seen for ttl_seconds
+    are dropped, together with the payloads only they referenced.
+    """
+
+    def __init__(self, directory: str = DEFAULT_SESSION_DIR, memory_budget_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES,
+                 budget_bytes: int = DEFAULT_BUDGET_BYTES, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self.directory = directory
+        self.memory_budget_bytes = memory_budget_bytes
+        self.budget_bytes = budget_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sessions: dict[str, Session] = {}
+        self.payloads: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_bytes = 0
+        self.spills = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.payload")
+
+    def touch(self, session_id: str) -> None:
+        with self._lock:
+            session = self.sessions.get(session_id)
+            self.sessions[session_id] = Session(session.handles if session else {}, time.time())
+
+    def bind(self, session_id: str, name: str, key: Union[str, None]) -> set[str]:
+        """Point the session's handle name at key, or remove it when key is None.
+
+        Returns the previous key if no session references it any more.
+        """
+        with self._lock:
+            session = self.sessions.get(session_id)
+            handles = session.handles if session else {}
+            previous = handles.pop(name, None)
+            if key is not None:
+                handles[name] = key
+            self.sessions[session_id] = Session(handles, time.time())
+            return self._release({previous} - {None, key})
+
+    def handle(self, session_id: str, name: str) -> Union[str, None]:
+        with self._lock:
+            session = self.sessions.get(session_id)
+            return session.handles.get(name) if session else None
+
+    def keys(self, name: str) -> set[str]:
+        """Keys the handle name of any session points at"""
+        with self._lock:
+            return {session.handles[name] for session in self.sessions.values() if name in session.handles}
+
+    def put(self, session_id: str, name: str, data: bytes) -> str:
+        """Store data as the session's payload name and return its key"""
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if key in self.payloads:
+                self.payloads.move_to_end(key)
+            elif os.path.exists(self.path(key)):
+                os.utime(self.path(key))
+            else:
+                self.payloads[key] = data
+                self.memory_bytes += len(data)
+                self._spill()
+        self.bind(session_id, name, key)
+        return key
+
+    def _spill(self) -> None:
+        while self.payloads and self.memory_bytes > self.memory_budget_bytes:
+            key, data = self.payloads.popitem(last=False)
+            self.memory_bytes -= len(data)
+            path = self.path(key)
+            tmp_path = os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp.payload")
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self.spills += 1
+            evict_least_recently_used(self.directory, self.budget_bytes, keep=path, suffixes=(".payload",))
+
+    def open(self, session_id: str, name: str) -> Union[BinaryIO, None]:
+        """The session's payload name for reading, or None if it has none or it was evicted from disk"""
+        key = self.handle(session_id, name)
+        if key is None:
+            return None
+        with self._lock:
+            data = self.payloads.get(key)
+            if data is not None:
+                self.payloads.move_to_end(key)
+                return io.BytesIO(data)
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(self.path(key))
+        return f
+
+    def drop(self, session_id: str) -> set[str]:
+        """Forget a session, returning the keys no remaining session references"""
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+            return self._release(set(session.handles.values()) if session else set())
+
+    def expire(self) -> set[str]:
+        """Drop sessions idle for longer than ttl_seconds, returning the keys no remaining session references"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            idle = [session_id for session_id, session in self.sessions.items() if session.last_seen < cutoff]
+            keys = set()
+            for session_id in idle:
+                keys.update(self.sessions.pop(session_id).handles.values())
+            self.expired += len(idle)
+            return self._release(keys)
+
+    def _release(self, keys: set[str]) -> set[str]:
+        referenced = {key for session in self.sessions.values() for key in session.handles.values()}
+        released = keys - referenced
+        for key in released:
+            data = self.payloads.pop(key, None)
+            if data is not None:
+                self.memory_bytes -= len(data)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+        return released
+
+    def usage(self) -> dict[str, int]:
+        with self._lock:
+            disk_bytes = 0
+            disk_payloads = 0
+            for name in os.listdir(self.directory):
+                if name.endswith(".payload") and ".tmp." not in name:
+                    try:
+                        disk_bytes += os.path.getsize(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        continue
+                    disk_payloads += 1
+            return {
+                "sessions": len(self.sessions),
+                "memory_payloads": len(self.payloads),
+                "memory_bytes": self.memory_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "disk_payloads": disk_payloads,
+                "disk_bytes": disk_bytes,
+                "budget_bytes": self.budget_bytes,
+                "spills": self.spills,
+                "expired_sessions": self.expired,
+            }
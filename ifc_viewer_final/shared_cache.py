@@ -0,0 +1,249 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Collection, Iterator, Sequence, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows; locks then only hold within one process
+    fcntl = None
+
+# Shared by the app and worker processes of one host. Locks are fcntl.flock locks, which are not reliable on
+# network filesystems such as NFS, so the directory has to be on a local filesystem.
+CACHE_ROOT = os.environ.get("IFC_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ifc_cache"))
+DEFAULT_BUDGET_BYTES = int(os.environ.get("IFC_CACHE_BYTES", 16 * 1024 ** 3))
+LOCK_DIR = ".locks"
+# Entries used more recently are not evicted, so a path build_once or a lookup just returned stays while it is opened
+MIN_AGE_SECONDS = float(os.environ.get("IFC_CACHE_MIN_AGE_SECONDS", 60))
+
+_process_locks: dict[str, threading.Lock] = {}
+_process_locks_guard = threading.Lock()
+
+
+def cache_dir(kind: str) -> str:
+    """Directory of one kind of artifact in the cache shared by every app and worker process"""
+    return os.path.join(CACHE_ROOT, kind)
+
+
+def lock_path(directory: str, name: str) -> str:
+    locks = os.path.join(directory, LOCK_DIR)
+    os.makedirs(locks, exist_ok=True)
+    return os.path.join(locks, f"{name}.lock")
+
+
+def touch(path: str) -> bool:
+    """Mark the entry at path as just used; False if it does not exist, or no longer does"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def locked(directory: str, name: str, blocking: bool = True) -> Iterator[bool]:
+    """Hold the lock called name in directory against other threads and processes.
+
+    Yields whether the lock was acquired, which is always True when blocking.
+    If the holder removed the lock file with remove_lock() while this call
+    waited, the lock is taken again on the file now at its path.
+    """
+    path = lock_path(directory, name)
+    with _process_locks_guard:
+        process_lock = _process_locks.setdefault(path, threading.Lock())
+    if not process_lock.acquire(blocking):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        while True:
+            f = open(lock_path(directory, name), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and os.path.samestat(os.fstat(f.fileno()), current):
+                break
+            # Locked a file that was removed meanwhile; closing it releases the lock
+            f.close()
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+    finally:
+        process_lock.release()
+
+
+def remove_lock(directory: str, name: str) -> None:
+    """Delete the lock file of name in directory, which the caller holds through locked()"""
+    path = os.path.join(directory, LOCK_DIR, f"{name}.lock")
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    if fcntl is not None:
+        # Without flock the process lock is all there is, so it has to stay for threads waiting on it
+        with _process_locks_guard:
+            _process_locks.pop(path, None)
+
+
+def remove_stale_locks(directory: str) -> int:
+    """Delete the lock files in directory whose entry no longer exists and that nobody holds, returning how many"""
+    locks = os.path.join(directory, LOCK_DIR)
+    removed = 0
+    for lock_name in os.listdir(locks) if os.path.isdir(locks) else ():
+        name = lock_name[:-len(".lock")]
+        if not lock_name.endswith(".lock") or os.path.exists(os.path.join(directory, name)):
+            continue
+        with locked(directory, name, blocking=False) as idle:
+            if idle and not os.path.exists(os.path.join(directory, name)):
+                remove_lock(directory, name)
+                removed += 1
+    return removed
+
+
+def build_once(path: str, build: Callable[[str], None]) -> bool:
+    """Create path by calling build(tmp_path) and renaming the result into place, unless it exists.
+
+    path may be a file or a directory. Concurrent callers for the same path,
+    in this or any other process sharing the directory, wait for the first
+    one instead of repeating its work. Returns whether this call built it.
+    Either way the entry was just used, so evict() leaves it for
+    MIN_AGE_SECONDS.
+    """
+    if touch(path):
+        return False
+    directory, name = os.path.split(path)
+    with locked(directory, name):
+        if touch(path):
+            return False
+        stem, suffix = os.path.splitext(name)
+        # Keeps the suffix, which some writers insist on, and ".tmp." so eviction leaves it alone
+        tmp_path = os.path.join(directory, f"{stem}.{uuid.uuid4().hex}.tmp{suffix}")
+        try:
+            build(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return True
+
+
+def entry_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def evict_least_recently_used(directory: str, budget_bytes: int, keep: str = "", suffixes: Sequence[str] = (),
+                              min_age_seconds: float = MIN_AGE_SECONDS,
+                              in_use: Collection[str] = ()) -> int:
+    """Delete the least recently modified files with the given suffixes until directory fits in budget_bytes.
+
+    Files still being written (containing ".tmp."), files modified in the last min_age_seconds, the path keep and
+    the paths in_use are left alone. Returns the bytes freed.
+    """
+    cutoff = time.time() - min_age_seconds
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(tuple(suffixes)) and ".tmp." not in name:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for mtime, size, path in sorted(entries):
+        if total - freed <= budget_bytes:
+            break
+        if path == keep or path in in_use or mtime > cutoff:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        freed += size
+    return freed
+
+
+def evict(root: str = CACHE_ROOT, budget_bytes: int = DEFAULT_BUDGET_BYTES, keep: str = "",
+          min_age_seconds: float = MIN_AGE_SECONDS) -> int:
+    """Delete the least recently used entries of every kind under root until it fits in budget_bytes.
+
+    Entries are the files and directories directly inside each kind's
+    directory. Entries being written, entries whose build lock another
+    process holds, entries used in the last min_age_seconds and the path keep
+    are left alone. The lock files of deleted entries are deleted too, also
+    of those other stores evicted themselves. Only one process evicts at a
+    time; the others skip. Returns the bytes freed.
+    """
+    freed = 0
+    cutoff = time.time() - min_age_seconds
+    with locked(root, "evict", blocking=False) as acquired:
+        if not acquired:
+            return 0
+        entries = []
+        for kind in os.listdir(root):
+            directory = os.path.join(root, kind)
+            if kind == LOCK_DIR or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name == LOCK_DIR or ".tmp" in name:
+                    continue
+                try:
+                    entries.append((os.stat(path).st_mtime, entry_size(path), path))
+                except FileNotFoundError:
+                    continue
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total - freed <= budget_bytes:
+                break
+            if path == keep or mtime > cutoff:
+                continue
+            directory, name = os.path.split(path)
+            with locked(directory, name, blocking=False) as idle:
+                if not idle:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                remove_lock(directory, name)
+            freed += size
+        for kind in os.listdir(root):
+            if kind != LOCK_DIR and os.path.isdir(os.path.join(root, kind)):
+                remove_stale_locks(os.path.join(root, kind))
+    return freed
+
+
+def usage(root: str = CACHE_ROOT) -> dict[str, Union[int, dict[str, int]]]:
+    """Bytes per kind and in total"""
+    kinds = {}
+    for kind in sorted(os.listdir(root)) if os.path.isdir(root) else ():
+        directory = os.path.join(root, kind)
+        if kind == LOCK_DIR or not os.path.isdir(directory):
+            continue
+        size = 0
+        for name in os.listdir(directory):
+            if name != LOCK_DIR and ".tmp" not in name:
+                with contextlib.suppress(FileNotFoundError):
+                    size += entry_size(os.path.join(directory, name))
+        kinds[kind] = size
+    return {"bytes": sum(kinds.values()), "budget_bytes": DEFAULT_BUDGET_BYTES, "kinds": kinds}
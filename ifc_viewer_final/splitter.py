@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import zipfile
+from typing import BinaryIO, Iterator, Union
+
+import ifcopenshell
+
+from model_index import ModelIndex
+from patcher import Patcher
+from subgraph_copy import SubgraphCopier
+
+SPLIT_OPTIONS = {"By Storey": "storey", "By IFC Class": "class"}
+UNSAFE_FILENAME_CHARACTERS = re.compile(r"[^\w.-]+")
+
+
+class Splitter:
+    """Splits a model into one filtered model per storey or per IFC class.
+
+    The model is parsed and indexed once. Spatial ancestors common to every
+    output (project, site, building) are traversed once and the resulting copy
+    plan is applied to each output, so the cost is close to a single filter run.
+    """
+
+    def __init__(
+            self,
+            file: ifcopenshell.file,
+            logger: logging.Logger,
+            split_by: str = "storey",
+            stories: Union[list[str], None] = None,
+            index: Union[ModelIndex, None] = None
+    ):
+        if split_by not in SPLIT_OPTIONS.values():
+            raise ValueError(f"Cannot split by {split_by!r}")
+        self.file = file
+        self.logger = logger
+        self.split_by = split_by
+        self.index = index or ModelIndex.for_file(file)
+        self.stories = stories or sorted({s.Name for s in file.by_type("IfcBuildingStorey") if s.Name})
+
+    def partitions(self) -> dict[str, list[ifcopenshell.entity_instance]]:
+        """Products per output, keeping only products contained in the selected storeys"""
+        partitions = {}
+        if self.split_by == "storey":
+            for storey in self.stories:
+                partitions[storey] = self.index.elements(self.index.in_storeys([storey]))
+        else:
+            contained = self.index.in_storeys(self.stories)
+            for ifc_class in self.index.classes():
+                if self.index.product(next(iter(self.index.by_class[ifc_class]))).is_a("IfcSpatialStructureElement"):
+                    continue
+                partitions[ifc_class] = self.index.elements(self.index.by_class[ifc_class] & contained)
+        return {label: elements for label, elements in partitions.items() if elements}
+
+    def ancestors(self, element: ifcopenshell.entity_instance, memo: dict) -> frozenset:
+        if element.id() not in memo:
+            result = set()
+            for rel in getattr(element, "ContainedInStructure", []):
+                result.add(rel.RelatingStructure)
+                result |= self.ancestors(rel.RelatingStructure, memo)
+            for rel in getattr(element, "Decomposes", []):
+                result.add(rel.RelatingObject)
+                result |= self.ancestors(rel.RelatingObject, memo)
+            memo[element.id()] = frozenset(result)
+        return memo[element.id()]
+
+    def shared_ancestors(self, partitions: dict[str, list[ifcopenshell.entity_instance]]) -> list:
+        memo = {}
+        shared = None
+        for elements in partitions.values():
+            ancestors = set()
+            for element in elements:
+                ancestors |= self.ancestors(element, memo)
+            shared = ancestors if shared is None else shared & ancestors
+        return sorted((e for e in shared or () if not e.is_a("IfcProject")), key=lambda e: e.id())
+
+    def split(self) -> Iterator[tuple[str, ifcopenshell.file]]:
+        partitions = self.partitions()
+        shared = SubgraphCopier(self.file, None).plan(self.shared_ancestors(partitions))
+        for label, elements in partitions.items():
+            patcher = Patcher(self.file, self.logger, self.stories, [], None, "", index=self.index, bulk_copy=True)
+            patcher.patch(elements=elements, shared=shared)
+            self.logger.info("Split %s: %d elements", label, len(elements))
+            yield label, patcher.file
+
+    def write_zip(self, output: Union[str, BinaryIO], stem: str, compresslevel: int = 6) -> dict[str, int]:
+        """Write each output into one zip as soon as it is built, returning products per file.
+
+        Each model is written to a temporary file next to output, when that
+        is a path, and compressed from there, so neither the IFC text nor
+        the zip is held in memory. The counts are also stored as the zip's
+        comment, for read_counts().
+        """
+        counts = {}
+        directory = os.path.dirname(os.path.abspath(output)) if isinstance(output, str) else None
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_ref, \
+                tempfile.TemporaryDirectory(dir=directory, prefix=".tmp.split-") as tmp_dir:
+            for label, new in self.split():
+                filename = base = f"{stem}_{UNSAFE_FILENAME_CHARACTERS.sub('_', label)}"
+                n = 1
+                while filename + ".ifc" in counts:
+                    n += 1
+                    filename = f"{base}_{n}"
+                filename += ".ifc"
+                tmp_path = os.path.join(tmp_dir, "model.ifc")
+                new.write(tmp_path)
+                zip_ref.write(tmp_path, filename)
+                os.remove(tmp_path)
+                counts[filename] = len(new.by_type("IfcProduct"))
+            zip_ref.comment = json.dumps(counts).encode("utf-8")
+        return counts
+
+
+def read_counts(path: str) -> dict[str, int]:
+    """Products per file of a zip written by Splitter.write_zip"""
+    with zipfile.ZipFile(path) as zip_ref:
+        return json.loads(zip_ref.comment or b"{}")
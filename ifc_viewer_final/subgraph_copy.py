@@ -0,0 +1,306 @@
+from collections import deque
+from typing import Callable, Iterable, NamedTuple, Union
+
+import ifcopenshell
+import ifcopenshell.util.element
+
+# Aggregate attributes through which a relationship fans out to objects that
+# may not be part of the copied selection
+FAN_OUT_ATTRIBUTES = ("RelatedObjects", "RelatedResourceObjects")
+
+# A copy referred to by more entities than this is taken to be in use without
+# listing them, since shared entities like the owner history have thousands
+MAX_UNUSED_INVERSES = 32
+
+
+class CopyPlan(NamedTuple):
+    """Result of the traversal for a set of roots, which can be applied to several target files"""
+    roots: list[ifcopenshell.entity_instance]
+    entities: list[ifcopenshell.entity_instance]
+    relationships: list[ifcopenshell.entity_instance]
+
+
+class SubgraphCopier:
+    """Copies many elements from source into target in a single traversal.
+
+    This produces the same content as calling ``project.append_asset`` per
+    element: the forward reference closure of each element, its type, and the
+    inverse relationships append_asset whitelists (property sets, material and
+    classification associations, openings, nested ports, styles). Each entity
+    is visited once for the whole selection and added to target leaves first,
+    so every ``target.add`` call copies exactly one entity. Relationships are
+    recreated with their RelatedObjects restricted to what was copied.
+
+    The copier can be reused; later calls extend relationships copied earlier
+    and remove() takes copies out again. target may be None for a copier that
+    only makes plans.
+    """
+
+    def __init__(self, source: ifcopenshell.file, target: Union[ifcopenshell.file, None]):
+        self.source = source
+        self.target = target
+        self.copies: dict[int, ifcopenshell.entity_instance] = {}
+        self.sources: dict[int, int] = {}
+        self.relationships: dict[int, ifcopenshell.entity_instance] = {}
+        self.relationship_copies: dict[int, ifcopenshell.entity_instance] = {}
+        self.relationship_sources: dict[int, int] = {}
+        # Relationships met by the current traversal, which are the only ones a copy can extend
+        self.encountered: dict[int, ifcopenshell.entity_instance] = {}
+        material_class = "IfcMaterial" if source.schema == "IFC2X3" else "IfcMaterialDefinition"
+        self.inverse_attributes: dict[str, list[str]] = {
+            "IfcObjectDefinition": ["HasAssociations"],
+            "IfcObject": ["IsDefinedBy.IfcRelDefinesByProperties"],
+            "IfcElement": ["HasOpenings"],
+            "IfcDistributionElement": ["IsNestedBy"],
+            "IfcDistributionElementType": ["IsNestedBy"],
+            material_class: ["HasExternalReferences", "HasProperties", "HasRepresentation"],
+            "IfcRepresentationItem": ["StyledByItem"],
+        }
+        self._inverse_attributes_by_class: dict[str, list[tuple[str, str]]] = {}
+
+    def copy(
+            self,
+            elements: Iterable[ifcopenshell.entity_instance],
+            progress: Union[Callable[[int, int], None], None] = None
+    ) -> dict[int, ifcopenshell.entity_instance]:
+        """Copy elements with their subgraphs, returning source id -> copy for everything copied.
+
+        progress is called every thousand entities with the number copied and the number to copy.
+        """
+        self.encountered = {}
+        entities = self.closure(elements)
+        for n, entity in enumerate(entities, 1):
+            copy = self.copies[entity.id()] = self.target.add(entity)
+            self.sources[copy.id()] = entity.id()
+            if progress and n % 1000 == 0:
+                progress(n, len(entities))
+        if progress:
+            progress(len(entities), len(entities))
+        for relationship in self.encountered.values():
+            self.extend_relationship(relationship)
+        return self.copies
+
+    def plan(self, elements: Iterable[ifcopenshell.entity_instance]) -> CopyPlan:
+        elements = list(elements)
+        known_relationships = len(self.relationships)
+        entities = self.closure(elements)
+        return CopyPlan(elements, entities, list(self.relationships.values())[known_relationships:])
+
+    def apply(self, plan: CopyPlan) -> dict[int, ifcopenshell.entity_instance]:
+        """Copy a plan made by this or another copier over the same source"""
+        for entity in plan.entities:
+            if entity.id() not in self.copies:
+                copy = self.copies[entity.id()] = self.target.add(entity)
+                self.sources[copy.id()] = entity.id()
+        for relationship in plan.relationships:
+            if relationship.id() not in self.relationships:
+                self.relationships[relationship.id()] = relationship
+            self.extend_relationship(relationship)
+        return self.copies
+
+    def closure(self, elements: Iterable[ifcopenshell.entity_instance]) -> list[ifcopenshell.entity_instance]:
+        """Entities not yet copied that the elements depend on, in topological (leaves first) order"""
+        order = []
+        visited = set()
+        pending = deque(elements)
+        while pending:
+            root = pending.popleft()
+            if root.id() in visited or root.id() in self.copies:
+                continue
+            visited.add(root.id())
+            stack = [(root, iter(self.references(root)))]
+            while stack:
+                entity, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    order.append(entity)
+                    pending.extend(self.attached(entity))
+                elif child.id() not in visited and child.id() not in self.copies:
+                    visited.add(child.id())
+                    stack.append((child, iter(self.references(child))))
+        return order
+
+    def references(self, entity: ifcopenshell.entity_instance) -> list[ifcopenshell.entity_instance]:
+        return [e for e in self.source.traverse(entity, max_levels=1)[1:] if e.id()]
+
+    def attached(self, entity: ifcopenshell.entity_instance) -> list[ifcopenshell.entity_instance]:
+        """Entities that reference entity and travel with it, recording relationships for later"""
+        attached = []
+        for inverse in self.inverses(entity):
+            if inverse.is_a("IfcRelationship") or any(hasattr(inverse, a) for a in FAN_OUT_ATTRIBUTES):
+                self.encountered[inverse.id()] = inverse
+                if inverse.id() not in self.relationships:
+                    self.relationships[inverse.id()] = inverse
+                    attached.extend(self.relationship_references(inverse))
+            else:
+                attached.append(inverse)
+        if entity.is_a("IfcObject"):
+            element_type = ifcopenshell.util.element.get_type(entity)
+            if element_type:
+                attached.append(element_type)
+                for rel in getattr(entity, "IsTypedBy", None) or getattr(entity, "IsDefinedBy", []):
+                    if rel.is_a("IfcRelDefinesByType"):
+                        self.encountered[rel.id()] = rel
+                        self.relationships.setdefault(rel.id(), rel)
+        return attached
+
+    def inverses(self, entity: ifcopenshell.entity_instance) -> list[ifcopenshell.entity_instance]:
+        attributes = self._inverse_attributes_by_class.get(entity.is_a())
+        if attributes is None:
+            attributes = self._inverse_attributes_by_class[entity.is_a()] = [
+                attribute.partition(".")[::2]
+                for source_class, class_attributes in self.inverse_attributes.items() if entity.is_a(source_class)
+                for attribute in class_attributes
+            ]
+        inverses = []
+        for attribute, attribute_class in attributes:
+            for inverse in getattr(entity, attribute, None) or []:
+                if not attribute_class or inverse.is_a(attribute_class):
+                    inverses.append(inverse)
+        return inverses
+
+    def relationship_references(self, relationship: ifcopenshell.entity_instance) -> list[ifcopenshell.entity_instance]:
+        """Entities a relationship needs apart from the objects it fans out to"""
+        references = []
+        for name, value in relationship.get_info(include_identifier=False, recursive=False).items():
+            if name in FAN_OUT_ATTRIBUTES:
+                if relationship.is_a("IfcRelNests"):
+                    references.extend(e for e in value if e.is_a("IfcDistributionPort"))
+                continue
+            if isinstance(value, ifcopenshell.entity_instance) and value.id():
+                references.append(value)
+            elif isinstance(value, tuple):
+                references.extend(e for e in value if isinstance(e, ifcopenshell.entity_instance) and e.id())
+        return references
+
+    def map(self, value):
+        if isinstance(value, ifcopenshell.entity_instance):
+            copy = self.copies.get(value.id()) if value.id() else None
+            return copy if copy is not None else self.target.add(value)
+        if isinstance(value, tuple):
+            return [self.map(v) for v in value]
+        return value
+
+    def fan_out(self, value: tuple) -> list[ifcopenshell.entity_instance]:
+        return [self.copies[e.id()] for e in value if e.id() in self.copies]
+
+    def copy_relationship(self, relationship: ifcopenshell.entity_instance) -> None:
+        attributes = relationship.get_info(include_identifier=False, recursive=False)
+        del attributes["type"]
+        for name, value in attributes.items():
+            if name in FAN_OUT_ATTRIBUTES:
+                attributes[name] = self.fan_out(value)
+                if not attributes[name]:
+                    return
+            else:
+                attributes[name] = self.map(value)
+        copy = self.relationship_copies[relationship.id()] = self.target.create_entity(relationship.is_a(), **attributes)
+        self.relationship_sources[copy.id()] = relationship.id()
+
+    def extend_relationship(self, relationship: ifcopenshell.entity_instance) -> None:
+        copy = self.relationship_copies.get(relationship.id())
+        if copy is None:
+            self.copy_relationship(relationship)
+            return
+        for name in FAN_OUT_ATTRIBUTES:
+            if hasattr(relationship, name):
+                related = list(getattr(copy, name))
+                present = {e.id() for e in related}
+                related.extend(e for e in self.fan_out(getattr(relationship, name)) if e.id() not in present)
+                setattr(copy, name, related)
+
+    def remove(
+            self,
+            elements: Iterable[ifcopenshell.entity_instance],
+            keep: Callable[[ifcopenshell.entity_instance], bool] = lambda copy: False
+    ) -> int:
+        """Remove the copies of elements from target with whatever only they used, returning the number removed.
+
+        The copies are taken out of the copied relationships that fan out to
+        them and relationships that refer to them otherwise are removed. Other
+        copies go, with the entities attached to them, once nothing but
+        relationships fanning out to them refers to them, unless keep(copy) is
+        true.
+        """
+        pending = set()
+        detached: dict[int, tuple[ifcopenshell.entity_instance, set[int]]] = {}
+        for element in elements:
+            copy = self.copies.get(element.id())
+            if copy is None:
+                continue
+            for inverse in self.target.get_inverse(copy):
+                if inverse.id() in self.relationship_sources:
+                    detached.setdefault(inverse.id(), (inverse, set()))[1].add(copy.id())
+            pending.add(copy.id())
+        # Each relationship is rewritten once, however many of the elements it relates
+        for relationship, copy_ids in detached.values():
+            self.detach(relationship, copy_ids, pending)
+        removed = 0
+        # Checked in waves, so an entity shared by many removed ones is looked at once per wave
+        while pending:
+            candidates, pending = pending, set()
+            for entity_id in candidates:
+                try:
+                    copy = self.target.by_id(entity_id)
+                except RuntimeError:
+                    continue
+                if keep(copy) or not self.unused(copy):
+                    continue
+                for inverse in self.target.get_inverse(copy) if self.target.get_total_inverses(copy) else ():
+                    if inverse.id() in self.relationship_sources:
+                        self.detach(inverse, {copy.id()}, pending)
+                    else:
+                        self.discard(inverse, pending)
+                        removed += 1
+                self.discard(copy, pending)
+                removed += 1
+        return removed
+
+    def unused(self, copy: ifcopenshell.entity_instance) -> bool:
+        """Whether copy is referred to by nothing but copied relationships that fan out to it and the entities
+        attached to it"""
+        total = self.target.get_total_inverses(copy)
+        if not total:
+            return True
+        if total > MAX_UNUSED_INVERSES:
+            return False
+        attached = None
+        for inverse in self.target.get_inverse(copy):
+            if inverse.id() in self.relationship_sources:
+                if any(e.id() == copy.id() for name in FAN_OUT_ATTRIBUTES for e in getattr(inverse, name, None) or ()):
+                    continue
+                return False
+            if attached is None:
+                source_id = self.sources.get(copy.id())
+                attached = {e.id() for e in self.inverses(self.source.by_id(source_id))} if source_id else set()
+            if self.sources.get(inverse.id()) not in attached or self.target.get_total_inverses(inverse):
+                return False
+        return True
+
+    def detach(self, relationship: ifcopenshell.entity_instance, copy_ids: set[int], pending: set[int]) -> None:
+        """Take copies out of a copied relationship, removing the relationship if nothing is left for it to relate"""
+        for name in FAN_OUT_ATTRIBUTES:
+            related = getattr(relationship, name, None)
+            if not related:
+                continue
+            kept = [e for e in related if e.id() not in copy_ids]
+            if len(kept) == len(related):
+                continue
+            if kept:
+                setattr(relationship, name, kept)
+                return
+            break
+        self.discard(relationship, pending)
+
+    def discard(self, copy: ifcopenshell.entity_instance, pending: set[int]) -> None:
+        """Remove copy from target, queueing what it referred to to be checked"""
+        pending.update(e.id() for e in self.target.traverse(copy, max_levels=1)[1:] if e.id())
+        source_id = self.sources.pop(copy.id(), None)
+        if source_id is not None:
+            del self.copies[source_id]
+        source_id = self.relationship_sources.pop(copy.id(), None)
+        if source_id is not None:
+            del self.relationship_copies[source_id]
+            del self.relationships[source_id]
+        self.target.remove(copy)
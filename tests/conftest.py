@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "ifc_viewer_final"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# Stores read their directories at import, so point them away from the real caches first
+_scratch = tempfile.mkdtemp(prefix="ifc_viewer_tests_")
+for variable, name in [("IFC_CACHE_DIR", "cache"), ("IFC_JOB_DIR", "jobs"), ("IFC_SESSION_DIR", "sessions"),
+                       ("IFC_UPLOAD_DIR", "uploads"), ("IFC_ASSET_DIR", "assets"), ("IFC_METRICS_DIR", "metrics")]:
+    os.environ.setdefault(variable, os.path.join(_scratch, name))
+
+import ifcopenshell  # noqa: E402
+import ifcopenshell.api as api  # noqa: E402
+
+import synthetic  # noqa: E402
+
+
+def synthetic_args(*argv: str) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    synthetic.add_arguments(parser)
+    return parser.parse_args(list(argv))
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory) -> str:
+    """A small synthetic model: 3 storeys of 20 product slots, assemblies one level deep"""
+    path = str(tmp_path_factory.mktemp("models") / "synthetic.ifc")
+    synthetic.generate(path, synthetic_args("--storeys", "3", "--products-per-storey", "20", "--depth", "1"))
+    return path
+
+
+@pytest.fixture
+def model(model_path) -> ifcopenshell.file:
+    return ifcopenshell.open(model_path)
+
+
+@pytest.fixture
+def small_model() -> ifcopenshell.file:
+    """Walls, a slab and a door on two storeys, with properties on occurrences and on a wall type"""
+    file = ifcopenshell.file(schema="IFC4")
+    api.run("root.create_entity", file, ifc_class="IfcProject", name="Project")
+    storeys = [api.run("root.create_entity", file, ifc_class="IfcBuildingStorey", name=f"Level {n}") for n in (0, 1)]
+    concrete = api.run("material.add_material", file, name="Concrete")
+    wall_type = api.run("root.create_entity", file, ifc_class="IfcWallType", name="Partition")
+    type_pset = api.run("pset.add_pset", file, product=wall_type, name="Pset_WallCommon")
+    api.run("pset.edit_pset", file, pset=type_pset, properties={"FireRating": "EI30", "IsExternal": False})
+
+    def add(ifc_class, name, storey, properties=None):
+        element = api.run("root.create_entity", file, ifc_class=ifc_class, name=name)
+        api.run("spatial.assign_container", file, products=[element], relating_structure=storeys[storey])
+        if properties:
+            pset = api.run("pset.add_pset", file, product=element, name=f"Pset_{ifc_class[3:]}Common")
+            api.run("pset.edit_pset", file, pset=pset, properties=properties)
+        return element
+
+    external = add("IfcWall", "External wall", 0, {"FireRating": "EI60", "ThermalTransmittance": 0.3,
+                                                   "IsExternal": True})
+    partition = add("IfcWall", "Partition wall", 1, {"ThermalTransmittance": 1.5})
+    api.run("type.assign_type", file, related_objects=[partition], relating_type=wall_type)
+    slab = add("IfcSlab", "Floor slab", 0, {"LoadBearing": True})
+    api.run("material.assign_material", file, products=[external, slab], material=concrete)
+    add("IfcDoor", "Fire door", 1, {"FireRating": "EI30"})
+    return file
@@ -0,0 +1,108 @@
+import http.client
+import socket
+import urllib.parse
+
+import pytest
+
+from asset_server import AssetServer
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = AssetServer(str(tmp_path), port=0)
+    yield server
+    server.shutdown()
+
+
+def request(url: str, method: str = "GET", headers=None) -> tuple[int, dict, bytes]:
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+    try:
+        connection.request(method, parts.path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def test_whole_file_with_etag(server):
+    url = server.publish_bytes(DATA, "glb")
+    status, headers, body = request(url)
+    assert status == 200
+    assert body == DATA
+    assert headers["Content-Type"] == "model/gltf-binary"
+    assert headers["ETag"] == f'"{url.rsplit("/", 1)[1].split(".")[0]}"'
+    assert headers["Accept-Ranges"] == "bytes"
+    assert server.publish_bytes(DATA, "glb") == url
+
+    status, headers, body = request(url, "HEAD")
+    assert (status, headers["Content-Length"], body) == (200, str(len(DATA)), b"")
+
+
+@pytest.mark.parametrize("header, start, end", [
+    ("bytes=2-5", 2, 5),
+    ("bytes=1000-", 1000, 1023),
+    ("bytes=-24", 1000, 1023),
+    ("bytes=1020-5000", 1020, 1023),
+])
+def test_ranges(server, header, start, end):
+    status, headers, body = request(server.publish_bytes(DATA, "glb"), headers={"Range": header})
+    assert status == 206
+    assert body == DATA[start:end + 1]
+    assert headers["Content-Range"] == f"bytes {start}-{end}/{len(DATA)}"
+
+
+def test_unsatisfiable_and_malformed_ranges(server):
+    url = server.publish_bytes(DATA, "glb")
+    status, headers, _ = request(url, headers={"Range": "bytes=2000-"})
+    assert (status, headers["Content-Range"]) == (416, f"bytes */{len(DATA)}")
+    status, _, body = request(url, headers={"Range": "bytes=5-2"})
+    assert status == 416
+    for header in ("bytes=-", "items=0-5", "bytes=0-1,4-5"):
+        status, _, body = request(url, headers={"Range": header})
+        assert (status, body) == (200, DATA)
+
+
+def test_unknown_paths_and_tokens_are_not_found(server, tmp_path):
+    url = server.publish_bytes(DATA, "glb")
+    base, name = url.rsplit("/", 2)[0], url.rsplit("/", 1)[1]
+    assert request(f"{base}/{'A' * 43}/{name}")[0] == 404
+    assert request(f"{base}/{name}")[0] == 404
+    assert request(f"{base}/{server.token}/{'0' * 64}.glb")[0] == 404
+    assert request(f"{base}/{server.token}/../{name}")[0] == 404
+    assert request(f"{base}/{server.token}/")[0] == 204
+
+    (tmp_path / name).unlink()
+    assert request(url)[0] == 404
+
+
+def test_processes_share_one_server(server, tmp_path):
+    other = AssetServer(str(tmp_path), port=server.port)
+    assert other.server is None
+    url = other.publish_bytes(b"shared", "json")
+    assert request(url)[2] == b"shared"
+
+    # Once the owner is gone, the next process to publish serves the directory itself
+    server.shutdown()
+    url = other.publish_bytes(b"taken over", "json")
+    assert other.server is not None
+    assert request(url)[2] == b"taken over"
+    other.shutdown()
+
+
+def test_port_used_by_something_else(tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        s.listen()
+        with pytest.raises(RuntimeError, match="IFC_ASSET_PORT"):
+            AssetServer(str(tmp_path), port=s.getsockname()[1])
+
+
+def test_other_interfaces_need_a_base_url(tmp_path):
+    with pytest.raises(ValueError, match="IFC_ASSET_URL"):
+        AssetServer(str(tmp_path), port=0, host="0.0.0.0")
+    server = AssetServer(str(tmp_path), port=0, host="0.0.0.0", base_url="https://example.com/assets/")
+    assert server.publish_bytes(DATA, "glb").startswith(f"https://example.com/assets/{server.token}/")
+    server.shutdown()
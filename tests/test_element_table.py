@@ -0,0 +1,90 @@
+import csv
+import io
+import os
+
+import numpy as np
+import pytest
+
+from element_table import ElementTable, TableStore
+from model_index import ModelIndex
+
+
+@pytest.fixture
+def table(small_model) -> ElementTable:
+    return ElementTable.build(small_model)
+
+
+def row_of(table: ElementTable, name: str) -> int:
+    return int(np.flatnonzero(table.columns["Name"] == name)[0])
+
+
+def test_rows_follow_the_model_index(model):
+    index = ModelIndex(model)
+    table = ElementTable.build(model, index)
+
+    assert len(table) == len(index)
+    assert table.columns["GlobalId"].tolist() == [product.GlobalId for product in index.products()]
+    assert table.decoded("Class").tolist() == [product.is_a() for product in index.products()]
+    assert set(table.decoded("Storey")) == {"Level 0", "Level 1", "Level 2", ""}
+    assert {"Pset_Common.FireRating", "Pset_Common.IsExternal"} <= set(table.columns)
+
+
+def test_column_kinds(table):
+    wall = row_of(table, "External wall")
+    partition = row_of(table, "Partition wall")
+    door = row_of(table, "Fire door")
+
+    # Numbers are float columns with NaN where missing
+    transmittance = table.columns["Pset_WallCommon.ThermalTransmittance"]
+    assert transmittance.dtype == np.float64
+    assert transmittance[wall] == pytest.approx(0.3)
+    assert np.isnan(transmittance[door])
+    # Anything else is categorical, and occurrences without their own value show their type's
+    assert table.decoded("Pset_WallCommon.FireRating")[[wall, partition, door]].tolist() == ["EI60", "EI30", ""]
+    assert table.decoded("Type")[partition] == "Partition"
+    assert table.decoded("Storey")[door] == "Level 1"
+
+
+@pytest.mark.parametrize("compressed", [True, False])
+def test_save_and_load(tmp_path, table, compressed):
+    path = str(tmp_path / "table.npz")
+    table.save(path, compressed=compressed)
+    loaded = ElementTable.load(path)
+
+    assert list(loaded.columns) == list(table.columns)
+    for name, column in table.columns.items():
+        np.testing.assert_array_equal(loaded.columns[name], column)
+    assert set(loaded.categories) == set(table.categories)
+    for name, categories in table.categories.items():
+        np.testing.assert_array_equal(loaded.categories[name], categories)
+
+
+def test_csv_decodes_every_chunk(table):
+    output = io.StringIO()
+    table.write_csv(output, chunk_rows=2)
+    header, *rows = list(csv.reader(io.StringIO(output.getvalue())))
+
+    assert header == list(table.columns)
+    assert len(rows) == len(table)
+    wall = rows[row_of(table, "External wall")]
+    door = rows[row_of(table, "Fire door")]
+    column = header.index("Pset_WallCommon.ThermalTransmittance")
+    assert float(wall[column]) == pytest.approx(0.3)
+    assert door[column] == ""
+    assert door[header.index("Class")] == "IfcDoor"
+
+
+def test_store_builds_once_and_forgets_deleted_tables(tmp_path, small_model):
+    store = TableStore(str(tmp_path))
+    path = store.build("a" * 64, small_model)
+    assert store.build("a" * 64, small_model) == path
+    table = store.get("a" * 64)
+    assert len(table) == len(ModelIndex(small_model))
+
+    export = store.export("a" * 64, table, [row_of(table, "Fire door")])
+    with open(export, newline="", encoding="utf-8") as f:
+        assert len(list(csv.reader(f))) == 2
+
+    os.remove(path)
+    assert store.get("a" * 64) is None
+    assert not store.open_tables
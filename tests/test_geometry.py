@@ -0,0 +1,130 @@
+import io
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from geometry import BYTE, FLOAT, SHORT, BatchedGlbWriter, GlbWriter, Mesh, vertex_normals
+
+BOX_INDICES = np.array([[0, 1, 2], [0, 2, 3], [4, 6, 5], [4, 7, 6], [0, 4, 5], [0, 5, 1],
+                        [1, 5, 6], [1, 6, 2], [2, 6, 7], [2, 7, 3], [3, 7, 4], [3, 4, 0]], dtype=np.uint32)
+NORMALIZED = {BYTE: (np.int8, 127), SHORT: (np.int16, 32767)}
+
+
+def box(guid: str, size=(4.0, 0.2, 3.0), at=(0.0, 0.0, 0.0), geometry_id: str = "") -> Mesh:
+    x, y, z = size
+    positions = np.array([[0, 0, 0], [x, 0, 0], [x, y, 0], [0, y, 0],
+                          [0, 0, z], [x, 0, z], [x, y, z], [0, y, z]], dtype=np.float32)
+    matrix = np.eye(4)
+    matrix[:3, 3] = at
+    return Mesh(guid, "IfcWall", guid, geometry_id or guid, positions, vertex_normals(positions, BOX_INDICES),
+                BOX_INDICES, np.zeros(len(BOX_INDICES), dtype=np.int32), (("Concrete", (0.7, 0.7, 0.7, 1.0)),),
+                matrix)
+
+
+def world_positions(mesh: Mesh) -> np.ndarray:
+    return mesh.positions @ mesh.matrix[:3, :3].T + mesh.matrix[:3, 3]
+
+
+def read_glb(writer: GlbWriter) -> tuple[dict, bytes]:
+    output = io.BytesIO()
+    writer.write(output)
+    data = output.getvalue()
+    json_length = struct.unpack_from("<I", data, 12)[0]
+    gltf = json.loads(data[20:20 + json_length])
+    return gltf, data[28 + json_length:]
+
+
+def accessor_values(gltf: dict, binary: bytes, index: int) -> tuple[np.ndarray, np.ndarray]:
+    """Values of a VEC3 accessor as stored and as floats, normalized integers decoded"""
+    accessor = gltf["accessors"][index]
+    view = gltf["bufferViews"][accessor["bufferView"]]
+    if accessor["componentType"] == FLOAT:
+        stored = np.frombuffer(binary, np.float32, accessor["count"] * 3, view["byteOffset"]).reshape(-1, 3)
+        return stored, stored.astype(np.float64)
+    dtype, limit = NORMALIZED[accessor["componentType"]]
+    components = view["byteStride"] // np.dtype(dtype).itemsize
+    stored = np.frombuffer(binary, dtype, accessor["count"] * components, view["byteOffset"])
+    stored = stored.reshape(-1, components)[:, :3]
+    return stored, np.maximum(stored / limit, -1.0)
+
+
+def rotate(quaternion: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    x, y, z, w = quaternion
+    matrix = np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                       [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                       [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+    return vectors @ matrix.T
+
+
+@pytest.mark.parametrize("quantization", ["off", "high", "low"])
+def test_accessor_bounds_match_stored_positions(quantization):
+    writer = GlbWriter(quantization)
+    writer.add_mesh(box("wall", at=(10.0, 5.0, 0.0)))
+    gltf, binary = read_glb(writer)
+
+    accessor = gltf["accessors"][gltf["meshes"][0]["primitives"][0]["attributes"]["POSITION"]]
+    stored, _ = accessor_values(gltf, binary, gltf["meshes"][0]["primitives"][0]["attributes"]["POSITION"])
+    assert accessor["min"] == stored.min(axis=0).tolist()
+    assert accessor["max"] == stored.max(axis=0).tolist()
+    assert ("KHR_mesh_quantization" in gltf.get("extensionsRequired", [])) == (quantization != "off")
+
+
+@pytest.mark.parametrize("quantization, component_type", [("high", SHORT), ("low", BYTE)])
+def test_node_matrix_dequantizes_positions(quantization, component_type):
+    mesh = box("wall", at=(10.0, 5.0, 1.5))
+    writer = GlbWriter(quantization)
+    writer.add_mesh(mesh)
+    gltf, binary = read_glb(writer)
+
+    attributes = gltf["meshes"][0]["primitives"][0]["attributes"]
+    assert gltf["accessors"][attributes["POSITION"]]["componentType"] == component_type
+    _, decoded = accessor_values(gltf, binary, attributes["POSITION"])
+    matrix = np.array(gltf["nodes"][0]["matrix"]).reshape(4, 4).T
+    restored = decoded @ matrix[:3, :3].T + matrix[:3, 3]
+    step = 4.0 / NORMALIZED[component_type][1]
+    np.testing.assert_allclose(restored, world_positions(mesh), atol=step)
+
+
+def test_merged_batches_keep_16_bit_positions_at_low_quality():
+    # Boxes spread over 200 m, each its own representation, so all of them are merged
+    meshes = [box(f"wall{i}", at=(i * 50.0, 0.0, 0.0)) for i in range(5)]
+    writer = BatchedGlbWriter("low")
+    for mesh in meshes:
+        writer.add_mesh(mesh)
+    gltf, binary = read_glb(writer)
+
+    (node,) = [node for node in gltf["nodes"] if node["name"] == "Batched"]
+    attributes = gltf["meshes"][node["mesh"]]["primitives"][0]["attributes"]
+    assert gltf["accessors"][attributes["POSITION"]]["componentType"] == SHORT
+    _, decoded = accessor_values(gltf, binary, attributes["POSITION"])
+    matrix = np.array(node["matrix"]).reshape(4, 4).T
+    restored = decoded @ matrix[:3, :3].T + matrix[:3, 3]
+    expected = np.concatenate([world_positions(mesh) for mesh in meshes])
+    # Vertices are deduplicated per element but kept in element order
+    np.testing.assert_allclose(restored, expected, atol=0.01)
+
+
+def test_instances_fold_dequantization_into_their_transforms():
+    meshes = [box(f"wall{i}", at=(i * 50.0, 3.0, 0.0), geometry_id="shared") for i in range(3)]
+    writer = BatchedGlbWriter("low")
+    for mesh in meshes:
+        writer.add_mesh(mesh)
+    gltf, binary = read_glb(writer)
+
+    (node,) = [node for node in gltf["nodes"] if "extensions" in node]
+    assert node["extras"]["guids"] == ["wall0", "wall1", "wall2"]
+    attributes = gltf["meshes"][node["mesh"]]["primitives"][0]["attributes"]
+    assert gltf["accessors"][attributes["POSITION"]]["componentType"] == BYTE
+    _, decoded = accessor_values(gltf, binary, attributes["POSITION"])
+
+    instancing = node["extensions"]["EXT_mesh_gpu_instancing"]["attributes"]
+    translations = accessor_values(gltf, binary, instancing["TRANSLATION"])[1]
+    rotation = gltf["accessors"][instancing["ROTATION"]]
+    rotations = np.frombuffer(binary, np.float32, rotation["count"] * 4,
+                              gltf["bufferViews"][rotation["bufferView"]]["byteOffset"]).reshape(-1, 4)
+    scales = accessor_values(gltf, binary, instancing["SCALE"])[1]
+    for mesh, translation, quaternion, scale in zip(meshes, translations, rotations, scales):
+        restored = rotate(quaternion, decoded * scale) + translation + node["translation"]
+        np.testing.assert_allclose(restored, world_positions(mesh), atol=4.0 / 127)
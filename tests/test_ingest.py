@@ -0,0 +1,49 @@
+import io
+import os
+import time
+
+from ingest import UploadStore
+from jobs import JobRunner
+from session_store import SessionStore
+from test_jobs import wait_for_cancel
+
+
+def ingest_old(store: UploadStore, data: bytes, filename: str = "model.ifc"):
+    """Ingest data and date the upload back past the minimum age, as if it were last used an hour ago"""
+    upload = store.ingest(io.BytesIO(data), filename)
+    hour_ago = time.time() - 3600
+    os.utime(upload.path, (hour_ago, hour_ago))
+    return upload
+
+
+def test_least_recently_used_upload_is_evicted(tmp_path):
+    store = UploadStore(str(tmp_path))
+    first = ingest_old(store, b"a" * 1000)
+    second = ingest_old(store, b"b" * 1000)
+    store.ifc_path(first)
+    store.budget_bytes = 1500
+    store.ingest(io.BytesIO(b"c" * 1000), "model.ifc")
+
+    assert os.path.exists(first.path)
+    assert not os.path.exists(second.path)
+
+
+def test_uploads_in_use_are_not_evicted(tmp_path):
+    sessions = SessionStore(str(tmp_path / "sessions"))
+    runner = JobRunner(str(tmp_path / "jobs"), max_workers=1)
+    store = UploadStore(str(tmp_path / "uploads"),
+                        in_use=lambda: sessions.keys("model") | runner.active_params("model_key"))
+    try:
+        shown = ingest_old(store, b"a" * 1000)
+        sessions.bind("session", "model", shown.key)
+        queued = ingest_old(store, b"b" * 1000, "model.ifczip")
+        runner.submit("wait", wait_for_cancel, 60, params={"model_key": queued.key})
+        unused = ingest_old(store, b"c" * 1000)
+        store.budget_bytes = 500
+        store.ingest(io.BytesIO(b"d" * 1000), "model.ifc")
+
+        assert os.path.exists(shown.path)
+        assert os.path.exists(queued.path)
+        assert not os.path.exists(unused.path)
+    finally:
+        runner.shutdown()
@@ -0,0 +1,125 @@
+import gc
+import os
+import shutil
+import time
+import weakref
+
+import ifcopenshell
+import pytest
+
+import jobs
+from jobs import JobContext, JobRunner, filter_model
+from patcher import Patcher
+from test_subgraph_copy import described
+
+SPEC = {"stories": ["Level 0", "Level 1"], "keywords": ["fire"], "ifc_product": None, "filter_option": "Keywords Only",
+        "keyword_mode": "substring", "query": None}
+
+
+def test_worker_releases_the_previous_model(tmp_path, model_path):
+    other_path = str(tmp_path / "other.ifc")
+    shutil.copy(model_path, other_path)
+    first = filter_model(JobContext(str(tmp_path)), model_path, "a" * 64, SPEC, 1, "session")
+    assert first["products"]
+    released = weakref.ref(jobs._models["a" * 64])
+
+    filter_model(JobContext(str(tmp_path)), other_path, "b" * 64, SPEC, 1, "session")
+    gc.collect()
+
+    assert list(jobs._models) == ["b" * 64]
+    assert released() is None
+
+
+def test_refilter_matches_a_fresh_patch(tmp_path, model_path):
+    jobs._models.clear()
+    filter_model(JobContext(str(tmp_path)), model_path, "c" * 64, SPEC, 1, "session")
+    patcher = jobs._patchers["session"]
+    spec = dict(SPEC, stories=["Level 1", "Level 2"], keywords=["steel", "!fire"])
+    result = filter_model(JobContext(str(tmp_path)), model_path, "c" * 64, spec, 1, "session")
+
+    assert jobs._patchers["session"] is patcher
+    fresh = Patcher(jobs._models["c" * 64], jobs.logger, spec["stories"], spec["keywords"], spec["ifc_product"],
+                    spec["filter_option"], keyword_mode=spec["keyword_mode"], bulk_copy=True)
+    fresh.patch()
+    expected = described(fresh.file)
+    assert expected
+    assert described(ifcopenshell.open(result["artifact"]["path"])) == expected
+    assert result["products"] == len(fresh.file.by_type("IfcProduct"))
+
+
+def worker_pid(context: JobContext) -> int:
+    return os.getpid()
+
+
+def test_jobs_with_the_same_pin_run_in_the_same_worker(tmp_path):
+    runner = JobRunner(str(tmp_path), max_workers=2)
+    try:
+        pids = {}
+        for pin in ("a", "b", "c", "a", "b", "c"):
+            job_id = runner.submit("pid", worker_pid, pin=pin)
+            pids.setdefault(pin, set()).add(wait_until(runner, job_id, ("done",))["result"])
+        assert all(len(pinned) == 1 for pinned in pids.values())
+        assert len(set.union(*pids.values())) == 2
+    finally:
+        runner.shutdown()
+
+
+def wait_for_cancel(context: JobContext, seconds: float) -> str:
+    """Job that runs until it is cancelled or seconds pass"""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        context.report(stage="waiting")
+        time.sleep(0.05)
+    return "finished"
+
+
+def wait_until(runner: JobRunner, job_id: str, states: tuple, timeout: float = 60) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = runner.status(job_id)
+        if status["state"] in states:
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not reach {states}, it is {status['state']}")
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = JobRunner(str(tmp_path), max_workers=1)
+    yield runner
+    runner.shutdown()
+
+
+def test_jobs_with_the_same_key_are_shared(runner):
+    key = "c" * 64
+    first = runner.submit("wait", wait_for_cancel, 0.5, key=key, subscriber="a")
+    assert runner.submit("wait", wait_for_cancel, 0.5, key=key, subscriber="b") == first
+    assert runner.submit("wait", wait_for_cancel, 0.5, key="d" * 64, subscriber="a") != first
+
+    assert wait_until(runner, first, ("done",))["result"] == "finished"
+    assert runner.submit("wait", wait_for_cancel, 0.5, key=key, reuse=lambda status: True) == first
+    assert runner.submit("wait", wait_for_cancel, 0.5, key=key, reuse=lambda status: False) != first
+
+
+def test_shared_job_stops_when_its_last_subscriber_cancels(runner):
+    key = "e" * 64
+    job_id = runner.submit("wait", wait_for_cancel, 60, key=key, subscriber="a")
+    runner.submit("wait", wait_for_cancel, 60, key=key, subscriber="b")
+    wait_until(runner, job_id, ("running",))
+
+    assert not runner.cancel(job_id, "a")
+    assert runner.status(job_id)["state"] == "running"
+    assert runner.cancel(job_id, "b")
+    assert wait_until(runner, job_id, ("cancelled",))["state"] == "cancelled"
+    # A job being cancelled is not joined; the same request starts again
+    assert runner.submit("wait", wait_for_cancel, 0.1, key=key, subscriber="a") != job_id
+
+
+def test_subscribers_that_left_do_not_keep_a_job_running(runner):
+    job_id = runner.submit("wait", wait_for_cancel, 60, key="f" * 64, subscriber="left")
+    runner.subscribe(job_id, "stays")
+    old = time.time() - jobs.SUBSCRIBER_TIMEOUT_SECONDS - 1
+    os.utime(runner.subscriber_path(job_id, "left"), (old, old))
+
+    assert runner.cancel(job_id, "stays")
+    assert wait_until(runner, job_id, ("cancelled",))["state"] == "cancelled"
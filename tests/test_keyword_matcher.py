@@ -0,0 +1,73 @@
+import pytest
+
+from keyword_matcher import KeywordMatcher
+
+NAMES = ["Fire door", "Firewall", "Wall fire rated", "Internal wall", "FIRE EXIT", "Glazed door", ""]
+
+
+def selected(keywords, mode="substring", names=NAMES) -> list[str]:
+    matcher = KeywordMatcher(keywords, mode=mode)
+    positions = matcher.filter(names)
+    # The one-pass filter and per-name matching agree
+    assert positions == {n for n, name in enumerate(names) if matcher and matcher.matches(name)}
+    return [names[n] for n in sorted(positions)]
+
+
+@pytest.mark.parametrize("mode, expected", [
+    ("substring", ["Fire door", "Firewall", "Wall fire rated", "FIRE EXIT"]),
+    ("word", ["Fire door", "Wall fire rated", "FIRE EXIT"]),
+    ("prefix", ["Fire door", "Firewall", "Wall fire rated", "FIRE EXIT"]),
+])
+def test_modes(mode, expected):
+    assert selected(["fire"], mode) == expected
+
+
+def test_prefix_needs_the_start_of_a_word():
+    assert selected(["all"], "substring") == ["Firewall", "Wall fire rated", "Internal wall"]
+    assert selected(["all"], "prefix") == []
+    assert selected(["wal"], "prefix") == ["Wall fire rated", "Internal wall"]
+    assert selected(["wal"], "word") == []
+
+
+def test_keywords_sharing_prefixes():
+    assert selected(["fire door", "firewall", "f"], "word") == ["Fire door", "Firewall"]
+    assert selected(["fire", "fire door", "firewall"], "word") == [
+        "Fire door", "Firewall", "Wall fire rated", "FIRE EXIT"
+    ]
+    assert selected(["glazed", "gl", "door"], "word") == ["Fire door", "Glazed door"]
+
+
+def test_negation():
+    assert selected(["door", "!glazed"]) == ["Fire door"]
+    assert selected(["fire", "! wall"], "word") == ["Fire door", "FIRE EXIT"]
+
+
+def test_negation_only_keeps_everything_else():
+    assert selected(["!fire"]) == ["Internal wall", "Glazed door", ""]
+    assert selected(["!fire", "!door"], "word") == ["Firewall", "Internal wall", ""]
+
+
+def test_no_keywords_select_nothing():
+    assert not KeywordMatcher([" ", "!", ""])
+    assert selected([]) == []
+
+
+def test_metacharacters_are_literal():
+    names = ["Beam (steel) 1.5m", "Beam steel 105m", "C++ part", "a|b", "x.*y", "Wall [new]"]
+    assert selected(["(steel)"], names=names) == ["Beam (steel) 1.5m"]
+    assert selected(["1.5"], names=names) == ["Beam (steel) 1.5m"]
+    assert selected(["c++", "a|b", ".*", "[new]"], names=names) == ["C++ part", "a|b", "x.*y", "Wall [new]"]
+    assert selected(["|"], "substring", names) == ["a|b"]
+
+
+def test_names_with_newlines_map_to_their_own_position():
+    names = ["first line\nsecond fire", "plain", "fire\n", "\nfire", "nothing\nhere"]
+    assert selected(["fire"], names=names) == ["first line\nsecond fire", "fire\n", "\nfire"]
+    assert selected(["!fire"], names=names) == ["plain", "nothing\nhere"]
+    # A keyword cannot span lines, so it cannot join two names either
+    assert not KeywordMatcher(["line\nsecond"])
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError, match="Unknown keyword mode"):
+        KeywordMatcher(["fire"], mode="regex")
@@ -0,0 +1,60 @@
+import numpy as np
+
+from geometry import Mesh, vertex_normals
+from lod import BOX_TRIANGLES, coarse_meshes, decimate
+from test_geometry import box
+
+
+def grid(cells: int = 10, size: float = 1.0) -> Mesh:
+    """A flat square of size split into cells x cells quads, two triangles each"""
+    steps = np.linspace(0.0, size, cells + 1)
+    positions = np.array([[x, y, 0.0] for y in steps for x in steps], dtype=np.float32)
+    triangles = []
+    for row in range(cells):
+        for column in range(cells):
+            corner = row * (cells + 1) + column
+            triangles += [[corner, corner + 1, corner + cells + 2], [corner, corner + cells + 2, corner + cells + 1]]
+    indices = np.array(triangles, dtype=np.uint32)
+    return Mesh("grid", "IfcSlab", "grid", "grid", positions, vertex_normals(positions, indices), indices,
+                np.zeros(len(indices), dtype=np.int32), (("Concrete", (0.7, 0.7, 0.7, 1.0)),), np.eye(4))
+
+
+def test_clustering_merges_vertices_within_a_cell():
+    mesh = grid(10)
+    coarse = decimate(mesh, 0.25)
+    assert 0 < len(coarse.indices) < len(mesh.indices)
+    assert coarse.geometry_id == "grid-lod"
+    assert coarse.indices.max() < len(coarse.positions)
+    assert len(coarse.material_ids) == len(coarse.indices)
+    # Cluster means stay inside the original extent
+    assert np.all(coarse.positions.min(axis=0) >= mesh.positions.min(axis=0) - 1e-6)
+    assert np.all(coarse.positions.max(axis=0) <= mesh.positions.max(axis=0) + 1e-6)
+
+
+def test_meshes_clustering_does_not_simplify_become_their_box():
+    coarse = decimate(grid(10), 0.01)
+    assert coarse.geometry_id == "grid-box"
+    assert np.array_equal(coarse.indices, BOX_TRIANGLES)
+
+
+def test_meshes_that_collapse_become_their_box():
+    coarse = decimate(grid(10), 10.0)
+    assert coarse.geometry_id == "grid-box"
+    assert np.allclose(coarse.positions.min(axis=0), (0, 0, 0))
+    assert np.allclose(coarse.positions.max(axis=0), (1, 1, 0))
+
+
+def test_boxes_and_empty_meshes():
+    wall = box("wall")
+    assert decimate(wall, 0.1) is wall
+    empty = wall._replace(indices=np.empty((0, 3), np.uint32), material_ids=np.empty(0, np.int32))
+    assert decimate(empty, 0.1) is None
+
+
+def test_coarse_meshes_size_the_grid_to_all_meshes():
+    fine = grid(64, size=1.0)
+    far = box("far", at=(63.0, 0.0, 0.0))
+    coarse = coarse_meshes([fine, far, far._replace(indices=np.empty((0, 3), np.uint32))])
+    assert [mesh.guid for mesh in coarse] == ["grid", "far"]
+    # The bounds are 67 units wide, so the unit grid falls into a single cell and collapses
+    assert coarse[0].geometry_id == "grid-box"
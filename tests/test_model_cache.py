@@ -0,0 +1,70 @@
+import gc
+import os
+import weakref
+
+from model_cache import PARSED_BYTES_PER_TEXT_BYTE, ModelCache
+from model_index import ModelIndex
+
+
+def test_evicted_model_is_collected(model_path):
+    size = os.path.getsize(model_path)
+    cache = ModelCache(budget_bytes=size)
+    file = cache.open_path("first", model_path)
+    ModelIndex.for_file(file)
+    released = weakref.ref(file)
+    del file
+
+    cache.open_path("second", model_path)
+    gc.collect()
+
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("first") is None
+    assert released() is None
+
+
+def test_discarded_model_is_collected(model_path):
+    cache = ModelCache()
+    file = cache.open_path("key", model_path)
+    index = ModelIndex.for_file(file)
+    released = weakref.ref(file)
+    released_index = weakref.ref(index)
+    del file, index
+
+    cache.discard("key")
+    gc.collect()
+
+    assert released() is None
+    assert released_index() is None
+
+
+def test_hits_and_misses(model_path):
+    cache = ModelCache()
+    first = cache.open_path("key", model_path)
+    assert cache.open_path("key", model_path) is first
+    assert cache.get("other") is None
+
+    assert cache.stats() == {"hits": 1, "misses": 2, "evictions": 0, "entries": 1,
+                             "bytes": int(os.path.getsize(model_path) * PARSED_BYTES_PER_TEXT_BYTE),
+                             "budget_bytes": cache.budget_bytes}
+
+
+def test_least_recently_used_models_are_evicted_first(model):
+    cache = ModelCache(budget_bytes=int(3 * 100 * PARSED_BYTES_PER_TEXT_BYTE))
+    for key in ("a", "b", "c"):
+        cache.put(key, model, 100)
+    cache.get("a")
+    cache.put("d", model, 100)
+    assert list(cache.entries) == ["c", "a", "d"]
+
+    cache.put("e", model, 200)
+    assert list(cache.entries) == ["d", "e"]
+    assert cache.stats()["evictions"] == 3
+
+
+def test_a_model_larger_than_the_budget_is_kept_alone(model):
+    cache = ModelCache(budget_bytes=10)
+    cache.put("a", model, 100)
+    assert list(cache.entries) == ["a"]
+    cache.put("b", model, 100)
+    assert list(cache.entries) == ["b"]
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,96 @@
+import ifcopenshell
+import ifcopenshell.util.element
+import pytest
+
+from model_index import ModelIndex
+from query import And, Not, Or, Predicate, Query, QueryError, parse
+
+
+def names(file: ifcopenshell.file, text: str) -> list[str]:
+    index = ModelIndex(file)
+    return sorted(element.Name for element in index.elements(Query(text).run(index)))
+
+
+def test_and_binds_tighter_than_or_and_not_tighter_than_and():
+    assert parse("IfcWall or IfcSlab and not name ~ floor") == Or((
+        Predicate("class", None, "=", "IfcWall", False),
+        And((Predicate("class", None, "=", "IfcSlab", False),
+             Not(Predicate("name", None, "~", "floor", False)))),
+    ))
+
+
+def test_parentheses_quotes_and_property_fields():
+    assert parse('(IfcWall or IfcDoor) and Pset_WallCommon.FireRating = "EI \\"60\\""') == And((
+        Or((Predicate("class", None, "=", "IfcWall", False), Predicate("class", None, "=", "IfcDoor", False))),
+        Predicate("FireRating", "Pset_WallCommon", "=", 'EI "60"', True),
+    ))
+    assert parse("Tag") == Predicate("Tag", None, None, None, False)
+
+
+@pytest.mark.parametrize("text, message", [
+    ("", "empty"),
+    ("IfcWall and", "ends"),
+    ("(IfcWall or IfcSlab", r"Missing '\)'"),
+    ("IfcWall IfcSlab", "Unexpected 'IfcSlab'"),
+    ("name =", "Expected a value"),
+    ("= IfcWall", "Unexpected '='"),
+    ("class", "class supports only = and !="),
+    ("class ~ wall", "class supports only = and !="),
+    ("class > 3", "class supports only = and !="),
+    ("not class", "class supports only = and !="),
+    ("Pset_WallCommon.ThermalTransmittance < low", "compares numbers"),
+    ("Tag >= \"three\"", "compares numbers"),
+    (".FireRating = EI60", "Expected PropertySet.Property"),
+    ("Pset_WallCommon. = EI60", "Expected PropertySet.Property"),
+    ("name = \"unterminated", "Unexpected"),
+])
+def test_invalid_queries_are_rejected_when_parsed(text, message):
+    with pytest.raises(QueryError, match=message):
+        Query(text)
+
+
+def test_class_and_storey(small_model):
+    assert names(small_model, "IfcWall") == ["External wall", "Partition wall"]
+    assert names(small_model, "class != IfcWall and storey = \"level 0\"") == ["Floor slab"]
+    assert names(small_model, "IfcBuildingElement and not IfcWall") == ["Fire door", "Floor slab"]
+
+
+def test_text_number_and_boolean_values(small_model):
+    assert names(small_model, "name ~ WALL") == ["External wall", "Partition wall"]
+    assert names(small_model, "Pset_WallCommon.ThermalTransmittance < 1") == ["External wall"]
+    assert names(small_model, "Pset_WallCommon.ThermalTransmittance >= 0.3") == ["External wall", "Partition wall"]
+    assert names(small_model, "Pset_SlabCommon.LoadBearing = true") == ["Floor slab"]
+    assert names(small_model, "Pset_SlabCommon.LoadBearing") == ["Floor slab"]
+
+
+def test_type_properties_apply_to_occurrences_without_their_own(small_model):
+    assert names(small_model, "Pset_WallCommon.FireRating = EI30") == ["Partition wall"]
+    assert names(small_model, "Pset_WallCommon.FireRating != EI30") == ["External wall"]
+    assert names(small_model, "type = partition") == ["Partition wall"]
+
+
+def test_materials(small_model):
+    assert names(small_model, "material = concrete") == ["External wall", "Floor slab"]
+    assert names(small_model, "IfcElement and not material") == ["Fire door", "Partition wall"]
+
+
+def test_matches_a_scan_of_the_model(model):
+    index = ModelIndex(model)
+    matched = Query('(IfcWall or IfcElementAssembly) and Pset_Common.FireRating = "EI60" '
+                    'and not Pset_Common.IsExternal = true').run(index)
+
+    expected = set()
+    for position, element in enumerate(index.products()):
+        properties = ifcopenshell.util.element.get_psets(element).get("Pset_Common", {})
+        if (element.is_a("IfcWall") or element.is_a("IfcElementAssembly")) \
+                and properties.get("FireRating") == "EI60" and properties.get("IsExternal") is not True:
+            expected.add(position)
+    assert expected and matched == expected
+
+
+def test_explain_lists_the_cheapest_condition_first(small_model):
+    index = ModelIndex(small_model)
+    plan = Query("material = concrete and IfcWall").explain(index)
+    assert plan[0] == "intersection of, stopping once empty"
+    assert plan[1].strip().startswith("class = IfcWall")
+    assert plan[2].strip().startswith("material = concrete")
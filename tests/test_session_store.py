@@ -0,0 +1,43 @@
+import gc
+import weakref
+
+from model_cache import ModelCache
+from model_index import ModelIndex
+from session_store import SessionStore
+
+
+def test_expired_session_releases_its_model(tmp_path, model_path):
+    sessions = SessionStore(str(tmp_path), ttl_seconds=-1)
+    cache = ModelCache()
+    file = cache.open_path("model", model_path)
+    ModelIndex.for_file(file)
+    released = weakref.ref(file)
+    del file
+    assert sessions.bind("session", "model", "model") == set()
+
+    # What main.release_models does with the keys expire() returns
+    for key in sessions.expire():
+        cache.discard(key)
+    gc.collect()
+
+    assert cache.stats()["bytes"] == 0
+    assert released() is None
+
+
+def test_model_shared_by_sessions_is_kept_until_the_last_one_expires(tmp_path):
+    sessions = SessionStore(str(tmp_path))
+    sessions.bind("a", "model", "key")
+    sessions.bind("b", "model", "key")
+    assert sessions.drop("a") == set()
+    assert sessions.drop("b") == {"key"}
+
+
+def test_payloads_spill_to_disk_and_read_back(tmp_path):
+    sessions = SessionStore(str(tmp_path), memory_budget_bytes=10)
+    first = sessions.put("session", "first", b"x" * 8)
+    sessions.put("session", "second", b"y" * 8)
+
+    assert sessions.usage()["spills"] == 1
+    assert (tmp_path / f"{first}.payload").exists()
+    with sessions.open("session", "first") as f:
+        assert f.read() == b"x" * 8
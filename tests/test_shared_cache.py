@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import shared_cache
+
+
+def build_slowly(path: str, builds: str) -> bool:
+    def build(tmp_path: str) -> None:
+        with open(builds, "a") as f:
+            f.write("built\n")
+        time.sleep(0.3)
+        with open(tmp_path, "w") as f:
+            f.write("artifact")
+
+    built = shared_cache.build_once(path, build)
+    with open(path) as f:
+        assert f.read() == "artifact"
+    return built
+
+
+def test_build_once_across_processes(tmp_path):
+    path, builds = str(tmp_path / "entry.txt"), str(tmp_path / "builds.log")
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=build_slowly, args=(path, builds)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    assert [process.exitcode for process in processes] == [0, 0, 0, 0]
+    with open(builds) as f:
+        assert f.read().splitlines() == ["built"]
+    assert sorted(os.listdir(tmp_path)) == [shared_cache.LOCK_DIR, "builds.log", "entry.txt"]
+
+
+def test_build_once_across_threads(tmp_path):
+    path, builds = str(tmp_path / "entry.txt"), str(tmp_path / "builds.log")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(build_slowly(path, builds))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, False, False, True]
+
+
+def test_build_once_rebuilds_an_evicted_entry(tmp_path):
+    path = str(tmp_path / "entry.txt")
+    write = lambda tmp_path: open(tmp_path, "w").close()
+    assert shared_cache.build_once(path, write)
+    os.remove(path)
+    assert not shared_cache.touch(path)
+    assert shared_cache.build_once(path, write)
+
+
+def test_evict_leaves_recently_used_entries(tmp_path):
+    kind = tmp_path / "kind"
+    kind.mkdir()
+    for name, age in [("old", 3600), ("recent", 10)]:
+        (kind / name).write_bytes(b"x" * 100)
+        then = time.time() - age
+        os.utime(kind / name, (then, then))
+
+    freed = shared_cache.evict(str(tmp_path), budget_bytes=0, min_age_seconds=60)
+
+    assert freed == 100
+    assert sorted(set(os.listdir(kind)) - {shared_cache.LOCK_DIR}) == ["recent"]
+
+
+def test_evict_removes_lock_files_of_deleted_entries(tmp_path):
+    kind = str(tmp_path / "kind")
+    for name in ("first", "second"):
+        shared_cache.build_once(os.path.join(kind, name), lambda tmp_path: open(tmp_path, "wb").write(b"x" * 100))
+    old = time.time() - 3600
+    os.utime(os.path.join(kind, "first"), (old, old))
+    # A build that failed leaves a lock without an entry
+    with shared_cache.locked(kind, "failed"):
+        pass
+
+    shared_cache.evict(str(tmp_path), budget_bytes=100, min_age_seconds=60)
+
+    assert sorted(os.listdir(kind)) == [shared_cache.LOCK_DIR, "second"]
+    assert os.listdir(os.path.join(kind, shared_cache.LOCK_DIR)) == ["second.lock"]
+
+
+def test_lock_removed_while_waiting_is_taken_again(tmp_path):
+    directory = str(tmp_path)
+    order = []
+
+    def wait_for_lock():
+        with shared_cache.locked(directory, "entry"):
+            order.append("waiter")
+            assert os.path.exists(shared_cache.lock_path(directory, "entry"))
+
+    with shared_cache.locked(directory, "entry"):
+        waiter = threading.Thread(target=wait_for_lock)
+        waiter.start()
+        time.sleep(0.1)
+        shared_cache.remove_lock(directory, "entry")
+        order.append("holder")
+    waiter.join(5)
+    assert order == ["holder", "waiter"]
@@ -0,0 +1,88 @@
+import logging
+import os
+import zipfile
+
+import ifcopenshell
+import pytest
+
+from model_index import ModelIndex
+from output_store import OutputStore
+from splitter import Splitter, read_counts
+
+logger = logging.getLogger("IFCLogger")
+
+
+def with_ancestors(elements) -> set[str]:
+    """GlobalIds of the products among elements and the spatial structure and assemblies above them"""
+    seen = {}
+    pending = list(elements)
+    while pending:
+        element = pending.pop()
+        if element.GlobalId in seen:
+            continue
+        seen[element.GlobalId] = element
+        pending += [rel.RelatingStructure for rel in getattr(element, "ContainedInStructure", [])]
+        pending += [rel.RelatingObject for rel in getattr(element, "Decomposes", [])]
+    return {guid for guid, element in seen.items() if element.is_a("IfcProduct")}
+
+
+def products(file: ifcopenshell.file) -> set[str]:
+    return {product.GlobalId for product in file.by_type("IfcProduct")}
+
+
+def test_split_by_storey(model):
+    index = ModelIndex(model)
+    outputs = dict(Splitter(model, logger, "storey", index=index).split())
+
+    assert list(outputs) == ["Level 0", "Level 1", "Level 2"]
+    for storey, output in outputs.items():
+        selected = index.elements(index.in_storeys([storey]))
+        assert products(output) == with_ancestors(selected)
+        assert len(output.by_type("IfcBuildingStorey")) == 1
+        assert len(output.by_type("IfcProject")) == 1
+
+
+def test_split_by_class_skips_spatial_classes(model):
+    index = ModelIndex(model)
+    outputs = dict(Splitter(model, logger, "class", index=index).split())
+
+    assert "IfcWall" in outputs
+    assert not {"IfcSite", "IfcBuilding", "IfcBuildingStorey"} & set(outputs)
+    contained = index.in_storeys(["Level 0", "Level 1", "Level 2"])
+    for ifc_class, output in outputs.items():
+        # Parts of assemblies are in no storey themselves, so they are left out like in a filter
+        selected = index.elements(index.by_class[ifc_class] & contained)
+        assert {element.is_a() for element in selected} == {ifc_class}
+        assert products(output) == with_ancestors(selected)
+
+
+def test_zip_counts_the_products_of_each_file(model, tmp_path):
+    output = str(tmp_path / "split.zip")
+    counts = Splitter(model, logger, "storey", stories=["Level 0", "Level 2"]).write_zip(output, "model")
+
+    assert list(counts) == ["model_Level_0.ifc", "model_Level_2.ifc"]
+    assert read_counts(output) == counts
+    assert os.listdir(tmp_path) == ["split.zip"]
+    with zipfile.ZipFile(output) as zip_ref:
+        assert zip_ref.namelist() == list(counts)
+        for filename, count in counts.items():
+            split = ifcopenshell.file.from_string(zip_ref.read(filename).decode("utf-8"))
+            assert len(split.by_type("IfcProduct")) == count
+
+
+def test_output_store_splits_each_model_once(model, tmp_path, monkeypatch):
+    written = []
+    write_zip = Splitter.write_zip
+    monkeypatch.setattr(Splitter, "write_zip", lambda self, *args: written.append(args) or write_zip(self, *args))
+    store = OutputStore(str(tmp_path))
+    path, counts = store.split("model", Splitter(model, logger, "class"), "model")
+
+    assert store.split("model", Splitter(model, logger, "class"), "model") == (path, counts)
+    assert len(written) == 1
+    assert store.split("model", Splitter(model, logger, "storey"), "model")[0] != path
+    assert "model_IfcWall.ifc" in counts
+
+
+def test_unknown_split_is_rejected(model):
+    with pytest.raises(ValueError):
+        Splitter(model, logger, "material")
@@ -0,0 +1,110 @@
+import logging
+from collections import Counter
+
+import ifcopenshell
+import ifcopenshell.util.element
+import ifcopenshell.util.placement
+import numpy as np
+import pytest
+
+from model_index import ModelIndex
+from patcher import Patcher
+from subgraph_copy import SubgraphCopier
+
+logger = logging.getLogger("IFCLogger")
+
+
+def described(file: ifcopenshell.file) -> dict:
+    """What a filtered model says about each product, independent of entity ids and of how it was copied"""
+    products = {}
+    for product in file.by_type("IfcProduct"):
+        element_type = ifcopenshell.util.element.get_type(product)
+        material = ifcopenshell.util.element.get_material(product)
+        container = ifcopenshell.util.element.get_container(product)
+        aggregate = ifcopenshell.util.element.get_aggregate(product)
+        psets = ifcopenshell.util.element.get_psets(product)
+        items = [item.is_a() for representation in product.Representation.Representations
+                 for item in representation.Items] if product.Representation else []
+        products[product.GlobalId] = (
+            product.is_a(),
+            product.Name,
+            {name: {k: v for k, v in properties.items() if k != "id"} for name, properties in psets.items()},
+            element_type.GlobalId if element_type else None,
+            material.Name if material else None,
+            container.GlobalId if container else None,
+            aggregate.GlobalId if aggregate else None,
+            np.round(ifcopenshell.util.placement.get_local_placement(product.ObjectPlacement), 6).tolist()
+            if product.ObjectPlacement else None,
+            sorted(items),
+        )
+    return products
+
+
+def filtered(file: ifcopenshell.file, bulk_copy: bool) -> ifcopenshell.file:
+    patcher = Patcher(file, logger, ["Level 0", "Level 1", "Level 2"], ["fire", "steel"], None, "Keywords Only",
+                      index=ModelIndex(file), bulk_copy=bulk_copy)
+    patcher.patch()
+    return patcher.file
+
+
+def test_bulk_copy_matches_append_asset_per_element(model):
+    per_element = filtered(model, bulk_copy=False)
+    bulk = filtered(model, bulk_copy=True)
+
+    expected = described(per_element)
+    assert len(expected) > 10
+    assert described(bulk) == expected
+    # Each shared entity is copied once, where append_asset repeats some per element
+    assert len(list(bulk)) <= len(list(per_element))
+
+
+def entity_counts(file: ifcopenshell.file) -> Counter:
+    return Counter(entity.is_a() for entity in file)
+
+
+@pytest.fixture
+def walls(model) -> list:
+    return model.by_type("IfcWall")
+
+
+def test_plan_applies_like_a_direct_copy(model, walls):
+    direct = ifcopenshell.file(schema=model.schema)
+    SubgraphCopier(model, direct).copy(walls)
+
+    plan = SubgraphCopier(model, None).plan(walls)
+    targets = [ifcopenshell.file(schema=model.schema) for _ in range(2)]
+    for target in targets:
+        copies = SubgraphCopier(model, target).apply(plan)
+        assert {wall.id() for wall in walls} <= set(copies)
+
+    assert entity_counts(direct)["IfcWall"] == len(walls)
+    for target in targets:
+        assert entity_counts(target) == entity_counts(direct)
+        assert described(target) == described(direct)
+
+
+def test_copies_made_in_several_calls_share_relationships(model, walls):
+    at_once = ifcopenshell.file(schema=model.schema)
+    SubgraphCopier(model, at_once).copy(walls)
+
+    in_parts = ifcopenshell.file(schema=model.schema)
+    copier = SubgraphCopier(model, in_parts)
+    for wall in walls:
+        copier.copy([wall])
+
+    assert entity_counts(in_parts) == entity_counts(at_once)
+    assert described(in_parts) == described(at_once)
+
+
+def test_remove_leaves_what_copying_the_rest_gives(model, walls):
+    kept, removed = walls[:len(walls) // 2], walls[len(walls) // 2:]
+    expected = ifcopenshell.file(schema=model.schema)
+    SubgraphCopier(model, expected).copy(kept)
+
+    target = ifcopenshell.file(schema=model.schema)
+    copier = SubgraphCopier(model, target)
+    copier.copy(walls)
+    assert copier.remove(removed) > 0
+
+    assert described(target) == described(expected)
+    assert entity_counts(target) == entity_counts(expected)